@@ -0,0 +1,91 @@
+"""
+Benchmark runner.
+
+    python -m benchmarks run --out benchmarks/results/current.json [--filter attention]
+    python -m benchmarks compare benchmarks/results/baseline.json benchmarks/results/current.json
+    python -m benchmarks image_cost --img_size 384 --camera 1080 1920
+
+`compare` exits with status 1 when any benchmark got slower than the
+threshold allows, so it can gate a change in CI. Record the baseline on the
+same machine, from the commit before the change.
+"""
+import argparse
+import sys
+
+import torch
+
+from . import common, e2e, micro  # noqa: F401, registers the benchmarks
+
+
+def cmd_run(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    results = common.run(args.filter, repeat=args.repeat, warmup=args.warmup, device=args.device)
+    if args.out:
+        common.save(results, args.out)
+        print(f"saved to {args.out}")
+    return 0
+
+
+def cmd_compare(args):
+    baseline, current = common.load(args.baseline), common.load(args.current)
+    rows, regressions, warnings = common.compare(baseline, current, args.threshold, args.stat)
+    for w in warnings:
+        print(f"warning: {w}")
+    print(f"{'benchmark':<40} {'baseline(ms)':>13} {'current(ms)':>13} {'ratio':>7}  status")
+    for name, base, cur, ratio, status in rows:
+        if ratio is None:
+            print(f"{name:<40} {'-':>13} {'-':>13} {'-':>7}  {status}")
+        else:
+            print(f"{name:<40} {base * 1e3:13.3f} {cur * 1e3:13.3f} {ratio:7.3f}  {status}")
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+def cmd_image_cost(args):
+    """Backbone FLOPs and image tokens of the square canvas and of the canvas fitted to the camera."""
+    from utils.strefer_utils import fit_img_shape, letterbox_size
+    square = letterbox_size(args.img_size)
+    canvases = [('img_size', square), ('fit_camera', fit_img_shape(max(args.img_size), args.camera))]
+    print(f"{'canvas':<24} {'backbone GFLOPs':>16} {'image tokens':>13} {'packed':>7}")
+    for name, img_size in canvases:
+        cost = micro.image_cost(img_size, args.camera)
+        print(f"{name + ' ' + cost['canvas']:<24} {cost['backbone_gflops']:16.2f} {cost['tokens']:13d} "
+              f"{cost['packed_tokens']:7d}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser('python -m benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help='run the benchmarks and write a JSON result file')
+    run.add_argument('--out', default='', type=str)
+    run.add_argument('--filter', default='', type=str, help='regex on benchmark names')
+    run.add_argument('--repeat', default=10, type=int)
+    run.add_argument('--warmup', default=2, type=int)
+    run.add_argument('--device', default='cpu', type=str)
+    run.add_argument('--threads', default=0, type=int, help='torch intra-op threads, 0 keeps the default')
+    run.set_defaults(fn=cmd_run)
+
+    compare = sub.add_parser('compare', help='flag regressions of current against baseline')
+    compare.add_argument('baseline', type=str)
+    compare.add_argument('current', type=str)
+    compare.add_argument('--threshold', default=0.1, type=float, help='allowed relative slowdown')
+    compare.add_argument('--stat', default='median', choices=['median', 'mean', 'min'])
+    compare.set_defaults(fn=cmd_compare)
+
+    image_cost = sub.add_parser('image_cost', help='backbone FLOPs and attention tokens per image canvas')
+    image_cost.add_argument('--img_size', default=[384], type=int, nargs='+', help='as in train.py')
+    image_cost.add_argument('--camera', default=list(micro.CAMERA), type=int, nargs=2, help='image height and width')
+    image_cost.set_defaults(fn=cmd_image_cost)
+
+    args = parser.parse_args(argv)
+    return args.fn(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+"""
+Benchmark registry, timer and result files.
+
+A benchmark is a function decorated with @benchmark that does its setup and
+returns the zero-argument callable to time. It raises Skip when something it
+needs (CUDA ops, pretrained files, spaCy models) is missing, and the reason
+is kept in the results instead of failing the run.
+"""
+import json
+import os
+import platform
+import re
+import subprocess
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+REGISTRY = OrderedDict()
+
+
+class Skip(Exception):
+    """Raised by a benchmark setup that cannot run on this machine."""
+
+
+def benchmark(name, group, memory=False, saved=False):
+    """
+    Register a benchmark. With memory=True the peak memory of one call is
+    recorded (device memory on CUDA, Python / NumPy allocations on CPU); with
+    saved=True the bytes autograd saves for backward during one call.
+    """
+    def register(fn):
+        REGISTRY[name] = (group, fn, memory, saved)
+        return fn
+    return register
+
+
+def sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def measure(fn, repeat=10, warmup=2, min_sample_time=0.01, device='cpu'):
+    """
+    Time fn() and return per-call statistics in seconds.
+
+    Fast calls are looped inside one sample until the sample takes at least
+    `min_sample_time`, as timeit.autorange does.
+    """
+    for _ in range(warmup):
+        fn()
+    sync(device)
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        sync(device)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_sample_time or number >= 1 << 16:
+            break
+        number *= 2
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        sync(device)
+        samples.append((time.perf_counter() - start) / number)
+    samples = np.asarray(samples)
+    return {
+        'median': float(np.median(samples)),
+        'mean': float(samples.mean()),
+        'min': float(samples.min()),
+        'std': float(samples.std()),
+        'repeat': repeat,
+        'number': number,
+    }
+
+
+def peak_memory(fn, device='cpu'):
+    """Peak bytes allocated on the CUDA `device`, or through Python / NumPy on CPU, during one fn() call."""
+    if torch.device(device).type == 'cuda':
+        sync(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        fn()
+        sync(device)
+        return torch.cuda.max_memory_allocated(device)
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def saved_tensor_bytes(fn):
+    """
+    Bytes of the tensors autograd saves for backward during one fn() call,
+    each storage counted once. Parameters saved by their layers are included.
+    Unlike the CPU allocator, this is observable on every device.
+    """
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(storages.values())
+
+
+def _cpu_model():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def _git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def machine_info():
+    info = {
+        'hostname': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu': _cpu_model(),
+        'cpu_count': os.cpu_count(),
+        'torch': torch.__version__,
+        'torch_threads': torch.get_num_threads(),
+        'numpy': np.__version__,
+        'cuda': torch.version.cuda if torch.cuda.is_available() else None,
+        'gpu': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+        'git_commit': _git_commit(),
+    }
+    return info
+
+
+def run(pattern='', repeat=10, warmup=2, device='cpu', verbose=True):
+    """Run every registered benchmark whose name matches `pattern`; returns the result dict."""
+    results = OrderedDict()
+    for name, (group, fn, memory, saved) in REGISTRY.items():
+        if pattern and not re.search(pattern, name):
+            continue
+        try:
+            call = fn(device)
+            stats = measure(call, repeat=repeat, warmup=warmup, device=device)
+            results[name] = dict(group=group, **stats)
+            line = f"{name:<40} {stats['median'] * 1e3:10.3f} ms  (min {stats['min'] * 1e3:.3f}, std {stats['std'] * 1e3:.3f})"
+            if memory:
+                results[name]['peak_bytes'] = peak_memory(call, device)
+                line += f"  peak {results[name]['peak_bytes'] / 2 ** 20:.1f} MiB"
+            if saved:
+                results[name]['saved_bytes'] = saved_tensor_bytes(call)
+                line += f"  saved {results[name]['saved_bytes'] / 2 ** 20:.1f} MiB"
+        except Skip as e:
+            results[name] = {'group': group, 'skipped': str(e)}
+            line = f"{name:<40} skipped: {e}"
+        if verbose:
+            print(line)
+    return {
+        'machine': machine_info(),
+        'config': {'repeat': repeat, 'warmup': warmup, 'device': device},
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+
+def save(results, path):
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+MACHINE_KEYS = ('cpu', 'cpu_count', 'torch', 'torch_threads', 'gpu')
+
+
+def compare(baseline, current, threshold=0.1, stat='median'):
+    """
+    Compare two result dicts.
+
+    Returns (rows, regressions, warnings). A benchmark regresses when its
+    `stat` grew by more than `threshold` (relative) over the baseline.
+    """
+    warnings = []
+    for key in MACHINE_KEYS:
+        a, b = baseline['machine'].get(key), current['machine'].get(key)
+        if a != b:
+            warnings.append(f"machine differs in {key}: {a} -> {b}")
+    rows, regressions = [], []
+    for name, cur in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None or 'skipped' in base or 'skipped' in cur:
+            rows.append((name, None, None, None, 'n/a'))
+            continue
+        ratio = cur[stat] / base[stat]
+        if ratio > 1 + threshold:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            status = 'faster'
+        else:
+            status = 'ok'
+        rows.append((name, base[stat], cur[stat], ratio, status))
+    return rows, regressions, warnings
@@ -0,0 +1,36 @@
+''' Testing the benchmark timer and the regression check. '''
+
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from benchmarks.common import compare, measure
+
+
+def result(machine, **timings):
+    results = {name: ({'skipped': 'reason'} if t is None else {'median': t, 'mean': t, 'min': t})
+               for name, t in timings.items()}
+    return {'machine': machine, 'results': results}
+
+
+def test_measure():
+    stats = measure(lambda: sum(range(100)), repeat=3, warmup=1, min_sample_time=1e-3)
+    assert stats['repeat'] == 3 and stats['number'] >= 1
+    assert 0 < stats['min'] <= stats['median']
+
+
+def test_compare():
+    machine = {'cpu': 'x', 'torch': '2'}
+    baseline = result(machine, a=1.0, b=1.0, c=1.0, d=1.0)
+    current = result(dict(machine, cpu='y'), a=1.05, b=1.5, c=0.5, d=None, e=1.0)
+    rows, regressions, warnings = compare(baseline, current, threshold=0.1)
+    status = {row[0]: row[-1] for row in rows}
+    assert status == {'a': 'ok', 'b': 'REGRESSION', 'c': 'faster', 'd': 'n/a', 'e': 'n/a'}
+    assert regressions == ['b']
+    assert len(warnings) == 1 and 'cpu' in warnings[0]
+
+
+if __name__ == '__main__':
+    test_measure()
+    test_compare()
@@ -0,0 +1,270 @@
+"""End-to-end benchmarks: dataset __getitem__, collate and the WildRefer train / eval step."""
+import argparse
+import atexit
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+
+from .common import Skip, benchmark
+from .micro import text_models
+
+# a small config that still exercises every stage of the model
+SMALL = dict(
+    max_obj_num=100, max_lang_num=100, num_queries=64, num_decoder_layers=2, frame_num=2,
+    img_size=192, fit_camera=False, batch_size=2, num_points=8192, lr_backbone=1e-3, butd=False, seed_keep=0,
+    pack_image_tokens=False, seed=0, crop=False, ground_height=0., voxel_size=0., dedup_frames=False,
+    own_previous_points=False,
+)
+
+_corpora = dict()
+
+
+def small_args(**kwargs):
+    args = dict(SMALL, dataset='strefer', src_path='', data_root='data')
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def synthetic_corpus(dataset):
+    """Generate (once per process) a small synthetic corpus, returns (src_path, data_root)."""
+    if dataset not in _corpora:
+        from datasets.synthetic import SCALES, generate
+        out = tempfile.mkdtemp(prefix=f'{dataset}_bench_')
+        atexit.register(shutil.rmtree, out, True)
+        num_scenes, frames, _, _, boxes, descriptions = SCALES['small']
+        # few scenes, but frames and images at capture size so __getitem__ does the real work
+        _corpora[dataset] = generate(out, dataset, num_scenes, frames, 60000, (1920, 1080), boxes, descriptions)
+    return _corpora[dataset]
+
+
+def fake_sample(args, num_points=30000, rng=None):
+    """A sample with the keys, shapes and dtypes of the STRefer __getitem__ output."""
+    rng = rng or np.random.default_rng(0)
+    K, S, M = args.frame_num, args.img_size, args.max_obj_num
+    img_mask = np.zeros((K, S, S), dtype=bool)
+    img_mask[:, S // 8:S - S // 8] = True
+    positive_map = np.zeros((M, args.max_lang_num), dtype=np.float32)
+    positive_map[0, 1:3] = 0.5
+    box_label_mask = np.zeros(M, dtype=np.float32)
+    box_label_mask[0] = 1
+    center = np.zeros((M, 3), dtype=np.float32)
+    center[0] = rng.random(3) * [30, 40, 2]
+    size = np.zeros((M, 3), dtype=np.float32)
+    size[0] = rng.random(3) + 0.5
+    return {
+        'point_clouds': ((rng.random((K, num_points, 6)) - 0.5) * [30, 40, 5, 1, 1, 1]).astype(np.float32),
+        'text': 'the tall man in a red jacket is walking towards the car not mentioned',
+        'dynamic_mask': np.ones(K, dtype=np.int64),
+        'image': rng.random((K, 3, S, S), dtype=np.float32),
+        'img_mask': img_mask,
+        'img_layout': ['e2e'] * K,  # the same mask for every frame
+        'det_boxes': rng.random((M, 6), dtype=np.float32),
+        'det_bbox_label_mask': np.ones(M, dtype=bool),
+        'center_label': center,
+        'size_gts': size,
+        'box_label_mask': box_label_mask,
+        'point_instance_label': -np.ones(num_points, dtype=np.int64),
+        'sem_cls_label': np.zeros(M, dtype=np.int64),
+        'tokens_positive': np.zeros((M, 2), dtype=np.int64),
+        'positive_map': positive_map,
+    }
+
+
+def _getitem_bench(dataset_name, mode='train'):
+    from datasets import create_dataset, required_fields
+    src_path, data_root = synthetic_corpus(dataset_name)
+    args = small_args(dataset=dataset_name, src_path=src_path, data_root=data_root, img_size=384,
+                      num_points=30000)
+    fields = required_fields(args, mode)
+    if 'positive_map' in fields:
+        text_models()
+    dataset = create_dataset(args, 'train', fields)
+    state = {'index': 0}
+
+    def call():
+        dataset[state['index'] % len(dataset)]
+        state['index'] += 1
+    return call
+
+
+@benchmark('e2e/getitem_strefer', 'data')
+def bench_getitem_strefer(device):
+    return _getitem_bench('strefer')
+
+
+@benchmark('e2e/getitem_wildrefer', 'data')
+def bench_getitem_wildrefer(device):
+    return _getitem_bench('wildrefer')
+
+
+@benchmark('e2e/getitem_strefer_infer', 'data')
+def bench_getitem_strefer_infer(device):
+    return _getitem_bench('strefer', 'infer')
+
+
+@benchmark('e2e/getitem_wildrefer_infer', 'data')
+def bench_getitem_wildrefer_infer(device):
+    return _getitem_bench('wildrefer', 'infer')
+
+
+@benchmark('e2e/collate', 'data')
+def bench_collate(device):
+    from torch.utils.data import default_collate
+    args = small_args(img_size=384)
+    rng = np.random.default_rng(0)
+    batch = [fake_sample(args, rng=rng) for _ in range(8)]
+    return lambda: default_collate(batch)
+
+
+@benchmark('e2e/collate_unique_frames', 'data')
+def bench_collate_unique_frames(device):
+    """The batch of e2e/collate as a SceneAwareSampler run of 4 consecutive frames makes it: 2 runs, 5 unique frames each."""
+    from datasets.collate import collate_unique_frames
+    args = small_args(img_size=384)
+    rng = np.random.default_rng(0)
+    frames = {}
+    batch = []
+    for run in range(2):
+        for f in range(4):
+            keys = [f'{run}/{f}', f'{run}/{f - 1}']
+            sample = fake_sample(args, rng=rng)
+            for k, key in enumerate(keys):
+                for name in ('point_clouds', 'image', 'img_mask'):
+                    sample[name][k] = frames.setdefault((key, name), sample[name][k])
+            sample['frame_keys'] = keys
+            batch.append(sample)
+    return lambda: collate_unique_frames(batch)
+
+
+def _model_requirements(device):
+    if torch.device(device).type != 'cuda':
+        return  # pointnet2 falls back to its PyTorch ops
+    if not torch.cuda.is_available():
+        raise Skip('CUDA unavailable')
+    from pointnet2 import pointnet2_utils
+    if not hasattr(pointnet2_utils._ext, 'furthest_point_sampling'):
+        raise Skip('pointnet2 extension not built')
+
+
+def _model(device):
+    _model_requirements(device)
+    from models import create_model
+    args = small_args()
+    try:
+        model = create_model(args)
+    except OSError as e:
+        raise Skip(f'pretrained weights unavailable: {e}')
+    return args, model.to(device)
+
+
+def _batch(args, device):
+    from torch.utils.data import default_collate
+    rng = np.random.default_rng(0)
+    batch = default_collate([fake_sample(args, args.num_points, rng) for _ in range(args.batch_size)])
+    return {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
+
+
+def _point_backbone_bench(device, num_points):
+    from models.point_backbone_module import Pointnet2Backbone
+    _model_requirements(device)
+    backbone = Pointnet2Backbone(input_feature_dim=3).to(device).eval()
+    args = small_args(num_points=num_points)
+    pc = torch.from_numpy(fake_sample(args, num_points)['point_clouds'][:1].repeat(4, 0)).to(device)
+
+    def call():
+        with torch.no_grad():
+            backbone(pc, {})
+    return call
+
+
+@benchmark('e2e/point_backbone_30000', 'model')
+def bench_point_backbone_30000(device):
+    return _point_backbone_bench(device, 30000)
+
+
+@benchmark('e2e/point_backbone_16384', 'model')
+def bench_point_backbone_16384(device):
+    return _point_backbone_bench(device, 16384)
+
+
+@benchmark('e2e/forward', 'model')
+def bench_forward(device):
+    args, model = _model(device)
+    model.eval()
+    batch = _batch(args, device)
+
+    def call():
+        with torch.no_grad():
+            model(batch)
+    return call
+
+
+def _train_step_bench(device, stages=()):
+    from models.activation_checkpoint import enable_activation_checkpointing
+    from models.losses import HungarianMatcher, SetCriterion, compute_hungarian_loss
+    args, model = _model(device)
+    enable_activation_checkpointing(model, stages)
+    model.train()
+    batch = _batch(args, device)
+    matcher = HungarianMatcher(1, 0, 2, True)
+    set_criterion = SetCriterion(matcher, losses=['boxes', 'labels', 'contrastive_align'],
+                                 eos_coef=0.1, temperature=0.07)
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-4)
+
+    def call():
+        end_points = model(batch)
+        for key in batch:
+            if key not in end_points:
+                end_points[key] = batch[key]
+        loss, _ = compute_hungarian_loss(end_points, args.num_decoder_layers, set_criterion,
+                                         query_points_obj_topk=4)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return call
+
+
+@benchmark('e2e/train_step', 'model')
+def bench_train_step(device):
+    return _train_step_bench(device)
+
+
+def _register_checkpoint_benches():
+    """checkpoint/train_step_<stage>: the train step with one stage checkpointed, none or all of them."""
+    from models.activation_checkpoint import STAGES
+    for setting in ('none',) + tuple(STAGES) + ('all',):
+        stages = () if setting == 'none' else (setting,)
+        benchmark(f'checkpoint/train_step_{setting}', 'checkpoint', memory=True, saved=True)(
+            lambda device, stages=stages: _train_step_bench(device, stages))
+
+
+_register_checkpoint_benches()
+
+
+def _point_backbone_train_bench(device, checkpointed):
+    from models.activation_checkpoint import checkpoint_module
+    from models.point_backbone_module import Pointnet2Backbone
+    _model_requirements(device)
+    backbone = Pointnet2Backbone(input_feature_dim=3).to(device).train()
+    if checkpointed:
+        for sa in (backbone.sa1, backbone.sa2, backbone.sa3, backbone.sa4):
+            checkpoint_module(sa)
+    args = small_args(num_points=16384)
+    pc = torch.from_numpy(fake_sample(args, 16384)['point_clouds'][:1].repeat(2, 0)).to(device)
+
+    def call():
+        end_points = backbone(pc, {})
+        end_points['fp2_features'].sum().backward()
+    return call
+
+
+@benchmark('checkpoint/point_backbone_none', 'checkpoint', memory=True, saved=True)
+def bench_point_backbone_train(device):
+    return _point_backbone_train_bench(device, False)
+
+
+@benchmark('checkpoint/point_backbone_sa', 'checkpoint', memory=True, saved=True)
+def bench_point_backbone_train_checkpointed(device):
+    return _point_backbone_train_bench(device, True)
@@ -0,0 +1,531 @@
+"""Microbenchmarks of the preprocessing, metric, loss, attention and inference-time building blocks."""
+import numpy as np
+import torch
+
+from .common import Skip, benchmark
+
+D_MODEL = 288
+BATCH = 4
+NUM_POINTS = 1024       # seeds after the point backbone
+NUM_TOKENS = 32
+NUM_IMAGE_TOKENS = 144  # (384 / 32) ** 2
+NUM_QUERIES = 256
+MAX_LANG_NUM = 100
+FRAME_NUM = 2
+
+
+def text_models():
+    """(spaCy pipeline, RoBERTa tokenizer) as the datasets build them, or Skip."""
+    try:
+        import spacy
+        from transformers import RobertaTokenizerFast
+        from models.wildrefer import from_pretrained
+        nlp = spacy.load('en_core_web_sm')
+        tokenizer = from_pretrained(RobertaTokenizerFast, 'roberta-base')
+    except (ImportError, OSError) as e:
+        raise Skip(f'text models unavailable: {type(e).__name__}')
+    return nlp, tokenizer
+
+
+@benchmark('random_sampling', 'preprocess')
+def bench_random_sampling(device):
+    from utils.strefer_utils import random_sampling
+    pc = np.random.default_rng(0).random((60000, 6), dtype=np.float32)
+    rng = np.random.default_rng(0)
+    return lambda: random_sampling(pc, 30000, rng=rng)
+
+
+def _synthetic_frame():
+    from datasets.synthetic import random_boxes, random_points
+    rng = np.random.default_rng(0)
+    pc = random_points(rng, random_boxes(rng, 12), 60000)
+    pc[:, 3:6] /= 255.
+    return pc
+
+
+@benchmark('preprocess_points/uniform_30000', 'preprocess')
+def bench_preprocess_uniform(device):
+    from utils.strefer_utils import preprocess_points
+    pc, rng = _synthetic_frame(), np.random.default_rng(0)
+    return lambda: preprocess_points(pc, 30000, rng=rng)
+
+
+@benchmark('preprocess_points/roi_16384', 'preprocess')
+def bench_preprocess_roi(device):
+    from utils.strefer_utils import preprocess_points
+    pc, rng = _synthetic_frame(), np.random.default_rng(0)
+    pc_range = [16.36, 0, -1.5, 30.72, 40.96, 5, 0]
+    return lambda: preprocess_points(pc, 16384, pc_range, ground_height=0.2, voxel_size=0.05, rng=rng)
+
+
+@benchmark('extract_pc_in_box3d', 'preprocess')
+def bench_extract_pc_in_box3d(device):
+    from utils.strefer_utils import extract_pc_in_box3d, my_compute_box_3d
+    rng = np.random.default_rng(0)
+    pc = (rng.random((30000, 6)) - 0.5) * [30, 40, 5, 1, 1, 1]
+    box = my_compute_box_3d(np.array([1.0, 2.0, 0.0]), np.array([0.8, 0.6, 1.7]), 0.3)
+    return lambda: extract_pc_in_box3d(pc, box)
+
+
+@benchmark('resize_img_keep_ratio', 'preprocess')
+def bench_resize_img_keep_ratio(device):
+    from utils.box_util import resize_img_keep_ratio
+    img = np.random.default_rng(0).random((1080, 1920, 3))
+    return lambda: resize_img_keep_ratio(img, 384)
+
+
+def _camera_jpeg(size):
+    """A (w, h) JPEG written to a temp file that is removed at exit."""
+    import atexit
+    import os
+    import tempfile
+    import cv2
+    from datasets.synthetic import random_image
+    fd, path = tempfile.mkstemp(suffix='.jpg')
+    os.close(fd)
+    atexit.register(os.remove, path)
+    cv2.imwrite(path, random_image(np.random.default_rng(0), size))
+    return path
+
+
+@benchmark('image/load_image_resize', 'preprocess', memory=True)
+def bench_decode_full(device):
+    from utils.box_util import resize_img_keep_ratio
+    from utils.strefer_utils import load_image
+    path = _camera_jpeg((1920, 1200))
+
+    def call():
+        image, _, _, _ = resize_img_keep_ratio(load_image(path), 384)
+        np.transpose(image, (2, 0, 1)).astype(np.float32)
+    return call
+
+
+@benchmark('image/load_image_letterbox', 'preprocess', memory=True)
+def bench_decode_letterbox(device):
+    from utils.strefer_utils import load_image_letterbox
+    path = _camera_jpeg((1920, 1200))
+    out = np.empty((3, 384, 384), dtype=np.float32)
+    return lambda: load_image_letterbox(path, 384, out=out)
+
+
+@benchmark('get_token_positive_map', 'preprocess')
+def bench_get_token_positive_map(device):
+    from datasets.strefer_dynamic import STReferDynamicDataset
+    nlp, tokenizer = text_models()
+    dataset = STReferDynamicDataset.__new__(STReferDynamicDataset)
+    dataset.nlp, dataset.tokenizer, dataset.max_objects = nlp, tokenizer, 100
+    description = 'the tall man in a red jacket is walking towards the car on the left side of the road'
+    return lambda: dataset._get_token_positive_map(description, MAX_LANG_NUM)
+
+
+@benchmark('cal_accuracy', 'metric')
+def bench_cal_accuracy(device):
+    from utils.pc_utils import cal_accuracy
+    rng = np.random.default_rng(0)
+    gt = np.concatenate([rng.random((500, 3)) * 10, rng.random((500, 3)) + 0.5, rng.random((500, 1))], axis=1)
+    pred = gt + rng.normal(0, 0.2, gt.shape)
+    return lambda: cal_accuracy(pred, gt)
+
+
+def _candidate_boxes(n=256):
+    from datasets.synthetic import calibration, random_boxes
+    ex_matrix, in_matrix = (np.array(m, dtype=np.float64) for m in calibration((1920, 1080)))
+    return random_boxes(np.random.default_rng(0), n).astype(np.float64), ex_matrix, in_matrix
+
+
+@benchmark('box_projection/256', 'metric')
+def bench_box_projection(device):
+    from utils.strefer_utils import batch_compute_box_3d
+    boxes, ex_matrix, in_matrix = _candidate_boxes()
+    return lambda: batch_compute_box_3d(boxes, ex_matrix, in_matrix)
+
+
+@benchmark('box_projection/overlay_256', 'metric')
+def bench_box_overlay(device):
+    from utils.strefer_utils import box_corners, draw_projected_boxes3d, project_corners
+    boxes, ex_matrix, in_matrix = _candidate_boxes()
+    image = np.zeros((1080, 1920, 3), dtype=np.uint8)
+
+    def call():
+        pixel, in_front = project_corners(box_corners(boxes), ex_matrix, in_matrix)
+        draw_projected_boxes3d(image, pixel, in_front)
+    return call
+
+
+def _outputs_and_targets(device, gt_per_sample=1):
+    g = torch.Generator().manual_seed(0)
+    outputs = {
+        'pred_logits': torch.randn(BATCH, NUM_QUERIES, MAX_LANG_NUM, generator=g),
+        'pred_boxes': torch.cat([torch.randn(BATCH, NUM_QUERIES, 3, generator=g),
+                                 torch.rand(BATCH, NUM_QUERIES, 3, generator=g) + 0.1], -1),
+        'proj_tokens': torch.nn.functional.normalize(torch.randn(BATCH, NUM_TOKENS, 64, generator=g), dim=-1),
+        'proj_queries': torch.nn.functional.normalize(torch.randn(BATCH, NUM_QUERIES, 64, generator=g), dim=-1),
+        'tokenized': {'attention_mask': torch.ones(BATCH, NUM_TOKENS, dtype=torch.long)},
+    }
+    targets = []
+    for _ in range(BATCH):
+        positive_map = torch.zeros(gt_per_sample, MAX_LANG_NUM)
+        positive_map[:, 1:3] = 0.5
+        targets.append({
+            'labels': torch.zeros(gt_per_sample, dtype=torch.long),
+            'boxes': torch.cat([torch.randn(gt_per_sample, 3, generator=g),
+                                torch.rand(gt_per_sample, 3, generator=g) + 0.1], -1),
+            'positive_map': positive_map,
+        })
+    to = lambda x: x.to(device) if isinstance(x, torch.Tensor) else x
+    outputs = {k: ({kk: to(vv) for kk, vv in v.items()} if isinstance(v, dict) else to(v)) for k, v in outputs.items()}
+    targets = [{k: to(v) for k, v in t.items()} for t in targets]
+    return outputs, targets
+
+
+@benchmark('hungarian_matcher', 'loss')
+def bench_hungarian_matcher(device):
+    from models.losses import HungarianMatcher
+    matcher = HungarianMatcher(1, 0, 2, True)
+    outputs, targets = _outputs_and_targets(device)
+    return lambda: matcher(outputs, targets)
+
+
+@benchmark('loss_contrastive_align', 'loss')
+def bench_loss_contrastive_align(device):
+    from models.losses import HungarianMatcher, SetCriterion
+    matcher = HungarianMatcher(1, 0, 2, True)
+    criterion = SetCriterion(matcher, losses=['contrastive_align'], eos_coef=0.1, temperature=0.07)
+    outputs, targets = _outputs_and_targets(device)
+    indices = matcher(outputs, targets)
+    num_boxes = torch.tensor([float(BATCH)], device=device)
+    return lambda: criterion.loss_contrastive_align(outputs, targets, indices, num_boxes)
+
+
+def _layer_bench(layer, device, *args, **kwargs):
+    layer = layer.to(device).eval()
+
+    def call():
+        with torch.no_grad():
+            layer(*args, **kwargs)
+    return call
+
+
+def _randn(*shape, device='cpu'):
+    return torch.randn(*shape, generator=torch.Generator().manual_seed(0)).to(device)
+
+
+@benchmark('attention/bi_encoder_layer', 'attention')
+def bench_bi_encoder_layer(device):
+    from models.encoder_decoder_layers import BiEncoderLayer
+    layer = BiEncoderLayer(D_MODEL, dropout=0.1, n_heads=8, dim_feedforward=256,
+                           self_attend_lang=True, self_attend_vis=True, use_img_enc_attn=True)
+    return _layer_bench(
+        layer, device,
+        vis_feats=_randn(BATCH, NUM_POINTS, D_MODEL, device=device),
+        pos_feats=_randn(BATCH, NUM_POINTS, D_MODEL, device=device),
+        padding_mask=torch.zeros(BATCH, NUM_POINTS, dtype=torch.bool, device=device),
+        text_feats=_randn(BATCH, NUM_TOKENS, D_MODEL, device=device),
+        text_padding_mask=torch.zeros(BATCH, NUM_TOKENS, dtype=torch.bool, device=device),
+        end_points={},
+        enhanced_feats=_randn(BATCH, NUM_IMAGE_TOKENS, D_MODEL, device=device),
+        enhanced_mask=torch.zeros(BATCH, NUM_IMAGE_TOKENS, dtype=torch.bool, device=device),
+    )
+
+
+def _bi_decoder_layer_bench(device, int8=False):
+    from torch import nn
+    from models.encoder_decoder_layers import BiDecoderLayer
+    from models.quantization import quantize_dynamic_model
+    layer = BiDecoderLayer(D_MODEL, n_heads=8, dim_feedforward=256, dropout=0.1,
+                           self_position_embedding='loc_learned')
+    if int8:
+        if torch.device(device).type != 'cpu':
+            raise Skip('quantized kernels are CPU-only')
+        holder = nn.Module()
+        holder.layer = layer
+        quantize_dynamic_model(holder, modules=('layer',))
+    return _layer_bench(
+        layer, device,
+        _randn(BATCH, NUM_QUERIES, D_MODEL, device=device),
+        _randn(BATCH, NUM_POINTS, D_MODEL, device=device),
+        _randn(BATCH, NUM_TOKENS, D_MODEL, device=device),
+        _randn(BATCH, NUM_QUERIES, 6, device=device),
+        None,
+        torch.zeros(BATCH, NUM_TOKENS, dtype=torch.bool, device=device),
+    )
+
+
+@benchmark('attention/bi_decoder_layer', 'attention')
+def bench_bi_decoder_layer(device):
+    return _bi_decoder_layer_bench(device)
+
+
+@benchmark('inference/bi_decoder_layer_int8', 'inference')
+def bench_bi_decoder_layer_int8(device):
+    return _bi_decoder_layer_bench(device, int8=True)
+
+
+def _pruned_decoder_bench(device, schedule, num_layers=6):
+    """The decoder layers of WildRefer over NUM_QUERIES queries, cut down by a query pruning schedule."""
+    import torch.nn.functional as F
+    from torch import nn
+    from models.encoder_decoder_layers import BiDecoderLayer
+    from models.query_pruning import keep_top_queries, parse_schedule, text_scores
+    torch.manual_seed(0)
+    layers = nn.ModuleList([BiDecoderLayer(D_MODEL, n_heads=8, dim_feedforward=256, dropout=0.1,
+                                           self_position_embedding='loc_learned')
+                            for _ in range(num_layers)]).to(device).eval()
+    projection = nn.Linear(D_MODEL, 64).to(device).eval()
+    schedule = parse_schedule(schedule, num_layers)
+    query = _randn(BATCH, NUM_QUERIES, D_MODEL, device=device)
+    query_pos = _randn(BATCH, NUM_QUERIES, 6, device=device)
+    vis_feats = _randn(BATCH, NUM_POINTS, D_MODEL, device=device)
+    text_feats = _randn(BATCH, NUM_TOKENS, D_MODEL, device=device)
+    proj_tokens = F.normalize(_randn(BATCH, NUM_TOKENS, 64, device=device), dim=-1)
+    attention_mask = torch.ones(BATCH, NUM_TOKENS, dtype=torch.long, device=device)
+
+    def call():
+        with torch.no_grad():
+            q, pos = query, query_pos
+            for i, layer in enumerate(layers):
+                if i in schedule:
+                    scores = text_scores(F.normalize(projection(q), dim=-1), proj_tokens, attention_mask)
+                    _, (q, pos) = keep_top_queries(scores, schedule[i], q, pos)
+                q = layer(q, vis_feats, text_feats, pos, None, attention_mask.ne(1))
+    return call
+
+
+def _register_query_pruning_benches():
+    """inference/decoder_queries_<schedule>: the six decoder layers without and with query pruning."""
+    for schedule, name in [('none', '256'), ('0:128,3:32', '128-32'), ('0:64,3:16', '64-16'), ('0:64', '64'),
+                           ('3:16', '256-16')]:
+        benchmark(f'inference/decoder_queries_{name}', 'inference')(
+            lambda device, schedule=schedule: _pruned_decoder_bench(device, schedule))
+
+
+_register_query_pruning_benches()
+
+
+def _seed_pruned_encoder_bench(device, seed_keep, num_layers=3):
+    """The cross encoder of WildRefer over the NUM_POINTS seeds, or the seed_keep most relevant of them."""
+    from models.encoder_decoder_layers import BiEncoder, BiEncoderLayer
+    from models.seed_pruning import SeedRelevanceScorer, keep_top_seeds, scatter_seeds
+    torch.manual_seed(0)
+    encoder = BiEncoder(BiEncoderLayer(D_MODEL, dropout=0.1, n_heads=8, dim_feedforward=256,
+                                       use_img_enc_attn=True), num_layers).to(device).eval()
+    scorer = SeedRelevanceScorer(D_MODEL).to(device).eval()
+    points_features = _randn(BATCH, D_MODEL, NUM_POINTS, device=device)
+    pos_feats = _randn(BATCH, NUM_POINTS, D_MODEL, device=device)
+    points_mask = torch.zeros(BATCH, NUM_POINTS, dtype=torch.bool, device=device)
+    text_feats = _randn(BATCH, NUM_TOKENS, D_MODEL, device=device)
+    text_padding_mask = torch.zeros(BATCH, NUM_TOKENS, dtype=torch.bool, device=device)
+    image_feats = _randn(BATCH, NUM_IMAGE_TOKENS, D_MODEL, device=device)
+    img_mask = torch.zeros(BATCH, NUM_IMAGE_TOKENS, dtype=torch.bool, device=device)
+
+    def call():
+        with torch.no_grad():
+            vis, pos, mask = points_features.transpose(1, 2), pos_feats, points_mask
+            if seed_keep:
+                scores = scorer(points_features, text_feats, text_padding_mask)
+                inds, (vis, pos, mask) = keep_top_seeds(scores, seed_keep, vis, pos, mask)
+            vis, _ = encoder(vis, pos, mask, text_feats, text_padding_mask, {},
+                             enhanced_feats=image_feats, enhanced_mask=img_mask)
+            if seed_keep:
+                scatter_seeds(points_features.transpose(1, 2), vis, inds)
+    return call
+
+
+def _register_seed_pruning_benches():
+    """inference/cross_encoder_seeds_<k>: the three cross encoder layers over all the seeds or the k kept ones."""
+    for seed_keep in (0, 512, 256):
+        benchmark(f'inference/cross_encoder_seeds_{seed_keep or NUM_POINTS}', 'inference')(
+            lambda device, seed_keep=seed_keep: _seed_pruned_encoder_bench(device, seed_keep))
+
+
+_register_seed_pruning_benches()
+
+
+@benchmark('attention/multi_ca_layer', 'attention')
+def bench_multi_ca_layer(device):
+    from models.encoder_decoder_layers import MultiCALayer
+    layer = MultiCALayer(D_MODEL, n_heads=8, dim_feedforward=256, dropout=0.1, frame_num=FRAME_NUM)
+    features = _randn(BATCH, FRAME_NUM, NUM_POINTS, D_MODEL, device=device)
+    return _layer_bench(
+        layer, device,
+        query=_randn(BATCH, NUM_POINTS, D_MODEL, device=device),
+        key=features, value=features,
+        query_pos=_randn(BATCH, NUM_POINTS, 3, device=device),
+        key_pos=_randn(BATCH, FRAME_NUM, NUM_POINTS, 3, device=device),
+        multi_mask=torch.ones(BATCH, FRAME_NUM, device=device),
+    )
+
+
+@benchmark('attention/image_multi_ca_layer', 'attention')
+def bench_image_multi_ca_layer(device):
+    from models.encoder_decoder_layers import ImageMultiCALayer
+    layer = ImageMultiCALayer(D_MODEL, n_heads=8, dim_feedforward=256, dropout=0.1, frame_num=FRAME_NUM)
+    features = _randn(BATCH, FRAME_NUM, D_MODEL, NUM_IMAGE_TOKENS, device=device)
+    return _layer_bench(
+        layer, device,
+        query=_randn(BATCH, NUM_IMAGE_TOKENS, D_MODEL, device=device),
+        key=features.transpose(-1, -2), value=features.transpose(-1, -2),
+        query_pos=_randn(BATCH, D_MODEL, NUM_IMAGE_TOKENS, device=device),
+        key_pos=_randn(BATCH, FRAME_NUM, D_MODEL, NUM_IMAGE_TOKENS, device=device),
+        multi_mask=torch.ones(BATCH, FRAME_NUM, device=device),
+        key_mask=torch.zeros(BATCH, FRAME_NUM, NUM_IMAGE_TOKENS, dtype=torch.bool, device=device),
+    )
+
+
+def _inference_bench(module, device, fold, *args):
+    from models.inference import optimize_for_inference
+    module = module.to(device).eval()
+    if fold:
+        optimize_for_inference(module, args)
+    return _layer_bench(module, device, *args)
+
+
+@benchmark('inference/visual_backbone', 'inference')
+def bench_visual_backbone(device):
+    from models.image_backbone_module import VisualBackbone
+    return _inference_bench(VisualBackbone(D_MODEL, pretrained=False), device, False,
+                            _randn(FRAME_NUM, 3, 384, 384, device=device))
+
+
+@benchmark('inference/visual_backbone_folded', 'inference')
+def bench_visual_backbone_folded(device):
+    from models.image_backbone_module import VisualBackbone
+    return _inference_bench(VisualBackbone(D_MODEL, pretrained=False), device, True,
+                            _randn(FRAME_NUM, 3, 384, 384, device=device))
+
+
+CAMERA = (1080, 1920)  # (height, width) of the STRefer images
+CANVASES = {'square': 384, 'square_packed': 384, 'fit': (224, 384)}  # --img_size 384, with packing, fitted to CAMERA
+
+
+def image_tokens(img_size, camera=CAMERA, packed=False):
+    """
+    (canvas, image tokens) of a camera image letterboxed on --img_size as the
+    datasets do it, all the tokens of the feature map or only the valid ones.
+    """
+    import torch.nn.functional as F
+    from utils.strefer_utils import BACKBONE_STRIDE, img_shape, letterbox_mask
+    height, width = img_shape(img_size)
+    ratio = min(height / camera[0], width / camera[1])
+    pad_h, pad_w = height - int(camera[0] * ratio), width - int(camera[1] * ratio)
+    mask = torch.from_numpy(letterbox_mask(img_size, pad_w, pad_h).copy())
+    size = (-(-height // BACKBONE_STRIDE), -(-width // BACKBONE_STRIDE))
+    tokens = F.interpolate(mask[None, None].float(), size=size)[0, 0].bool()
+    return (height, width), int(tokens.sum()) if packed else tokens.numel()
+
+
+def image_cost(img_size, camera=CAMERA, d_model=D_MODEL):
+    """Backbone GFLOPs of one image and the image tokens of the attention layers, before and after packing."""
+    from torch.utils.flop_counter import FlopCounterMode
+    from models.image_backbone_module import VisualBackbone
+    (height, width), tokens = image_tokens(img_size, camera)
+    backbone = VisualBackbone(d_model, pretrained=False).eval()
+    counter = FlopCounterMode(display=False)
+    with torch.no_grad(), counter:
+        backbone(torch.zeros(1, 3, height, width))
+    return {'canvas': f'{height}x{width}', 'backbone_gflops': counter.get_total_flops() / 1e9,
+            'tokens': tokens, 'packed_tokens': image_tokens(img_size, camera, packed=True)[1]}
+
+
+def _position_embedding_bench(device, cached):
+    """
+    Token mask and sine embedding of the image tokens of BATCH samples of FRAME_NUM
+    letterboxed frames. Cached, the lookup by layout name never syncs with the device.
+    """
+    from models.image_backbone_module import VisualBackbone
+    from utils.strefer_utils import letterbox_key, letterbox_mask
+    backbone = VisualBackbone(D_MODEL, pretrained=False).to(device)
+    x = _randn(BATCH * FRAME_NUM, D_MODEL, 12, 12, device=device)
+    mask = torch.from_numpy(letterbox_mask((384, 384), 0, 168).copy()).to(device).repeat(BATCH * FRAME_NUM, 1, 1)
+    layout = [letterbox_key((384, 384), 0, 168)] * (BATCH * FRAME_NUM)
+    if cached:
+        return lambda: backbone.cached_mask_and_pos(x, mask, layout)
+    return lambda: backbone.mask_and_pos(x, mask)
+
+
+@benchmark('inference/image_position_embedding', 'inference')
+def bench_image_position_embedding(device):
+    return _position_embedding_bench(device, False)
+
+
+@benchmark('inference/image_position_embedding_cached', 'inference')
+def bench_image_position_embedding_cached(device):
+    return _position_embedding_bench(device, True)
+
+
+@benchmark('inference/visual_backbone_224x384', 'inference')
+def bench_visual_backbone_fit(device):
+    """The backbone on the canvas fitted to the 16:9 camera, against the 384x384 inference/visual_backbone."""
+    from models.image_backbone_module import VisualBackbone
+    return _inference_bench(VisualBackbone(D_MODEL, pretrained=False), device, False,
+                            _randn(FRAME_NUM, 3, 224, 384, device=device))
+
+
+def _image_fuser_bench(device, num_tokens):
+    """The image multi-fuser and the seeds-to-image attention of the three cross encoder layers over num_tokens."""
+    from torch import nn
+    from models.encoder_decoder_layers import ImageMultiCALayer
+    torch.manual_seed(0)
+    fuser = ImageMultiCALayer(D_MODEL, n_heads=8, dim_feedforward=256, dropout=0.1, frame_num=FRAME_NUM)
+    cross_d = nn.ModuleList([nn.MultiheadAttention(D_MODEL, 8, dropout=0.1) for _ in range(3)])
+    fuser, cross_d = fuser.to(device).eval(), cross_d.to(device).eval()
+    features = _randn(BATCH, FRAME_NUM, D_MODEL, num_tokens, device=device)
+    key_mask = torch.zeros(BATCH, FRAME_NUM, num_tokens, dtype=torch.bool, device=device)
+    multi_mask = torch.ones(BATCH, FRAME_NUM, device=device)
+    vis_feats = _randn(NUM_POINTS, BATCH, D_MODEL, device=device)
+
+    def call():
+        with torch.no_grad():
+            image = fuser(features[:, 0].transpose(1, 2), features.transpose(-1, -2), features.transpose(-1, -2),
+                          features[:, 0], features, multi_mask, key_mask)
+            image = image.permute(2, 0, 1)  # (N, B, F)
+            for attn in cross_d:
+                attn(vis_feats, image, image, key_padding_mask=key_mask[:, 0])
+    return call
+
+
+def _register_image_token_benches():
+    """attention/image_tokens_<canvas>: the attention over the image tokens of each canvas, packed or not."""
+    for name, img_size in CANVASES.items():
+        num_tokens = image_tokens(img_size, packed=name.endswith('_packed'))[1]
+        benchmark(f'attention/image_tokens_{name}', 'attention')(
+            lambda device, num_tokens=num_tokens: _image_fuser_bench(device, num_tokens))
+
+
+_register_image_token_benches()
+
+
+def _predict_head():
+    from models.modules import ClsAgnosticPredictHead
+
+    class Head(ClsAgnosticPredictHead):
+        def forward(self, features, base_xyz):
+            return super().forward(features, base_xyz, {})
+    return Head(MAX_LANG_NUM, 1, NUM_QUERIES, D_MODEL, objectness=True, heading=False, compute_sem_scores=True)
+
+
+@benchmark('inference/predict_head', 'inference')
+def bench_predict_head(device):
+    return _inference_bench(_predict_head(), device, False, _randn(BATCH, D_MODEL, NUM_QUERIES, device=device),
+                            _randn(BATCH, NUM_QUERIES, 3, device=device))
+
+
+@benchmark('inference/predict_head_folded', 'inference')
+def bench_predict_head_folded(device):
+    return _inference_bench(_predict_head(), device, True, _randn(BATCH, D_MODEL, NUM_QUERIES, device=device),
+                            _randn(BATCH, NUM_QUERIES, 3, device=device))
+
+
+def _shared_mlp():
+    from pointnet2.pytorch_utils import SharedMLP
+    return SharedMLP([3 + 3, 64, 64, 128], bn=True)
+
+
+@benchmark('inference/shared_mlp', 'inference')
+def bench_shared_mlp(device):
+    return _inference_bench(_shared_mlp(), device, False, _randn(BATCH, 6, NUM_POINTS, 32, device=device))
+
+
+@benchmark('inference/shared_mlp_folded', 'inference')
+def bench_shared_mlp_folded(device):
+    return _inference_bench(_shared_mlp(), device, True, _randn(BATCH, 6, NUM_POINTS, 32, device=device))
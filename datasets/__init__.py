@@ -1,8 +1,9 @@
 from .strefer_plus_dynamic import STReferPlusDynamicDataset
 from .strefer_dynamic import STReferDynamicDataset
+from .fields import ALL_FIELDS, required_fields
 
-def create_dataset(args, split):
+def create_dataset(args, split, fields=ALL_FIELDS):
     if args.dataset == 'wildrefer':
-        return STReferPlusDynamicDataset(args, split)
+        return STReferPlusDynamicDataset(args, split, fields)
     elif args.dataset == 'strefer':
-        return STReferDynamicDataset(args, split)
\ No newline at end of file
+        return STReferDynamicDataset(args, split, fields)
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+from torch.utils.data import Dataset
+
+from utils.dist import barrier, is_main_process
+from utils.profiler import profiler, PROFILE_KEY
+
+# args that change what __getitem__ returns; a cache built with other values is stale
+PREPROCESS_ARGS = ('dataset', 'src_path', 'data_root', 'img_size', 'fit_camera', 'frame_num', 'max_obj_num',
+                   'max_lang_num', 'seed', 'num_points', 'crop', 'ground_height', 'voxel_size', 'dedup_frames',
+                   'own_previous_points')
+
+
+def fingerprint(args, split, length, fields=()):
+    config = {k: getattr(args, k, None) for k in PREPROCESS_ARGS}
+    config.update(split=split, length=length, fields=sorted(fields))
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def shared_cache(dataset, cache_dir, fingerprint):
+    """The CachedDataset of every process of the group: rank 0 builds it, the others open it after a barrier."""
+    if is_main_process():
+        cached = CachedDataset(dataset, cache_dir, fingerprint)
+    barrier()
+    if not is_main_process():
+        cached = CachedDataset(dataset, cache_dir, fingerprint, allocate=False)
+    return cached
+
+
+class CachedDataset(Dataset):
+    """
+    Memory-mapped store of the preprocessed samples of a deterministic dataset.
+
+    The first pass over an index runs the wrapped dataset and writes the sample
+    into per-key .npy memmaps (DataLoader workers write their own rows, the
+    files are shared); later passes read it back without touching the point
+    clouds or images. Non-array values (the text) go to a small json per
+    sample. Only valid when the wrapped dataset returns the same sample for an
+    index every time, e.g. the eval split whose sampling is seeded by the index
+    alone. Put `cache_dir` on /dev/shm to keep it in RAM.
+
+    The files go to `cache_dir`/<fingerprint>/, the only directories the cache
+    creates and removes: a stale cache is a sibling holding a meta.json, the
+    other contents of `cache_dir` are never touched.
+
+    Several processes share a cache by letting one of them build it
+    (allocate=True) before the others open it (allocate=False), which fails
+    rather than racing to build it again.
+    """
+
+    def __init__(self, dataset, cache_dir, fingerprint, allocate=True):
+        self.dataset = dataset
+        self.root = cache_dir
+        self.cache_dir = os.path.join(cache_dir, fingerprint)
+        self.fingerprint = fingerprint
+        self.arrays = None
+        self.filled = None
+        if not self._valid():
+            if not allocate:
+                raise RuntimeError(f'no cache for this data under {cache_dir}, it is built by another process first')
+            self._allocate()
+
+    def _meta_path(self):
+        return os.path.join(self.cache_dir, 'meta.json')
+
+    def _valid(self):
+        if not os.path.exists(self._meta_path()):
+            return False
+        with open(self._meta_path()) as f:
+            meta = json.load(f)
+        return meta['fingerprint'] == self.fingerprint
+
+    def _remove_stale(self):
+        """Remove the caches of other fingerprints and a partial one of this fingerprint."""
+        if not os.path.isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if path == self.cache_dir or os.path.isfile(os.path.join(path, 'meta.json')):
+                shutil.rmtree(path)
+
+    def _allocate(self):
+        """Create empty memmaps shaped after sample 0, which is written right away."""
+        self._remove_stale()
+        os.makedirs(os.path.join(self.cache_dir, 'objects'))
+        sample = self.dataset[0]
+        sample.pop(PROFILE_KEY, None)
+        n = len(self.dataset)
+        arrays = {}
+        for key, value in sample.items():
+            if isinstance(value, np.ndarray):
+                arrays[key] = {'dtype': value.dtype.str, 'shape': list(value.shape)}
+                np.lib.format.open_memmap(os.path.join(self.cache_dir, f'{key}.npy'), 'w+',
+                                          value.dtype, (n,) + value.shape)
+        np.lib.format.open_memmap(os.path.join(self.cache_dir, 'filled.npy'), 'w+', np.uint8, (n,))
+        with open(self._meta_path(), 'w') as f:
+            json.dump({'fingerprint': self.fingerprint, 'length': n, 'arrays': arrays}, f)
+        self._write(0, sample)
+
+    def _open(self):
+        with open(self._meta_path()) as f:
+            meta = json.load(f)
+        self.arrays = {key: np.load(os.path.join(self.cache_dir, f'{key}.npy'), mmap_mode='r+')
+                       for key in meta['arrays']}
+        self.filled = np.load(os.path.join(self.cache_dir, 'filled.npy'), mmap_mode='r+')
+
+    def _write(self, index, sample):
+        if self.arrays is None:
+            self._open()
+        objects = {}
+        for key, value in sample.items():
+            if key in self.arrays:
+                if value.shape != self.arrays[key].shape[1:]:
+                    raise ValueError(f"cannot cache {key}: sample {index} has shape {value.shape}, "
+                                     f"expected {self.arrays[key].shape[1:]}")
+                self.arrays[key][index] = value
+            else:
+                objects[key] = value
+        with open(os.path.join(self.cache_dir, 'objects', f'{index}.json'), 'w') as f:
+            json.dump(objects, f)
+        # the flag goes last so a half-written row is never read back (the
+        # memmaps are shared through the page cache, no flush needed)
+        self.filled[index] = 1
+
+    def _read(self, index):
+        with open(os.path.join(self.cache_dir, 'objects', f'{index}.json')) as f:
+            data_dict = json.load(f)
+        for key, array in self.arrays.items():
+            data_dict[key] = np.array(array[index])
+        return data_dict
+
+    def is_complete(self):
+        if self.filled is None:
+            self._open()
+        return bool(self.filled.all())
+
+    def set_epoch(self, epoch):
+        """Cached samples do not depend on the epoch."""
+
+    def __getitem__(self, index):
+        if self.arrays is None:
+            self._open()
+        if not self.filled[index]:
+            data_dict = self.dataset[index]
+            profile = data_dict.pop(PROFILE_KEY, None)
+            self._write(index, data_dict)
+            if profile is not None:
+                data_dict[PROFILE_KEY] = profile
+            return data_dict
+        if not profiler.enabled:
+            return self._read(index)
+        with profiler.capture() as records:
+            with profiler.stage('data/cache_read'):
+                data_dict = self._read(index)
+        data_dict[PROFILE_KEY] = json.dumps(records)
+        return data_dict
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getstate__(self):
+        # workers reopen the memmaps instead of receiving pickled copies
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        state['filled'] = None
+        return state
@@ -0,0 +1,81 @@
+''' Testing the memory-mapped eval cache. '''
+
+import os
+import sys
+import tempfile
+
+import numpy as np
+from torch.utils.data import DataLoader, Dataset
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from datasets.cache import CachedDataset
+
+
+class DeterministicDataset(Dataset):
+    def __init__(self, n=10):
+        self.n = n
+        self.calls = 0
+
+    def __getitem__(self, index):
+        self.calls += 1
+        rng = np.random.default_rng(index)
+        return {'point_clouds': rng.random((2, 50, 6), dtype=np.float32),
+                'img_mask': rng.random((2, 8, 8)) > 0.5,
+                'text': f'sample {index} not mentioned'}
+
+    def __len__(self):
+        return self.n
+
+
+def test_cache():
+    dataset = DeterministicDataset()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # another process only opens a cache that was built
+        try:
+            CachedDataset(dataset, cache_dir, 'a', allocate=False)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('opened a cache nobody built')
+        cached = CachedDataset(dataset, cache_dir, 'a')
+        assert not cached.is_complete()
+        first = [b for b in DataLoader(cached, 4, num_workers=2)]
+        assert cached.is_complete()
+
+        # a second instance reuses the files and never calls the dataset
+        dataset.calls = 0
+        cached = CachedDataset(dataset, cache_dir, 'a')
+        second = [b for b in DataLoader(cached, 4, num_workers=0)]
+        assert dataset.calls == 0
+        for a, b in zip(first, second):
+            assert a['text'] == b['text']
+            assert (a['point_clouds'] == b['point_clouds']).all()
+            assert (a['img_mask'] == b['img_mask']).all() and b['img_mask'].dtype == a['img_mask'].dtype
+
+        assert CachedDataset(dataset, cache_dir, 'a', allocate=False).is_complete()
+
+        # another fingerprint rebuilds
+        cached = CachedDataset(dataset, cache_dir, 'b')
+        assert not cached.is_complete()
+        assert os.listdir(cache_dir) == ['b']
+
+
+def test_cache_keeps_other_files():
+    """A cache_dir that holds other things (/dev/shm itself, a typo) only loses the caches."""
+    dataset = DeterministicDataset(n=3)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        with open(os.path.join(cache_dir, 'notes.txt'), 'w') as f:
+            f.write('keep me')
+        os.makedirs(os.path.join(cache_dir, 'other', 'objects'))
+        for fingerprint in ('a', 'b'):
+            cached = CachedDataset(dataset, cache_dir, fingerprint)
+            assert cached[2]['text'] == 'sample 2 not mentioned'
+        assert sorted(os.listdir(cache_dir)) == ['b', 'notes.txt', 'other']
+        with open(os.path.join(cache_dir, 'notes.txt')) as f:
+            assert f.read() == 'keep me'
+
+
+if __name__ == '__main__':
+    test_cache()
+    test_cache_keeps_other_files()
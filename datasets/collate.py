@@ -0,0 +1,42 @@
+import numpy as np
+import torch
+from torch.utils.data import default_collate
+
+# per-frame inputs of a sample and the key of their unique-frame table in the batch
+FRAME_INPUTS = {'point_clouds': 'unique_point_clouds', 'image': 'unique_image', 'img_mask': 'unique_img_mask'}
+# per-frame strings of a sample, listed per unique frame
+FRAME_NAMES = {'img_layout': 'unique_img_layout'}
+
+
+def collate_unique_frames(batch):
+    """
+    default_collate, except that the frames are stored once per batch.
+
+    A frame is often both the current frame of one sample and the previous
+    frame of another, and several descriptions share a frame. Samples built
+    with dedup_frames carry a key per frame ('frame_keys'); the per-frame
+    inputs of all samples are replaced by a table of the U distinct frames
+    (unique_point_clouds (U, N, C), unique_image (U, 3, H, W), unique_img_mask
+    (U, H, W), unique_img_layout [U]) and frame_index (B, K) pointing into
+    it, so the backbones run U times instead of B * K. unique_*[frame_index]
+    is the dense batch.
+    """
+    frame_keys = [sample['frame_keys'] for sample in batch]
+    table = dict()
+    frame_index = np.empty((len(batch), len(frame_keys[0])), dtype=np.int64)
+    for b, keys in enumerate(frame_keys):
+        for k, key in enumerate(keys):
+            if key not in table:
+                table[key] = (len(table), b, k)
+            frame_index[b, k] = table[key][0]
+
+    data_dict = default_collate([{key: value for key, value in sample.items()
+                                  if key not in FRAME_INPUTS and key not in FRAME_NAMES and key != 'frame_keys'}
+                                 for sample in batch])
+    for key, unique_key in FRAME_INPUTS.items():
+        data_dict[unique_key] = torch.from_numpy(np.stack([batch[b][key][k] for _, b, k in table.values()]))
+    for key, unique_key in FRAME_NAMES.items():
+        if key in batch[0]:
+            data_dict[unique_key] = [batch[b][key][k] for _, b, k in table.values()]
+    data_dict['frame_index'] = torch.from_numpy(frame_index)
+    return data_dict
@@ -0,0 +1,100 @@
+''' Testing the unique-frame collate, the scene-aware sampler and the gather back to the dense batch. '''
+
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+import torch
+from torch.utils.data import default_collate
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from datasets.collate import FRAME_INPUTS, FRAME_NAMES, collate_unique_frames
+from datasets.samplers import ResumableSampler, SceneAwareSampler
+from datasets.synthetic import ANNOTATION_FILES, generate
+from models.wildrefer import gather_frames
+
+FRAME_NUM = 2
+
+
+def fake_sample(keys, num_points=16, img_size=8):
+    frames = [np.random.default_rng(abs(hash(key)) % 2 ** 32) for key in keys]
+    return {
+        'point_clouds': np.stack([rng.random((num_points, 6), dtype=np.float32) for rng in frames]),
+        'image': np.stack([rng.random((3, img_size, img_size), dtype=np.float32) for rng in frames]),
+        'img_mask': np.stack([rng.random((img_size, img_size)) > 0.5 for rng in frames]),
+        'img_layout': [key.split('/')[0] for key in keys],
+        'text': ' '.join(keys),
+        'frame_keys': keys,
+    }
+
+
+def test_collate_unique_frames():
+    batch = [fake_sample(['s/2', 's/1']), fake_sample(['s/2', 's/1']), fake_sample(['s/3', 's/2']),
+             fake_sample(['t/1', ''])]
+    out = collate_unique_frames(batch)
+    dense = default_collate([{k: v for k, v in s.items() if k != 'frame_keys'} for s in batch])
+    assert len(out['unique_point_clouds']) == 5
+    assert out['frame_index'].shape == (4, FRAME_NUM)
+    assert out['text'] == dense['text']
+    for key, unique_key in FRAME_INPUTS.items():
+        assert key not in out
+        assert torch.equal(out[unique_key][out['frame_index']], dense[key])
+    for key, unique_key in FRAME_NAMES.items():
+        assert key not in out
+        assert [[out[unique_key][i] for i in row] for row in out['frame_index'].tolist()] == \
+            [sample[key] for sample in batch]
+
+    # the backbone outputs of the unique frames expand to the dense (B*K) order
+    features = out['unique_point_clouds'].sum(-1)
+    gathered = gather_frames({'features': features, 'scalar': torch.tensor(1.)}, out['frame_index'].view(-1),
+                             len(features))
+    assert torch.equal(gathered['features'], dense['point_clouds'].flatten(0, 1).sum(-1))
+
+
+def unique_frames_per_batch(sampler, dataset, find_previous, batch_size):
+    indices = sampler.indices()
+    counts = []
+    for start in range(0, len(indices), batch_size):
+        frames = set()
+        for i in indices[start:start + batch_size]:
+            scene_id, name = dataset[i]['scene_id'], dataset[i]['point_cloud']['point_cloud_name']
+            for _ in range(FRAME_NUM):
+                frames.add((scene_id, name))
+                name = find_previous[scene_id][name] if name else None
+        counts.append(len(frames) / (len(indices[start:start + batch_size]) * FRAME_NUM))
+    return np.mean(counts)
+
+
+class Annotations:
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def test_scene_aware_sampler():
+    with tempfile.TemporaryDirectory() as out:
+        _, data_root = generate(out, 'wildrefer', num_scenes=6, frames_per_scene=20, points_per_frame=100,
+                                image_size=(32, 32), boxes_per_frame=4, descriptions_per_frame=2)
+        files = ANNOTATION_FILES['wildrefer']
+        dataset = json.load(open(os.path.join(data_root, files['train'])))
+        find_previous = json.load(open(os.path.join(data_root, files['find_previous'])))
+    source = Annotations(dataset)
+    sampler = SceneAwareSampler(source, group_size=4, seed=0)
+    for epoch in range(2):
+        sampler.set_epoch(epoch)
+        assert sorted(sampler.indices()) == list(range(len(dataset)))
+    assert sampler.indices() != SceneAwareSampler(source, group_size=4, seed=5).indices()
+
+    uniform = unique_frames_per_batch(ResumableSampler(source, seed=0), dataset, find_previous, 8)
+    grouped = unique_frames_per_batch(sampler, dataset, find_previous, 8)
+    assert grouped < 0.6 * uniform, (grouped, uniform)
+
+
+if __name__ == '__main__':
+    test_collate_unique_frames()
+    test_scene_aware_sampler()
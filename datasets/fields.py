@@ -0,0 +1,25 @@
+# inputs of WildRefer.forward, img_layout names the letterbox of every frame (strings, they stay on the host)
+MODEL_FIELDS = ('point_clouds', 'text', 'dynamic_mask', 'image', 'img_mask', 'img_layout')
+# detected boxes, only read with --butd
+BUTD_FIELDS = ('det_boxes', 'det_bbox_label_mask')
+# targets of compute_hungarian_loss
+TARGET_FIELDS = ('center_label', 'size_gts', 'box_label_mask', 'point_instance_label', 'sem_cls_label',
+                 'tokens_positive', 'positive_map')
+ALL_FIELDS = MODEL_FIELDS + BUTD_FIELDS + TARGET_FIELDS
+
+MODES = ('train', 'eval', 'infer')
+
+
+def required_fields(args, mode):
+    """
+    The data_dict keys consumed with this model config in `mode`: 'train' and
+    'eval' compute the loss, 'infer' only needs the predictions (test.py scores
+    them with dataset.evaluate, from the annotations).
+    """
+    assert mode in MODES, mode
+    fields = MODEL_FIELDS
+    if args.butd:
+        fields += BUTD_FIELDS
+    if mode != 'infer':
+        fields += TARGET_FIELDS
+    return fields
@@ -0,0 +1,88 @@
+''' Testing that the datasets return exactly the required fields, and the same values for them. '''
+
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from datasets import create_dataset
+from datasets.fields import BUTD_FIELDS, MODEL_FIELDS, TARGET_FIELDS, required_fields
+from datasets.synthetic import SCALES, generate
+
+
+def make_args(dataset, src_path, data_root, butd):
+    return argparse.Namespace(dataset=dataset, src_path=src_path, data_root=data_root, max_obj_num=100,
+                              max_lang_num=100, frame_num=2, seed=0, img_size=96, fit_camera=False, num_points=2048,
+                              crop=False, ground_height=0., voxel_size=0., dedup_frames=False,
+                              own_previous_points=False, butd=butd)
+
+
+def test_required_fields():
+    args = argparse.Namespace(butd=False)
+    assert required_fields(args, 'infer') == MODEL_FIELDS
+    assert required_fields(args, 'train') == MODEL_FIELDS + TARGET_FIELDS
+    args.butd = True
+    assert required_fields(args, 'eval') == MODEL_FIELDS + BUTD_FIELDS + TARGET_FIELDS
+
+
+def check_projection(dataset):
+    # infer mode loads neither spaCy nor the tokenizer, so this runs without the text models
+    num_scenes, frames, _, _, boxes, descriptions = SCALES['small']
+    with tempfile.TemporaryDirectory() as out:
+        src_path, data_root = generate(out, dataset, num_scenes, frames, 4096, (160, 90), boxes, descriptions)
+        samples = []
+        for butd in (False, True):
+            args = make_args(dataset, src_path, data_root, butd)
+            fields = required_fields(args, 'infer')
+            sample = create_dataset(args, 'train', fields)[0]
+            assert set(sample) == set(fields)
+            samples.append(sample)
+        assert samples[0]['text'] == samples[1]['text']
+        for key in set(MODEL_FIELDS) - {'text'}:
+            assert np.array_equal(samples[0][key], samples[1][key])
+        assert samples[1]['det_bbox_label_mask'].sum() == boxes
+
+
+def test_strefer_projection():
+    check_projection('strefer')
+
+
+def test_wildrefer_projection():
+    check_projection('wildrefer')
+
+
+def check_previous_points(dataset):
+    """Previous frames are the current frame's points, shuffled, unless they get their own."""
+    num_scenes, frames, _, _, boxes, descriptions = SCALES['small']
+    with tempfile.TemporaryDirectory() as out:
+        src_path, data_root = generate(out, dataset, num_scenes, frames, 4096, (160, 90), boxes, descriptions)
+        args = make_args(dataset, src_path, data_root, False)
+        fields = ('point_clouds', 'dynamic_mask')
+        data = create_dataset(args, 'train', fields)
+        index = next(i for i in range(len(data)) if data[i]['dynamic_mask'][1])
+        current, previous = data[index]['point_clouds']
+        assert np.array_equal(np.unique(current, axis=0), np.unique(previous, axis=0))
+        args.own_previous_points = True
+        own = create_dataset(args, 'train', fields)[index]['point_clouds']
+        assert np.array_equal(own[0], current)
+        assert not np.array_equal(np.unique(own[1], axis=0), np.unique(current, axis=0))
+
+
+def test_strefer_previous_points():
+    check_previous_points('strefer')
+
+
+def test_wildrefer_previous_points():
+    check_previous_points('wildrefer')
+
+
+if __name__ == '__main__':
+    test_required_fields()
+    test_strefer_projection()
+    test_wildrefer_projection()
+    test_strefer_previous_points()
+    test_wildrefer_previous_points()
@@ -0,0 +1,169 @@
+"""
+Per-sample evaluation results, streamed to disk as columnar row groups.
+
+dataset.evaluate(predict_boxes, output_path) writes one record per sample:
+the index, scene, frame and image names, description, ground-truth and
+predicted boxes, their projected image corners and which of those are in
+front of the camera, and the 3D IoU. Records are buffered into row groups
+of `row_group_size` samples; a background thread writes every full row
+group as `output_path/part-<n>.npz`, one array per column, renamed into
+place once complete. Memory stays at one row group, and a job that dies
+keeps every row group written before.
+
+read_results loads only the columns asked for. Filtering by scene or IoU
+reads the scene_id / iou columns of each row group first and then the other
+columns for the matching rows only.
+"""
+import glob
+import os
+import os.path as osp
+import queue
+import threading
+
+import numpy as np
+
+from utils import pc_utils, strefer_utils
+
+COLUMNS = ('index', 'scene_id', 'point_cloud_name', 'image_name', 'language', 'gt_box', 'pred_box',
+           'gt_corner2d', 'pred_corner2d', 'gt_in_front', 'pred_in_front', 'iou')
+
+
+class ResultsWriter:
+    """
+    Appends per-sample records to a directory of row groups.
+
+    append() takes a dict of equal-length column arrays; close() writes the
+    last, partial row group and waits for the writer thread. An error of the
+    thread is raised by the next append() or by close().
+    """
+
+    def __init__(self, path, row_group_size=4096, max_pending=2):
+        os.makedirs(path, exist_ok=True)
+        for old in glob.glob(osp.join(path, 'part-*.npz')):
+            os.remove(old)
+        self.path = path
+        self.row_group_size = row_group_size
+        self._buffer = []
+        self._buffered = 0
+        self._parts = 0
+        self._errors = []
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='results-writer', daemon=True)
+        self._thread.start()
+
+    def append(self, columns):
+        self._raise_errors()
+        self._buffer.append(columns)
+        self._buffered += len(next(iter(columns.values())))
+        if self._buffered >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffered:
+            return
+        group = {key: np.concatenate([columns[key] for columns in self._buffer]) for key in self._buffer[0]}
+        self._queue.put((osp.join(self.path, f'part-{self._parts:05d}.npz'), group))
+        self._parts += 1
+        self._buffer = []
+        self._buffered = 0
+
+    def close(self):
+        self._flush()
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _raise_errors(self):
+        if self._errors:
+            raise RuntimeError('results writer failed') from self._errors.pop(0)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            path, group = item
+            try:
+                with open(path + '.tmp', 'wb') as f:
+                    np.savez(f, **group)
+                os.replace(path + '.tmp', path)
+            except Exception as e:
+                self._errors.append(e)
+
+
+def read_results(path, columns=COLUMNS, scene_ids=None, min_iou=None, max_iou=None):
+    """
+    Load `columns` of the results under `path`, in sample order, keeping
+    the samples of `scene_ids` whose IoU lies in [min_iou, max_iou).
+    Returns a dict of column arrays.
+    """
+    scene_ids = None if scene_ids is None else np.array([str(s) for s in scene_ids])
+    parts = {key: [] for key in columns}
+    for part in sorted(glob.glob(osp.join(path, 'part-*.npz'))):
+        with np.load(part) as group:
+            keep = np.ones(len(group['index']), dtype=bool)
+            if scene_ids is not None:
+                keep &= np.isin(group['scene_id'], scene_ids)
+            if min_iou is not None:
+                keep &= group['iou'] >= min_iou
+            if max_iou is not None:
+                keep &= group['iou'] < max_iou
+            if not keep.any():
+                continue
+            for key in columns:
+                parts[key].append(group[key][keep])
+    return {key: np.concatenate(values) if values else np.zeros(0) for key, values in parts.items()}
+
+
+def sample_records(entries, indices, predict_boxes, ious):
+    """The columns of the samples `indices` of a STRefer-style annotation list, projections computed at once."""
+    data = [entries[i] for i in indices]
+    gt_boxes = np.array([d['point_cloud']['bbox'] for d in data], dtype=np.float64)
+    pred_boxes = np.asarray(predict_boxes, dtype=np.float64)
+    ex_matrices = np.array([d['calibration']['ex_matrix'] for d in data], dtype=np.float64)
+    in_matrices = np.array([d['calibration']['in_matrix'] for d in data], dtype=np.float64)
+    gt_pixel, gt_in_front = strefer_utils.project_corners(strefer_utils.box_corners(gt_boxes[:, :7]),
+                                                          ex_matrices, in_matrices)
+    pred_pixel, pred_in_front = strefer_utils.project_corners(strefer_utils.box_corners(pred_boxes[:, :7]),
+                                                              ex_matrices, in_matrices)
+    return {
+        'index': np.asarray(indices, dtype=np.int64),
+        'scene_id': np.array([str(d['scene_id']) for d in data]),
+        'point_cloud_name': np.array([d['point_cloud']['point_cloud_name'] for d in data]),
+        'image_name': np.array([d['image']['image_name'] for d in data]),
+        'language': np.array([d['language']['description'] for d in data]),
+        'gt_box': gt_boxes,
+        'pred_box': pred_boxes,
+        'gt_corner2d': np.around(gt_pixel).astype(int),
+        'pred_corner2d': np.around(pred_pixel).astype(int),
+        'gt_in_front': gt_in_front,
+        'pred_in_front': pred_in_front,
+        'iou': np.asarray(ious, dtype=np.float64),
+    }
+
+
+def evaluate_boxes(entries, predict_boxes, output_path='', chunk_size=512, row_group_size=4096):
+    """
+    Acc@0.25, Acc@0.5 and mIoU of `predict_boxes` against the boxes of the
+    annotation list `entries`; with `output_path`, the per-sample records
+    are streamed there every `chunk_size` samples.
+    """
+    writer = ResultsWriter(output_path, row_group_size) if output_path else None
+    ious = []
+    try:
+        for start in range(0, len(predict_boxes), chunk_size):
+            indices = range(start, min(start + chunk_size, len(predict_boxes)))
+            chunk = [pc_utils.cal_iou3d(predict_boxes[i][:7], entries[i]['point_cloud']['bbox']) for i in indices]
+            if writer is not None:
+                writer.append(sample_records(entries, indices, predict_boxes[indices.start:indices.stop], chunk))
+            ious += chunk
+    finally:
+        if writer is not None:
+            writer.close()
+    return pc_utils.accuracy_from_ious(ious)
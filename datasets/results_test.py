@@ -0,0 +1,68 @@
+''' Testing the streamed evaluation results: same metrics, same records, filtered reads. '''
+
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from datasets.results import evaluate_boxes, read_results
+from datasets.synthetic import calibration
+from utils import pc_utils, strefer_utils
+
+
+def fake_entries(n, rng):
+    ex_matrix, in_matrix = calibration((1920, 1080))
+    entries = []
+    for i in range(n):
+        box = np.concatenate([rng.random(3) * [10, 4, 1] + [8, -2, 0], rng.random(3) + 0.5, rng.random(1) * 3])
+        entries.append({
+            'scene_id': f'scene_{i % 3}',
+            'point_cloud': {'point_cloud_name': f'{i:06d}', 'bbox': box.tolist()},
+            'image': {'image_name': f'{i:06d}.jpg'},
+            'language': {'description': f'object number {i}'},
+            'calibration': {'ex_matrix': ex_matrix, 'in_matrix': in_matrix},
+        })
+    return entries
+
+
+def test_batch_projection_matches_per_box():
+    rng = np.random.default_rng(0)
+    entries = fake_entries(20, rng)
+    boxes = np.array([e['point_cloud']['bbox'] for e in entries])
+    ex_matrix, in_matrix = entries[0]['calibration']['ex_matrix'], entries[0]['calibration']['in_matrix']
+    expected = strefer_utils.batch_compute_box_3d(boxes, np.array(ex_matrix), np.array(in_matrix))
+    corners = strefer_utils.batch_loc_pc2img(boxes, np.array([ex_matrix] * 20), np.array([in_matrix] * 20))
+    assert np.array_equal(corners, expected)
+
+
+def test_streamed_results():
+    rng = np.random.default_rng(1)
+    entries = fake_entries(45, rng)
+    gt = np.array([e['point_cloud']['bbox'] for e in entries])
+    predict_boxes = gt + np.concatenate([rng.normal(0, 0.3, (45, 3)), np.zeros((45, 4))], 1)
+    with tempfile.TemporaryDirectory() as out:
+        metrics = evaluate_boxes(entries, predict_boxes, out, chunk_size=8, row_group_size=16)
+        assert metrics == pc_utils.cal_accuracy(predict_boxes, gt)
+        # row groups of 16 (or a few more, chunks are appended whole) and the remainder
+        assert len([f for f in os.listdir(out) if f.endswith('.npz')]) == 3
+        results = read_results(out)
+        assert np.array_equal(results['index'], np.arange(45))
+        assert np.allclose(results['pred_box'], predict_boxes)
+        ious = np.array([pc_utils.cal_iou3d(p, g) for p, g in zip(predict_boxes, gt)])
+        assert np.allclose(results['iou'], ious)
+        assert results['language'][7] == 'object number 7'
+        assert results['gt_corner2d'].shape == (45, 8, 2)
+        subset = read_results(out, columns=('index', 'iou'), scene_ids=['scene_1'], min_iou=0.5)
+        expected = [i for i in range(45) if i % 3 == 1 and ious[i] >= 0.5]
+        assert subset['index'].tolist() == expected and set(subset) == {'index', 'iou'}
+        # a new evaluation replaces the old row groups
+        evaluate_boxes(entries[:10], predict_boxes[:10], out)
+        assert len(read_results(out, columns=('index',))['index']) == 10
+
+
+if __name__ == '__main__':
+    test_batch_projection_matches_per_box()
+    test_streamed_results()
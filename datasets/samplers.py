@@ -0,0 +1,154 @@
+import random
+from collections import defaultdict
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class ResumableSampler(Sampler):
+    """
+    Epoch-seeded sampler that can restart in the middle of an epoch.
+
+    The order of epoch `e` depends only on (seed, e), so it can be rebuilt
+    after a restart. `cursor` is the number of samples of the current epoch
+    already consumed; the training loop advances it after every batch and
+    iteration resumes from it.
+    """
+
+    def __init__(self, data_source, shuffle=True, seed=0):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.cursor = 0
+
+    def set_epoch(self, epoch):
+        """Switch to `epoch`; the cursor is kept only when resuming that same epoch."""
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.cursor = 0
+
+    def indices(self):
+        n = len(self.data_source)
+        if not self.shuffle:
+            return list(range(n))
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        return torch.randperm(n, generator=g).tolist()
+
+    def __iter__(self):
+        start = self.cursor
+        return iter(self.indices()[start:])
+
+    def __len__(self):
+        return len(self.data_source) - self.cursor
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'cursor': self.cursor, 'seed': self.seed}
+
+    def load_state_dict(self, state):
+        self.epoch = state['epoch']
+        self.cursor = state['cursor']
+        self.seed = state['seed']
+
+
+class SceneAwareSampler(ResumableSampler):
+    """
+    ResumableSampler whose order keeps samples of nearby frames of a scene together.
+
+    The samples of every scene are sorted by frame and cut into runs of
+    `group_size` at a random offset, and the runs are shuffled, both anew
+    every epoch. A batch is then a few runs from random scenes: descriptions
+    of the same frame and frames that are each other's previous frames land
+    in one batch, which collate_unique_frames turns into fewer backbone
+    passes. Smaller runs are closer to a uniform shuffle.
+    """
+
+    def __init__(self, data_source, group_size=4, seed=0):
+        super().__init__(data_source, shuffle=True, seed=seed)
+        self.group_size = group_size
+        scenes = defaultdict(list)
+        for i, data in enumerate(data_source.dataset):
+            scenes[data['scene_id']].append((data['point_cloud']['point_cloud_name'], i))
+        self.scenes = [[i for _, i in sorted(scenes[scene_id])] for scene_id in sorted(scenes)]
+
+    def indices(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        runs = []
+        for scene in self.scenes:
+            offset = int(torch.randint(self.group_size, (1,), generator=g))
+            starts = range(-offset, len(scene), self.group_size)
+            runs += [scene[max(start, 0):start + self.group_size] for start in starts if start + self.group_size > 0]
+        order = torch.randperm(len(runs), generator=g).tolist()
+        return [i for r in order for i in runs[r]]
+
+
+class DistributedSampler(Sampler):
+    """
+    The share of one process of the order of any ResumableSampler.
+
+    Every process rebuilds the same global order from (seed, epoch), pads it
+    by wrapping around to a multiple of num_replicas * batch_size, and takes
+    every num_replicas-th block of batch_size consecutive samples. A batch is
+    thus a contiguous slice of the global order, so the runs of a
+    SceneAwareSampler stay together, and every process makes the same number
+    of steps. `cursor` counts the samples of this process already consumed;
+    all processes advance it in lockstep, so the state of any one of them
+    resumes all.
+    """
+
+    def __init__(self, sampler, num_replicas=1, rank=0, batch_size=1):
+        assert 0 <= rank < num_replicas, (rank, num_replicas)
+        self.sampler = sampler
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.batch_size = batch_size
+        self.cursor = 0
+
+    @property
+    def epoch(self):
+        return self.sampler.epoch
+
+    def set_epoch(self, epoch):
+        if epoch != self.sampler.epoch:
+            self.cursor = 0
+        self.sampler.set_epoch(epoch)
+
+    def num_samples(self):
+        """Samples per process in an epoch, padding included."""
+        block = self.num_replicas * self.batch_size
+        return -(-len(self.sampler.data_source) // block) * self.batch_size
+
+    def indices(self):
+        order = self.sampler.indices()
+        total = self.num_samples() * self.num_replicas
+        order = (order * -(-total // len(order)))[:total]
+        blocks = [order[i:i + self.batch_size] for i in range(0, total, self.batch_size)]
+        return [i for block in blocks[self.rank::self.num_replicas] for i in block]
+
+    def __iter__(self):
+        return iter(self.indices()[self.cursor:])
+
+    def __len__(self):
+        return self.num_samples() - self.cursor
+
+    def state_dict(self):
+        return dict(self.sampler.state_dict(), cursor=self.cursor)
+
+    def load_state_dict(self, state):
+        self.sampler.load_state_dict(dict(state, cursor=0))
+        self.cursor = state['cursor']
+
+
+def seed_worker(worker_id):
+    """
+    DataLoader worker_init_fn seeding numpy and python from the worker's torch seed.
+
+    torch only seeds its own generator (and python's) per worker, so without
+    this every worker starts from the parent's numpy state.
+    """
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
@@ -2,6 +2,7 @@ import os
 import os.path as osp
 from torch.utils.data import Dataset
 import json
+import zlib
 import random
 import torch
 
@@ -13,11 +14,11 @@ import pickle
 import time
 import json
 from utils import strefer_utils, pc_utils
+from utils.profiler import profiler, PROFILE_KEY
+from datasets.results import evaluate_boxes
+from datasets.fields import ALL_FIELDS, TARGET_FIELDS
 
-from tqdm import tqdm
 
-from transformers import RobertaTokenizerFast
-import spacy
 # import mmcv
 
 from utils.box_util import resize_img_keep_ratio, resize_box_keep_ratio, resize_box_to_original_size
@@ -29,29 +30,113 @@ cv2.setNumThreads(0)
 SRC_PATH = "/remote-home/linzhx/AAAI_Project/src/STRefer"
 
 class STReferDynamicDataset(Dataset):
-    def __init__(self, args, split="train") -> None:
+    def __init__(self, args, split="train", fields=ALL_FIELDS) -> None:
         super().__init__()
         self.args = args
+        self.src_path = args.src_path or SRC_PATH
+        self.data_root = args.data_root
         if split == "train":
-            self.dataset = json.load(open("data/strefer_train_submit.json"))
+            self.dataset = json.load(open(os.path.join(self.data_root, "strefer_train_submit.json")))
         else:
-            self.dataset = json.load(open("data/strefer_test_submit.json"))
+            self.dataset = json.load(open(os.path.join(self.data_root, "strefer_test_submit.json")))
 
-        self.find_previous = json.load(open("data/find_previous_strefer.json"))
-        self.points2image = json.load(open("data/points2image_strefer.json"))
+        self.find_previous = json.load(open(os.path.join(self.data_root, "find_previous_strefer.json")))
+        self.points2image = json.load(open(os.path.join(self.data_root, "points2image_strefer.json")))
         self.max_objects = args.max_obj_num
         self.max_lang_num = args.max_lang_num
         self.frame_num = args.frame_num
+        self.seed = args.seed
+        self.epoch = 0
 
         self.range = [16.36, 0, -1.5, 30.72, 40.96, 5, 0]
-
-        self.tokenizer = RobertaTokenizerFast.from_pretrained("roberta-base")
-        self.nlp = spacy.load('en_core_web_sm')
+        self.num_points = args.num_points
+        self.crop = args.crop
+        self.ground_height = args.ground_height
+        self.voxel_size = args.voxel_size
+        self.dedup_frames = args.dedup_frames
+        # previous frames from their own points, instead of the current frame's as trained
+        self.own_previous_points = args.own_previous_points
+        # letterbox canvas, an int for a square or (H, W), see strefer_utils.letterbox_size
+        camera_size = self._camera_size() if args.fit_camera else None
+        self.img_size = strefer_utils.letterbox_size(args.img_size, camera_size)
+        # data_dict keys to produce, the I/O and compute of the others is skipped
+        self.fields = set(fields)
+
+        self.nlp = self.tokenizer = None
+        if self.fields & {'tokens_positive', 'positive_map'}:
+            import spacy
+            from transformers import RobertaTokenizerFast
+            self.tokenizer = RobertaTokenizerFast.from_pretrained("roberta-base")
+            self.nlp = spacy.load('en_core_web_sm')
         
     
+    def _camera_size(self):
+        """(height, width) of the images, read from the first one."""
+        data = self.dataset[0]
+        return strefer_utils.image_size(
+            os.path.join(self.src_path, 'image', data['scene_id'], f"{data['image']['image_name']}.jpg"))
+
+    def set_epoch(self, epoch):
+        """Per-sample randomness is drawn from (seed, epoch, index), see __getitem__."""
+        self.epoch = epoch
+
+    def _sample_points(self, scene, rng, frame_key):
+        """
+        Crop to self.range, remove the ground and voxel-downsample as configured, then sample num_points.
+        With dedup_frames the sampling is seeded by the frame instead of the sample, so every sample
+        of an epoch sees the same points of a frame and collate_unique_frames can share them.
+        """
+        if self.dedup_frames:
+            rng = np.random.default_rng((self.seed, self.epoch, zlib.crc32(frame_key.encode())))
+        pc_range = self.range if self.crop else None
+        return strefer_utils.preprocess_points(scene, self.num_points, pc_range, self.ground_height,
+                                               self.voxel_size, rng=rng)
+
+    def _resample_current(self, scene, rng, frame_key):
+        """
+        The points of a previous frame as the datasets always filled them: the sampled points of
+        the current frame, shuffled. frame_key names the pair, for the rng of dedup_frames.
+        """
+        if self.dedup_frames:
+            rng = np.random.default_rng((self.seed, self.epoch, zlib.crc32(frame_key.encode())))
+        return strefer_utils.random_sampling(scene, self.num_points, rng=rng)
+
+    def _load_image(self, image_path, image, img_mask):
+        """
+        Decode and letterbox image_path into the preallocated (3, H, W) image and (H, W) mask,
+        return the name of the letterbox layout (strefer_utils.letterbox_key).
+        """
+        with profiler.stage('data/decode'):
+            _, _, pad_w, pad_h = strefer_utils.load_image_letterbox(image_path, self.img_size, out=image)
+        img_mask[:] = strefer_utils.letterbox_mask(self.img_size, pad_w, pad_h)
+        return strefer_utils.letterbox_key(self.img_size, pad_w, pad_h)
+
+    def _load_det_boxes(self, scene_id, point_cloud_name):
+        """Detected boxes of the frame, padded to max_objects, and their mask."""
+        boxes3d = np.zeros((self.max_objects, 6))
+        with profiler.stage('data/io'):
+            pred_bboxes = np.load(os.path.join(self.src_path, 'pred_boxes', scene_id, f'{point_cloud_name}.npy'))[:, :6]        
+        num_boxes = len(pred_bboxes)
+        boxes3d[:num_boxes] = pred_bboxes[:, :6]
+        det_bbox_label_mask = np.zeros((self.max_objects, ), dtype=bool)
+        det_bbox_label_mask[:num_boxes] = True
+        if num_boxes == 0:
+            det_bbox_label_mask[0] = True
+        return boxes3d, det_bbox_label_mask
+
     def __getitem__(self, index):
+        if not profiler.enabled:
+            return self._getitem(index)
+        with profiler.capture() as records:
+            with profiler.stage('data/getitem'):
+                data_dict = self._getitem(index)
+        data_dict[PROFILE_KEY] = json.dumps(records)
+        return data_dict
+
+    def _getitem(self, index):
         data = self.dataset[index]
         data_dict = {}
+        rng = np.random.default_rng((self.seed, self.epoch, index))
 
         scene_id = data['scene_id']
         point_cloud_name = data['point_cloud']['point_cloud_name']
@@ -60,65 +145,61 @@ class STReferDynamicDataset(Dataset):
         description = data['language']['description'].lower()
 
         target_bbox = np.array(bbox, dtype=np.float32)
+        # one key per frame, '' for missing previous frames
+        frame_keys = [f'{scene_id}/{point_cloud_name}/{image_name}'] + [''] * (self.frame_num - 1)
         
-        # boxes
-        boxes3d = np.zeros((self.max_objects, 6))
-        pred_bboxes = np.load(os.path.join(SRC_PATH, 'pred_boxes', scene_id, f'{point_cloud_name}.npy'))[:, :6]        
-        num_boxes = len(pred_bboxes)
-        boxes3d[:num_boxes] = pred_bboxes[:, :6]
-        det_bbox_label_mask = np.zeros((self.max_objects, ), dtype=bool)
-        det_bbox_label_mask[:num_boxes] = True
-        if num_boxes == 0:
-            det_bbox_label_mask[0] = True
+        if self.fields & {'det_boxes', 'det_bbox_label_mask'}:
+            boxes3d, det_bbox_label_mask = self._load_det_boxes(scene_id, point_cloud_name)
+        else:
+            boxes3d, det_bbox_label_mask = np.zeros((self.max_objects, 6)), None
 
         # point cloud
-        scene_file = os.path.join(SRC_PATH, 'points_rgbd', scene_id, f"{point_cloud_name}.npy")
-        scene = np.load(scene_file)
+        scene_file = os.path.join(self.src_path, 'points_rgbd', scene_id, f"{point_cloud_name}.npy")
+        with profiler.stage('data/io'):
+            scene = np.load(scene_file)
         scene[:, 3:6] = scene[:, 3:6] / 255.
-        scene = strefer_utils.random_sampling(scene, 30000)
+        with profiler.stage('data/sampling'):
+            scene = self._sample_points(scene, rng, frame_keys[0])
 
         # images
-        image_path = os.path.join(SRC_PATH, 'image', scene_id, f'{image_name}.jpg')   
-        image = strefer_utils.load_image(image_path)
-        image, ratio, pad_w, pad_h = resize_img_keep_ratio(image, self.args.img_size)
-        image = np.transpose(image, (2, 0, 1))
-        img_mask = np.zeros(image.shape[1:3], dtype=bool)
-        img_mask[0+pad_h//2:image.shape[0]-pad_h//2, 0+pad_w//2:image.shape[1]-pad_w//2] = 1
+        height, width = strefer_utils.img_shape(self.img_size)
+        images = np.zeros((self.frame_num, 3, height, width), dtype=np.float32)
+        images_mask = np.zeros((self.frame_num, height, width), dtype=bool)
+        image_path = os.path.join(self.src_path, 'image', scene_id, f'{image_name}.jpg')   
+        img_layout = [self._load_image(image_path, images[0], images_mask[0])]
 
         scenes = [scene]
-        images = [image]
-        images_mask = [img_mask]
         dynamic_mask = [1]
-        for _ in range(1, self.frame_num):
+        for k in range(1, self.frame_num):
             if point_cloud_name:
                 point_cloud_name = self.find_previous[scene_id][point_cloud_name]
             if point_cloud_name:
                 image_name = self.points2image[scene_id][point_cloud_name]
-                scene_file = os.path.join(SRC_PATH, 'points_rgbd', scene_id, f"{point_cloud_name}.npy")
-                add_scene = np.load(scene_file)
-                add_scene[:, 3:6] = add_scene[:, 3:6] / 255.
-                add_scene = strefer_utils.random_sampling(scene, 30000)
+                if self.own_previous_points:
+                    frame_keys[k] = f'{scene_id}/{point_cloud_name}/{image_name}'
+                    scene_file = os.path.join(self.src_path, 'points_rgbd', scene_id, f"{point_cloud_name}.npy")
+                    with profiler.stage('data/io'):
+                        add_scene = np.load(scene_file)
+                    add_scene[:, 3:6] = add_scene[:, 3:6] / 255.
+                    with profiler.stage('data/sampling'):
+                        add_scene = self._sample_points(add_scene, rng, frame_keys[k])
+                else:
+                    # the points the checkpoints were trained on: the current frame's, resampled
+                    frame_keys[k] = f'{frame_keys[0]}>{point_cloud_name}/{image_name}'
+                    with profiler.stage('data/sampling'):
+                        add_scene = self._resample_current(scene, rng, frame_keys[k])
                 dynamic_mask.append(1)
 
-                image_path = os.path.join(SRC_PATH, 'image', scene_id, f'{image_name}.jpg')
-                image = strefer_utils.load_image(image_path)
-                image, ratio, pad_w, pad_h = resize_img_keep_ratio(image, self.args.img_size)
-                image = np.transpose(image, (2, 0, 1))
-                img_mask = np.zeros(image.shape[1:3], dtype=bool)
-                img_mask[0+pad_h//2:image.shape[0]-pad_h//2, 0+pad_w//2:image.shape[1]-pad_w//2] = 1
+                image_path = os.path.join(self.src_path, 'image', scene_id, f'{image_name}.jpg')
+                img_layout.append(self._load_image(image_path, images[k], images_mask[k]))
             else:
-                add_scene = np.zeros((30000, 6), dtype=np.float32)
-                image = np.zeros((3, self.args.img_size, self.args.img_size), dtype=np.float32)
-                img_mask = np.zeros((self.args.img_size, self.args.img_size), dtype=bool)
-                img_mask[0, 0] = True
+                add_scene = np.zeros((self.num_points, 6), dtype=np.float32)
+                images_mask[k, 0, 0] = True
+                img_layout.append(strefer_utils.NO_IMAGE)
                 dynamic_mask.append(0)
             scenes.append(add_scene)
-            images.append(image)
-            images_mask.append(img_mask)
         scenes = np.stack(scenes, axis=0)
         dynamic_mask = np.hstack(dynamic_mask)
-        images = np.stack(images, axis=0)
-        images_mask = np.stack(images_mask, axis=0)
 
         # language
         text = ' '.join(description.replace(',', ' ,').replace('.', ' .').split()) + ' not mentioned'
@@ -126,41 +207,55 @@ class STReferDynamicDataset(Dataset):
         data_dict['point_clouds'] = scenes.astype(np.float32)
         data_dict['text'] = text
         data_dict['dynamic_mask'] = dynamic_mask.astype(np.int64)
-        data_dict['image'] = images.astype(np.float32)
+        data_dict['image'] = images
         data_dict['img_mask'] = images_mask
+        data_dict['img_layout'] = img_layout
         data_dict['det_boxes'] = boxes3d.astype(np.float32)
         data_dict['det_bbox_label_mask'] = det_bbox_label_mask
+        if self.dedup_frames:
+            data_dict['frame_keys'] = frame_keys
 
         # GT
+        if self.fields & set(TARGET_FIELDS):
+            data_dict.update(self._get_targets(target_bbox, scene, description))
+
+        return {key: value for key, value in data_dict.items() if key in self.fields or key == 'frame_keys'}
+    
+    def _get_targets(self, target_bbox, scene, description):
+        """GT arrays of the loss; the hull test and the spaCy / tokenizer pass only when their fields are required."""
+        targets = {}
         gt_boxes3d = np.zeros((self.max_objects, 6))
         gt_boxes3d[0] = target_bbox[:6]
         bbox_label_mask = np.zeros((self.max_objects, ))
         bbox_label_mask[0] = 1
-        point_instance_label = -np.ones(len(scene))
-        _, instance_ind = strefer_utils.extract_pc_in_box3d(
-            scene.copy(), strefer_utils.my_compute_box_3d(target_bbox[0:3], target_bbox[3:6], target_bbox[6])
-            )
-        point_instance_label[instance_ind] = 0
-
-        data_dict['center_label'] = gt_boxes3d[:, :3].astype(np.float32)
-        data_dict['size_gts'] = gt_boxes3d[:, 3:6].astype(np.float32)
-        data_dict['box_label_mask'] = bbox_label_mask.astype(np.float32)
-        data_dict['point_instance_label'] = point_instance_label.astype(np.int64)
+        targets['center_label'] = gt_boxes3d[:, :3].astype(np.float32)
+        targets['size_gts'] = gt_boxes3d[:, 3:6].astype(np.float32)
+        targets['box_label_mask'] = bbox_label_mask.astype(np.float32)
+
+        if 'point_instance_label' in self.fields:
+            point_instance_label = -np.ones(len(scene))
+            with profiler.stage('data/hull'):
+                _, instance_ind = strefer_utils.extract_pc_in_box3d(
+                    scene.copy(), strefer_utils.my_compute_box_3d(target_bbox[0:3], target_bbox[3:6], target_bbox[6])
+                    )
+            point_instance_label[instance_ind] = 0
+            targets['point_instance_label'] = point_instance_label.astype(np.int64)
 
         _labels = np.zeros(self.max_objects)
-        data_dict['sem_cls_label'] = _labels.astype(np.int64)
-        tokens_positive, positive_map = self._get_token_positive_map(description, self.max_lang_num)
-        data_dict['tokens_positive'] = tokens_positive.astype(np.int64)
-        data_dict['positive_map'] = positive_map.astype(np.float32)
-        
-        return data_dict
-    
+        targets['sem_cls_label'] = _labels.astype(np.int64)
+        if self.fields & {'tokens_positive', 'positive_map'}:
+            tokens_positive, positive_map = self._get_token_positive_map(description, self.max_lang_num)
+            targets['tokens_positive'] = tokens_positive.astype(np.int64)
+            targets['positive_map'] = positive_map.astype(np.float32)
+        return targets
+
     def _get_token_positive_map(self, description, max_lang_num):
         caption = ' '.join(description.replace(',', ' ,').split())
         caption = ' ' + caption + ' '
         tokens_positive = np.zeros((self.max_objects, 2))
 
-        doc = self.nlp(caption)
+        with profiler.stage('data/spacy'):
+            doc = self.nlp(caption)
         cat_names = []
         for token in doc:
             if token.dep_ == 'nsubj':           # Find main object
@@ -193,10 +288,11 @@ class STReferDynamicDataset(Dataset):
             tokens_positive[c][1] = end_span
 
         # Positive map (for soft token prediction)
-        tokenized = self.tokenizer.batch_encode_plus(
-            [' '.join(description.replace(',', ' ,').split())],
-            padding="longest", return_tensors="pt"
-        )
+        with profiler.stage('data/tokenize'):
+            tokenized = self.tokenizer.batch_encode_plus(
+                [' '.join(description.replace(',', ' ,').split())],
+                padding="longest", return_tensors="pt"
+            )
         positive_map = np.zeros((self.max_objects, max_lang_num))
         gt_map = get_positive_map(tokenized, tokens_positive[:len(cat_names)], max_lang_num)
         positive_map[:len(cat_names)] = gt_map
@@ -204,48 +300,9 @@ class STReferDynamicDataset(Dataset):
         return tokens_positive, positive_map
     
     def evaluate(self, predict_boxes, output_path=''):
-        pred_boxes = []
-        target_boxes = []
-        eval_results = []
-        idx = 0
-        for pred_box in tqdm(predict_boxes):
-            data = self.dataset[idx]
-            scene_id = data['scene_id']
-            point_cloud_info = data['point_cloud']
-            image_info = data['image']
-            point_cloud_name = point_cloud_info['point_cloud_name']
-            image_name = image_info['image_name']
-
-            target = point_cloud_info['bbox']
-
-            if output_path:
-                ex_matrix = data['calibration']['ex_matrix']
-                in_matrix = data['calibration']['in_matrix']
-                language = data['language']['description']
-     
-                out_data = dict()
-                out_data['gt_box'] = target
-                out_data['pred_box'] = pred_box
-                out_data["scene_id"] = scene_id
-                out_data["point_cloud_name"] = point_cloud_name
-                out_data["image_name"] = image_name
-                out_data['gt_corner2d'] = strefer_utils.batch_compute_box_3d([np.array(target)], ex_matrix, in_matrix)
-                out_data['pred_corner2d'] = strefer_utils.batch_compute_box_3d([np.array(pred_box)], ex_matrix, in_matrix)
-                out_data['language'] = language
-                out_data['iou'] = pc_utils.cal_iou3d(pred_box, target)
-                eval_results.append(out_data)
-
-            target_boxes.append(target)
-            idx += 1
-
-        target_boxes = np.array(target_boxes)
-        pred_boxes = predict_boxes
-
-        if output_path:
-            save_pkl(eval_results, output_path)
-        acc25, acc50, miou = pc_utils.cal_accuracy(pred_boxes, target_boxes)
-        return acc25, acc50, miou
-        
+        """Acc@0.25, Acc@0.5 and mIoU; with output_path, per-sample records are streamed there (see datasets.results)."""
+        return evaluate_boxes(self.dataset, predict_boxes, output_path)
+
     def __len__(self):
         return len(self.dataset)
 
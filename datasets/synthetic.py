@@ -0,0 +1,208 @@
+"""
+Synthetic STRefer / WildRefer corpus for benchmarking without the captures.
+
+Writes the layout the dataset classes read, with the same JSON schema:
+
+    <out>/src/points_rgbd/<scene>/<frame>.npy   (N, 6) xyz + rgb in [0, 255]
+    <out>/src/image/<scene>/<image>.jpg
+    <out>/src/pred_boxes/<scene>/<frame>.npy    (M, 7) x y z w l h r
+    <out>/data/{strefer,wildrefer}_{train,test}*.json
+    <out>/data/find_previous_{strefer,wildrefer}.json
+    <out>/data/points2image_strefer.json         (strefer only)
+
+Train / test on it with `--src_path <out>/src --data_root <out>/data`.
+
+    python -m datasets.synthetic --out /tmp/strefer_fake --dataset strefer
+    python -m datasets.synthetic --out /tmp/ci --dataset wildrefer --small
+"""
+import argparse
+import json
+import os
+import os.path as osp
+
+import numpy as np
+
+# the region the loaders crop to, as (center, size)
+RANGE_CENTER = np.array([16.36, 0, -1.5])
+RANGE_SIZE = np.array([30.72, 40.96, 5])
+
+ANNOTATION_FILES = {
+    'strefer': {'train': 'strefer_train_submit.json', 'test': 'strefer_test_submit.json',
+                'find_previous': 'find_previous_strefer.json', 'points2image': 'points2image_strefer.json'},
+    'wildrefer': {'train': 'wildrefer_train.json', 'test': 'wildrefer_test.json',
+                  'find_previous': 'find_previous_wildrefer.json'},
+}
+
+# name: (num_scenes, frames_per_scene, points_per_frame, image (w, h), boxes_per_frame, descriptions_per_frame)
+SCALES = {
+    'full': (20, 50, 60000, (1920, 1080), 12, 3),
+    'small': (3, 4, 4000, (320, 180), 4, 2),
+}
+
+NOUNS = ['man', 'woman', 'person', 'child', 'girl', 'boy', 'cyclist', 'pedestrian', 'worker', 'student']
+ADJECTIVES = ['tall', 'short', 'young', 'old', 'running', 'standing', 'walking', 'sitting']
+COLORS = ['red', 'blue', 'black', 'white', 'gray', 'green', 'yellow', 'dark']
+CLOTHES = ['shirt', 'jacket', 'coat', 'dress', 'hoodie', 'backpack', 'hat', 'pants']
+VERBS = ['is walking towards', 'is standing next to', 'is crossing in front of', 'is moving away from',
+         'is waiting near', 'is talking with', 'is looking at', 'is passing by']
+PLACES = ['the car', 'the tree', 'the building', 'the bench', 'the crosswalk', 'the door',
+          'the bicycle', 'the bus stop', 'the other person', 'the street lamp']
+CLAUSES = ['while holding a phone', 'with both hands in the pockets', 'on the left side of the road',
+           'on the right of the scene', 'closest to the camera', 'far from the sensor',
+           'behind the group of people', 'at the end of the sidewalk', 'and then turns around',
+           'after leaving the shop']
+
+
+def random_description(rng, mean_words=18):
+    """A referring sentence; its word count follows a log-normal around `mean_words`."""
+    target = int(np.clip(rng.lognormal(np.log(mean_words), 0.4), 6, 80))
+    words = ['the', rng.choice(ADJECTIVES), rng.choice(NOUNS), 'in', 'a', rng.choice(COLORS),
+             rng.choice(CLOTHES), rng.choice(VERBS), rng.choice(PLACES)]
+    while len(words) < target:
+        words += rng.choice(CLAUSES).split()
+    return ' '.join(words) + ' .'
+
+
+def random_boxes(rng, n):
+    """(n, 7) boxes inside the cropped range: center, size (w, l, h), heading."""
+    center = RANGE_CENTER + (rng.random((n, 3)) - 0.5) * RANGE_SIZE * [0.9, 0.9, 0.2]
+    size = rng.uniform([0.4, 0.4, 1.4], [1.0, 1.0, 2.0], (n, 3))
+    heading = rng.uniform(-np.pi, np.pi, (n, 1))
+    boxes = np.concatenate([center, size, heading], axis=1)
+    boxes[:, 2] = RANGE_CENTER[2] - RANGE_SIZE[2] / 2 + 0.5 + size[:, 2] / 2
+    return boxes.astype(np.float32)
+
+
+def random_points(rng, boxes, n):
+    """A ground plane, background clutter and dense points on every box, (n, 6) float32."""
+    n_obj = n // 4
+    n_ground = n // 2
+    n_clutter = n - n_obj - n_ground
+    low = RANGE_CENTER - RANGE_SIZE / 2
+    ground = low + rng.random((n_ground, 3)) * RANGE_SIZE * [1, 1, 0]
+    ground[:, 2] += 0.5 + rng.normal(0, 0.03, n_ground)
+    clutter = low + rng.random((n_clutter, 3)) * RANGE_SIZE
+    owner = rng.integers(0, len(boxes), n_obj)
+    local = (rng.random((n_obj, 3)) - 0.5) * boxes[owner, 3:6]
+    c, s = np.cos(boxes[owner, 6]), np.sin(boxes[owner, 6])
+    obj = np.stack([c * local[:, 0] - s * local[:, 1], s * local[:, 0] + c * local[:, 1], local[:, 2]], axis=1)
+    obj += boxes[owner, :3]
+    xyz = np.concatenate([ground, clutter, obj], axis=0)
+    rgb = rng.integers(0, 256, (n, 3))
+    return np.concatenate([xyz, rgb], axis=1).astype(np.float32)
+
+
+def random_image(rng, size):
+    """A smooth color field with a few rectangles, so JPEG sizes stay realistic."""
+    import cv2
+    w, h = size
+    coarse = rng.integers(0, 256, (max(h // 32, 2), max(w // 32, 2), 3), dtype=np.uint8)
+    img = cv2.resize(coarse, (w, h), interpolation=cv2.INTER_CUBIC)
+    for _ in range(8):
+        x0, y0 = rng.integers(0, w), rng.integers(0, h)
+        x1, y1 = x0 + rng.integers(10, max(w // 4, 11)), y0 + rng.integers(10, max(h // 4, 11))
+        cv2.rectangle(img, (int(x0), int(y0)), (int(x1), int(y1)), rng.integers(0, 256, 3).tolist(), -1)
+    return img
+
+
+def calibration(size):
+    """A camera looking along +x of the lidar frame: ex_matrix (3, 4), in_matrix (3, 3)."""
+    w, h = size
+    ex_matrix = [[0, -1, 0, 0], [0, 0, -1, 0], [1, 0, 0, 0]]
+    f = 0.8 * w
+    in_matrix = [[f, 0, w / 2], [0, f, h / 2], [0, 0, 1]]
+    return ex_matrix, in_matrix
+
+
+def generate(out_dir, dataset='strefer', num_scenes=20, frames_per_scene=50, points_per_frame=60000,
+             image_size=(1920, 1080), boxes_per_frame=12, descriptions_per_frame=3,
+             test_ratio=0.2, mean_words=18, seed=0):
+    """Write a synthetic corpus under out_dir, returns (src_path, data_root)."""
+    import cv2
+    assert dataset in ANNOTATION_FILES, dataset
+    rng = np.random.default_rng(seed)
+    src_path = osp.join(out_dir, 'src')
+    data_root = osp.join(out_dir, 'data')
+    os.makedirs(data_root, exist_ok=True)
+    num_test = max(1, int(round(num_scenes * test_ratio))) if num_scenes > 1 else 0
+    splits = {'train': [], 'test': []}
+    find_previous = dict()
+    points2image = dict()
+    ex_matrix, in_matrix = calibration(image_size)
+    ann_id = 0
+    for s in range(num_scenes):
+        scene_id = f'scene_{s:04d}'
+        split = 'test' if s >= num_scenes - num_test else 'train'
+        for sub in ('points_rgbd', 'image', 'pred_boxes'):
+            os.makedirs(osp.join(src_path, sub, scene_id), exist_ok=True)
+        find_previous[scene_id] = dict()
+        points2image[scene_id] = dict()
+        previous = None
+        t0 = 1600000000.0 + 1000 * s
+        # the same objects drift through every frame of a scene
+        boxes = random_boxes(rng, boxes_per_frame)
+        velocity = np.zeros_like(boxes)
+        velocity[:, :2] = rng.normal(0, 0.1, (boxes_per_frame, 2))
+        for f in range(frames_per_scene):
+            # lidar and camera run at different rates, strefer maps them by timestamp
+            frame = f'{t0 + 0.1 * f:.6f}'
+            image_name = frame if dataset == 'wildrefer' else f'{t0 + 0.1 * f + 0.013:.6f}'
+            find_previous[scene_id][frame] = previous
+            points2image[scene_id][frame] = image_name
+            previous = frame
+
+            if f > 0:
+                boxes = boxes + velocity
+            np.save(osp.join(src_path, 'points_rgbd', scene_id, f'{frame}.npy'),
+                    random_points(rng, boxes, points_per_frame))
+            pred = boxes + rng.normal(0, 0.1, boxes.shape).astype(np.float32)
+            np.save(osp.join(src_path, 'pred_boxes', scene_id, f'{frame}.npy'), pred)
+            cv2.imwrite(osp.join(src_path, 'image', scene_id, f'{image_name}.jpg'), random_image(rng, image_size))
+
+            for object_id in rng.choice(boxes_per_frame, min(descriptions_per_frame, boxes_per_frame), replace=False):
+                splits[split].append({
+                    'scene_id': scene_id,
+                    'object_id': str(object_id),
+                    'point_cloud': {'point_cloud_name': frame, 'bbox': boxes[object_id].tolist()},
+                    'image': {'image_name': image_name},
+                    'language': {'description': random_description(rng, mean_words), 'ann_id': ann_id},
+                    'calibration': {'ex_matrix': ex_matrix, 'in_matrix': in_matrix},
+                })
+                ann_id += 1
+
+    files = ANNOTATION_FILES[dataset]
+    outputs = {files['train']: splits['train'], files['test']: splits['test'],
+               files['find_previous']: find_previous}
+    if 'points2image' in files:
+        outputs[files['points2image']] = points2image
+    for name, obj in outputs.items():
+        with open(osp.join(data_root, name), 'w') as f:
+            json.dump(obj, f)
+    return src_path, data_root
+
+
+def main():
+    parser = argparse.ArgumentParser('Generate a synthetic STRefer / WildRefer corpus')
+    parser.add_argument('--out', required=True, type=str)
+    parser.add_argument('--dataset', default='strefer', choices=sorted(ANNOTATION_FILES))
+    parser.add_argument('--small', action='store_true', help='a few tiny scenes, for CI')
+    parser.add_argument('--num_scenes', type=int)
+    parser.add_argument('--frames_per_scene', type=int)
+    parser.add_argument('--points_per_frame', type=int)
+    parser.add_argument('--image_size', type=int, nargs=2, metavar=('W', 'H'))
+    parser.add_argument('--boxes_per_frame', type=int)
+    parser.add_argument('--descriptions_per_frame', type=int)
+    parser.add_argument('--mean_words', default=18, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    scale = SCALES['small' if args.small else 'full']
+    keys = ['num_scenes', 'frames_per_scene', 'points_per_frame', 'image_size',
+            'boxes_per_frame', 'descriptions_per_frame']
+    kwargs = {k: getattr(args, k) if getattr(args, k) is not None else v for k, v in zip(keys, scale)}
+    src_path, data_root = generate(args.out, args.dataset, mean_words=args.mean_words, seed=args.seed, **kwargs)
+    print(f"--src_path {src_path} --data_root {data_root}")
+
+
+if __name__ == '__main__':
+    main()
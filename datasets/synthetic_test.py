@@ -0,0 +1,60 @@
+''' Testing that the synthetic corpus matches what the STRefer / WildRefer loaders read. '''
+
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from datasets.synthetic import ANNOTATION_FILES, SCALES, generate
+
+FRAME_NUM = 3
+
+
+def check_corpus(dataset):
+    num_scenes, frames, points, image_size, boxes, descriptions = SCALES['small']
+    with tempfile.TemporaryDirectory() as out:
+        src_path, data_root = generate(out, dataset, num_scenes, frames, points, image_size, boxes, descriptions)
+        files = ANNOTATION_FILES[dataset]
+        load = lambda name: json.load(open(os.path.join(data_root, files[name])))
+        train, test = load('train'), load('test')
+        find_previous = load('find_previous')
+        points2image = load('points2image') if 'points2image' in files else None
+        assert len(train) > 0 and len(test) > 0
+        assert not {d['scene_id'] for d in train} & {d['scene_id'] for d in test}
+
+        for data in train + test:
+            scene_id = data['scene_id']
+            name = data['point_cloud']['point_cloud_name']
+            image_name = data['image']['image_name']
+            assert len(data['point_cloud']['bbox']) == 7
+            assert np.array(data['calibration']['ex_matrix']).shape == (3, 4)
+            assert np.array(data['calibration']['in_matrix']).shape == (3, 3)
+            assert data['language']['description'].split()
+            # walk the predecessor chain the way __getitem__ does
+            for _ in range(FRAME_NUM):
+                scene = np.load(os.path.join(src_path, 'points_rgbd', scene_id, f'{name}.npy'))
+                assert scene.shape == (points, 6) and scene.dtype == np.float32
+                pred_boxes = np.load(os.path.join(src_path, 'pred_boxes', scene_id, f'{name}.npy'))
+                assert pred_boxes.shape == (boxes, 7)
+                assert os.path.exists(os.path.join(src_path, 'image', scene_id, f'{image_name}.jpg'))
+                name = find_previous[scene_id][name]
+                if not name:
+                    break
+                image_name = points2image[scene_id][name] if points2image is not None else name
+
+
+def test_strefer_layout():
+    check_corpus('strefer')
+
+
+def test_wildrefer_layout():
+    check_corpus('wildrefer')
+
+
+if __name__ == '__main__':
+    test_strefer_layout()
+    test_wildrefer_layout()
@@ -1,6 +1,8 @@
 from .wildrefer import WildRefer
+from .fast_init import create_model_from_checkpoint
+from .inference import optimize_for_inference
 
-def create_model(args):
+def create_model(args, pretrained=True):
     return WildRefer(
         args=args,
         num_class=args.max_lang_num,
@@ -14,5 +16,8 @@ def create_model(args):
         resnet_ckpt=None,
         self_attend=True,
         frame_num=args.frame_num,
-        butd=args.butd
+        butd=args.butd,
+        seed_keep=args.seed_keep,
+        pack_image_tokens=args.pack_image_tokens,
+        pretrained=pretrained
     )
@@ -0,0 +1,78 @@
+"""
+Activation checkpointing of WildRefer stages.
+
+A checkpointed module keeps only its inputs for backward and runs its
+forward a second time during backward to rebuild the activations, trading
+compute for memory. Stages are named after their profiler stages; within a
+stage every layer is checkpointed on its own, so only one layer's
+activations are alive at a time during the recompute.
+"""
+import functools
+from contextlib import contextmanager, nullcontext
+
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+# stage name -> submodules of WildRefer checkpointed as separate segments
+STAGES = {
+    'point_backbone': ('point_backbone_net.sa1', 'point_backbone_net.sa2', 'point_backbone_net.sa3',
+                       'point_backbone_net.sa4'),
+    'point_fuser': ('multi_fuser',),
+    'image_fuser': ('image_multi_fuser',),
+    'cross_encoder': ('cross_encoder_text_points.layers',),
+    'decoder': ('decoder',),
+}
+
+
+@contextmanager
+def _frozen_running_stats(module):
+    """Keep the batch-norm running statistics of `module` as they are, so a recompute does not update them twice."""
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    states = [(m.momentum, m.num_batches_tracked.clone() if m.num_batches_tracked is not None else None)
+              for m in norms]
+    for m in norms:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(norms, states):
+            m.momentum = momentum
+            if num_batches_tracked is not None:
+                m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def checkpoint_module(module):
+    """Make `module` checkpoint its forward while training with grad enabled; its state dict is unchanged."""
+    if getattr(module, 'activation_checkpoint', False):
+        return
+    forward = module.forward
+
+    @functools.wraps(forward)
+    def checkpointed_forward(*args, **kwargs):
+        if not (module.training and torch.is_grad_enabled()):
+            return forward(*args, **kwargs)
+        return checkpoint(forward, *args, use_reentrant=False,
+                          context_fn=lambda: (nullcontext(), _frozen_running_stats(module)), **kwargs)
+
+    module.forward = checkpointed_forward
+    module.activation_checkpoint = True
+
+
+def stage_modules(model, stage):
+    """The modules checkpointed for `stage`: the listed ones, or each layer of a listed ModuleList."""
+    modules = []
+    for name in STAGES[stage]:
+        module = model.get_submodule(name)
+        modules += list(module) if isinstance(module, nn.ModuleList) else [module]
+    return modules
+
+
+def enable_activation_checkpointing(model, stages):
+    """Checkpoint every layer of `stages` (names of STAGES, or 'all'). Returns how many modules."""
+    if 'all' in stages:
+        stages = list(STAGES)
+    modules = [module for stage in stages for module in stage_modules(model, stage)]
+    for module in modules:
+        checkpoint_module(module)
+    return len(modules)
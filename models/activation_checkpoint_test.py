@@ -0,0 +1,93 @@
+''' Testing that activation checkpointing keeps the outputs, gradients and batch-norm statistics. '''
+
+import copy
+import os
+import sys
+
+import torch
+from torch import nn
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from benchmarks.common import saved_tensor_bytes
+from models.activation_checkpoint import STAGES, checkpoint_module, enable_activation_checkpointing
+from models.encoder_decoder_layers import BiDecoderLayer
+from pointnet2.pointnet2_modules import PointnetSAModuleVotes
+
+
+def run_twice(module, inputs, output):
+    """Train-mode output and parameter gradients of `module` and of its checkpointed copy, same dropout masks."""
+    results = []
+    for checkpointed in (False, True):
+        m = copy.deepcopy(module).train()
+        if checkpointed:
+            checkpoint_module(m)
+        torch.manual_seed(0)
+        out = output(m(*inputs))
+        out.square().sum().backward()
+        results.append((m, out.detach(), {name: p.grad for name, p in m.named_parameters()}))
+    return results
+
+
+def test_bi_decoder_layer():
+    torch.manual_seed(0)
+    layer = BiDecoderLayer(64, n_heads=4, dim_feedforward=128, dropout=0.1, self_position_embedding='loc_learned')
+    inputs = (torch.randn(2, 16, 64), torch.randn(2, 128, 64), torch.randn(2, 12, 64), torch.randn(2, 16, 6),
+              None, torch.zeros(2, 12, dtype=torch.bool))
+    (_, expected, expected_grads), (m, out, grads) = run_twice(layer, inputs, lambda x: x)
+    assert torch.allclose(out, expected, atol=1e-6)
+    for name in expected_grads:
+        assert torch.allclose(grads[name], expected_grads[name], atol=1e-5), name
+    # only the inputs are kept for backward, the attention maps and FFN activations are not
+    plain = copy.deepcopy(layer).train()
+    assert saved_tensor_bytes(lambda: m(*inputs)) < saved_tensor_bytes(lambda: plain(*inputs)) / 4
+
+
+def test_sa_module_batch_norm_updated_once():
+    torch.manual_seed(0)
+    sa = PointnetSAModuleVotes(npoint=64, radius=0.3, nsample=16, mlp=[3, 32, 64], use_xyz=True,
+                               normalize_xyz=True)
+    xyz = torch.rand(2, 512, 3)
+    features = torch.randn(2, 3, 512)
+    (plain, expected, expected_grads), (m, out, grads) = run_twice(sa, (xyz, features), lambda x: x[1])
+    assert torch.allclose(out, expected, atol=1e-5)
+    for name in expected_grads:
+        assert torch.allclose(grads[name], expected_grads[name], rtol=1e-4, atol=1e-4), name
+    for name, buffer in plain.named_buffers():
+        assert torch.allclose(dict(m.named_buffers())[name], buffer), name
+
+
+class Stages(nn.Module):
+    """The module names of STAGES, holding small layers."""
+
+    def __init__(self):
+        super().__init__()
+        self.point_backbone_net = nn.Module()
+        for i in range(1, 5):
+            setattr(self.point_backbone_net, f'sa{i}', nn.Linear(4, 4))
+        self.multi_fuser = nn.ModuleList([nn.Linear(4, 4)])
+        self.image_multi_fuser = nn.ModuleList([nn.Linear(4, 4)])
+        self.cross_encoder_text_points = nn.Module()
+        self.cross_encoder_text_points.layers = nn.ModuleList([nn.Linear(4, 4) for _ in range(3)])
+        self.decoder = nn.ModuleList([nn.Linear(4, 4) for _ in range(6)])
+
+
+def test_stage_selection():
+    model = Stages()
+    keys = list(model.state_dict())
+    assert enable_activation_checkpointing(model, ['decoder']) == 6
+    assert all(getattr(m, 'activation_checkpoint', False) for m in model.decoder)
+    assert not getattr(model.multi_fuser[0], 'activation_checkpoint', False)
+    assert enable_activation_checkpointing(Stages(), ['all']) == 4 + 1 + 1 + 3 + 6
+    assert sorted(STAGES) == sorted(['point_backbone', 'point_fuser', 'image_fuser', 'cross_encoder', 'decoder'])
+    assert list(model.state_dict()) == keys
+    # evaluation runs the plain forward
+    x = torch.randn(2, 4, requires_grad=True)
+    model.eval()
+    assert model.decoder[0](x).grad_fn.name() == 'AddmmBackward0'
+
+
+if __name__ == '__main__':
+    test_bi_decoder_layer()
+    test_sa_module_batch_norm_updated_once()
+    test_stage_selection()
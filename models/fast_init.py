@@ -0,0 +1,77 @@
+"""
+Build a model straight from checkpoint tensors.
+
+The modules are constructed on the meta device, so nothing is randomly
+initialized and no pretrained weights are fetched, then the checkpoint
+tensors are assigned in place of the meta ones. Only tensors the checkpoint
+does not carry (the frozen pretrained weights left out of trainable-only
+checkpoints) are read from their pretrained source.
+"""
+import torch
+
+from utils.checkpoint import PRETRAINED_SOURCES
+
+
+def _pretrained_state(source):
+    """Return the state dict of a pretrained source named as in PRETRAINED_SOURCES."""
+    kind, name = source.split(':', 1)
+    if kind == 'huggingface':
+        from transformers import RobertaModel
+        from .wildrefer import from_pretrained
+        return from_pretrained(RobertaModel, name).state_dict()
+    if kind == 'torchvision':
+        import torchvision
+        weights = torchvision.models.get_model_weights(name).DEFAULT
+        return weights.get_state_dict(progress=False)
+    raise ValueError(f'unknown pretrained source {source}')
+
+
+def _load_pretrained(model, keys, sources):
+    """Materialize `keys` of model from the pretrained sources they belong to."""
+    for prefix, source in sources.items():
+        wanted = [k for k in keys if k.startswith(prefix)]
+        if not wanted:
+            continue
+        state = _pretrained_state(source)
+        state = {k: state[k[len(prefix):]] for k in wanted}
+        model.load_state_dict(state, strict=False, assign=True)
+
+
+def _init_non_persistent_buffers(model):
+    """Rebuild buffers that are not part of any state dict (RoBERTa's embedding ids)."""
+    for module in model.modules():
+        position_ids = getattr(module, 'position_ids', None)
+        if isinstance(position_ids, torch.Tensor) and position_ids.is_meta:
+            module.position_ids = torch.arange(position_ids.shape[-1]).expand((1, -1))
+        token_type_ids = getattr(module, 'token_type_ids', None)
+        if isinstance(token_type_ids, torch.Tensor) and token_type_ids.is_meta:
+            module.token_type_ids = torch.zeros(token_type_ids.shape, dtype=torch.long)
+
+
+def create_model_from_checkpoint(args, state, device='cpu'):
+    """
+    Construct the model for `args` and load `state` (see utils.checkpoint.load_state)
+    into it without initializing or downloading weights the checkpoint replaces.
+    """
+    from . import create_model
+
+    with torch.device('meta'):
+        model = create_model(args, pretrained=False)
+
+    manifest = state.get('manifest', {})
+    frozen = set(manifest.get('frozen_keys', []))
+    sources = manifest.get('sources', PRETRAINED_SOURCES)
+    missing_keys, unexpected_keys = model.load_state_dict(state['model'], strict=False, assign=True)
+    unknown = [k for k in missing_keys if k not in frozen]
+    if unknown or unexpected_keys:
+        raise RuntimeError(
+            f"Error(s) in loading state_dict for {model.__class__.__name__}:\n"
+            f"\tMissing key(s): {unknown}\n\tUnexpected key(s): {unexpected_keys}"
+        )
+    _load_pretrained(model, missing_keys, sources)
+    _init_non_persistent_buffers(model)
+
+    left = [n for n, t in list(model.named_parameters()) + list(model.named_buffers()) if t.is_meta]
+    if left:
+        raise RuntimeError(f'tensors left uninitialized: {left}')
+    return model.to(device)
@@ -0,0 +1,118 @@
+''' Testing that a model built from a checkpoint on the meta device is the one that was saved. '''
+
+import argparse
+import os
+import sys
+import tempfile
+
+import torch
+from transformers import BatchEncoding, RobertaConfig, RobertaModel
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+import models.wildrefer
+from models import create_model, create_model_from_checkpoint
+from models.seed_pruning import SeedRelevanceScorer
+from utils.checkpoint import CheckpointWriter, load_state
+
+# RoBERTa is frozen and comes from its pretrained source, the ResNet layers are saved
+SOURCES = {'text_encoder.': 'huggingface:roberta-base'}
+TINY_ROBERTA = dict(vocab_size=64, hidden_size=32, num_hidden_layers=1, num_attention_heads=2,
+                    intermediate_size=64, max_position_embeddings=40)
+
+
+class ToyTokenizer:
+    """Whitespace tokens hashed into the tiny vocabulary, padded to the longest text."""
+
+    def batch_encode_plus(self, texts, padding, return_tensors):
+        ids = [[0] + [3 + sum(map(ord, word)) % 60 for word in text.split()] + [2] for text in texts]
+        length = max(len(row) for row in ids)
+        return BatchEncoding({
+            'input_ids': torch.tensor([row + [1] * (length - len(row)) for row in ids]),
+            'attention_mask': torch.tensor([[1] * len(row) + [0] * (length - len(row)) for row in ids]),
+        })
+
+
+def tiny_from_pretrained(cls, name, **kwargs):
+    """from_pretrained of a tiny RoBERTa, the same weights at every call."""
+    if cls is RobertaConfig:
+        return RobertaConfig(**TINY_ROBERTA)
+    if cls is RobertaModel:
+        with torch.random.fork_rng():
+            torch.manual_seed(1)
+            return RobertaModel(RobertaConfig(**TINY_ROBERTA))
+    return ToyTokenizer()
+
+
+def make_args(seed_keep=0):
+    return argparse.Namespace(max_lang_num=16, num_queries=16, num_decoder_layers=1, frame_num=2, butd=False,
+                              seed_keep=seed_keep, pack_image_tokens=False, lr_backbone=1e-3)
+
+
+def inputs(num_points=2048, img_size=64):
+    generator = torch.Generator().manual_seed(0)
+    img_mask = torch.zeros(2, 2, img_size, img_size, dtype=torch.bool)
+    img_mask[:, :, :, :img_size - 16] = True
+    return {
+        'point_clouds': torch.rand(2, 2, num_points, 6, generator=generator) * torch.tensor([10, 10, 2, 1, 1, 1]),
+        'text': ['the man in red walking to the car', 'a parked car not mentioned'],
+        'dynamic_mask': torch.ones(2, 2, dtype=torch.long),
+        'image': torch.rand(2, 2, 3, img_size, img_size, generator=generator),
+        'img_mask': img_mask,
+    }
+
+
+def saved_model(work_dir, args):
+    """A randomly initialized model with RoBERTa from its source, and its checkpoint."""
+    torch.manual_seed(0)
+    model = create_model(args, pretrained=False)
+    model.text_encoder.load_state_dict(tiny_from_pretrained(RobertaModel, 'roberta-base').state_dict())
+    writer = CheckpointWriter(work_dir, model, sources=SOURCES)
+    writer.save('model.pth', model)
+    writer.close()
+    return model.eval(), load_state(os.path.join(work_dir, 'model.pth'))
+
+
+def test_create_model_from_checkpoint():
+    from_pretrained = models.wildrefer.from_pretrained
+    models.wildrefer.from_pretrained = tiny_from_pretrained
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            model, state = saved_model(work_dir, make_args())
+            frozen = state['manifest']['frozen_keys']
+            assert frozen and all(key.startswith('text_encoder.') for key in frozen)
+            assert not set(frozen) & set(state['model'])
+
+            loaded = create_model_from_checkpoint(make_args(), state).eval()
+            expected = model.state_dict()
+            assert list(loaded.state_dict()) == list(expected)
+            for key, value in loaded.state_dict().items():
+                assert torch.equal(value, expected[key]), key
+            # the buffers no state dict carries are rebuilt
+            embeddings = loaded.text_encoder.embeddings
+            assert torch.equal(embeddings.position_ids, model.text_encoder.embeddings.position_ids)
+            assert torch.equal(embeddings.token_type_ids, model.text_encoder.embeddings.token_type_ids)
+
+            with torch.no_grad():
+                reference = model(inputs())
+                out = loaded(inputs())
+            for key in ('text_feats', 'proj_tokens', 'last_proj_queries', 'last_center', 'last_pred_size'):
+                assert torch.equal(out[key], reference[key]), key
+
+            # a checkpoint of another --seed_keep does not load, either way
+            scorer = {f'seed_scorer.{k}': v for k, v in SeedRelevanceScorer(288).state_dict().items()}
+            pruned_state = dict(state, model={**state['model'], **scorer})
+            for seed_keep, checkpoint, error in ((16, state, 'Missing key(s): [\'seed_scorer'),
+                                                 (0, pruned_state, 'Unexpected key(s): [\'seed_scorer')):
+                try:
+                    create_model_from_checkpoint(make_args(seed_keep), checkpoint)
+                except RuntimeError as e:
+                    assert error in str(e), str(e)
+                else:
+                    raise AssertionError(f'loaded a checkpoint of another architecture with seed_keep={seed_keep}')
+    finally:
+        models.wildrefer.from_pretrained = from_pretrained
+
+
+if __name__ == '__main__':
+    test_create_model_from_checkpoint()
@@ -3,13 +3,14 @@ import torch.nn as nn
 
 import torch
 import torch.nn.functional as F
-import torchvision
+from collections import OrderedDict
 from torch import nn
-from torchvision.models._utils import IntermediateLayerGetter
 from typing import Dict
 
 from .position_encoding import PositionEmbeddingSine
 
+POS_CACHE_SIZE = 32  # image layouts whose token mask and position embedding are kept, a handful per camera
+
 class FrozenBatchNorm2d(torch.nn.Module):
     """
     BatchNorm2d where the batch statistics and the affine parameters are fixed.
@@ -51,6 +52,7 @@ class BackboneBase(nn.Module):
 
     def __init__(self, d_model:int, name:str, backbone: nn.Module, num_channels: int, return_interm_layers: bool):
         super().__init__()
+        from torchvision.models._utils import IntermediateLayerGetter
         for name, parameter in backbone.named_parameters():
             if 'layer2' not in name and 'layer3' not in name and 'layer4' not in name:
                 parameter.requires_grad_(False)
@@ -62,29 +64,91 @@ class BackboneBase(nn.Module):
         self.num_channels = num_channels
         self.proj = nn.Conv2d(num_channels, d_model, 1)
         self.position_embedding = PositionEmbeddingSine(d_model//2, normalize=True)
+        # (token mask, position embedding) of the last POS_CACHE_SIZE layouts, see cached_mask_and_pos
+        self.pos_cache = OrderedDict()
 
-    def forward(self, xs, m=None, end_points=None):
+    def forward(self, xs, m=None, end_points=None, layout=None):
+        """layout: optional names of the image masks (strings), the key of cached_mask_and_pos"""
         if end_points is None:
             end_points = {}
         x = self.body(xs)['0']
         if m is None:
             m = torch.ones([x.shape[0], x.shape[2], x.shape[3]], dtype=bool, device=x.device)
-        mask = F.interpolate(m[None].float(), size=x.shape[-2:]).to(torch.bool)[0]
+            layout = None
         x = self.proj(x)
-        pos = self.position_embedding(x, mask)
+        if layout is None:
+            mask, pos = self.mask_and_pos(x, m)
+        else:
+            mask, pos = self.cached_mask_and_pos(x, m, layout)
         B, C, W, H = x.shape
         end_points['image_feature'] = x.view(B, C, -1)
         end_points['img_mask'] = mask.view(B, -1)
         end_points['img_pos'] = pos.view(B, C, -1)
         return end_points
 
+    def mask_and_pos(self, x, m):
+        """The (B, h, w) token mask of the (B, H, W) image mask m for the features x, and their position embedding."""
+        mask = F.interpolate(m[None].float(), size=x.shape[-2:]).to(torch.bool)[0]
+        return mask, self.position_embedding(x, mask)
+
+    def cached_mask_and_pos(self, x, m, layout):
+        """
+        The token mask and position embedding of each image, looked up by the
+        name of its mask. Both depend on the mask alone, and the letterbox
+        masks of a camera are all the same: the datasets name them on the host
+        (strefer_utils.letterbox_key), so a known layout costs a lookup and its
+        mask is never read back from the device. Every distinct new layout of
+        the batch is computed once, least recently used out first. The key also
+        holds the canvas and feature map sizes, the device, the dtype and the
+        embedding parameters, changing any of them misses the old entries.
+        """
+        embedding = self.position_embedding
+        config = (tuple(m.shape[-2:]), tuple(x.shape[-2:]), x.device, x.dtype,
+                  embedding.num_pos_feats, embedding.temperature, embedding.normalize, embedding.scale)
+        keys = [(name,) + config for name in layout]
+        missing = {}
+        for i, key in enumerate(keys):
+            if key not in self.pos_cache:
+                missing.setdefault(key, i)
+        if missing:
+            inds = list(missing.values())
+            for key, mask, pos in zip(missing, *self.mask_and_pos(x[inds], m[inds])):
+                self.pos_cache[key] = (mask, pos.contiguous())
+        for key in keys:
+            self.pos_cache.move_to_end(key)
+        masks, pos = zip(*[self.pos_cache[key] for key in keys])
+        masks, pos = torch.stack(masks), torch.stack(pos)
+        while len(self.pos_cache) > POS_CACHE_SIZE:
+            self.pos_cache.popitem(last=False)
+        return masks, pos
+
+
+def pack_image_tokens(end_points):
+    """
+    Drop the letterbox padding tokens of the backbone output: the valid tokens
+    of every image move to the front, in raster order, and the token axis is
+    cut to the longest image. Attention masks the padding tokens out anyway,
+    so the model computes the same, over fewer tokens. The kept (B, T) raster
+    positions are in end_points['img_token_inds'].
+    """
+    mask = end_points['img_mask']  # (B, N), True for the image
+    num_tokens = int(mask.sum(1).max())
+    inds = torch.argsort((~mask).to(torch.uint8), dim=1, stable=True)[:, :num_tokens]
+    for key in ('image_feature', 'img_pos'):
+        value = end_points[key]  # (B, C, N)
+        end_points[key] = value.gather(2, inds.unsqueeze(1).expand(-1, value.shape[1], -1))
+    end_points['img_mask'] = mask.gather(1, inds)
+    end_points['img_token_inds'] = inds
+    return end_points
+
 
 class VisualBackbone(BackboneBase):
     """ResNet backbone with frozen BatchNorm."""
-    def __init__(self, d_model, name='resnet34', return_interm_layers=False, dilation=False):
+    def __init__(self, d_model, name='resnet34', return_interm_layers=False, dilation=False, pretrained=True):
+        import torchvision
         backbone = getattr(torchvision.models, name)(
             replace_stride_with_dilation=[False, False, dilation],
-            pretrained=True, norm_layer=FrozenBatchNorm2d)
+            pretrained=pretrained, norm_layer=FrozenBatchNorm2d)
             # pretrained=is_main_process(), norm_layer=FrozenBatchNorm2d)
         num_channels = backbone.fc.in_features
         super().__init__(d_model, name, backbone, num_channels, return_interm_layers)
@@ -0,0 +1,142 @@
+''' Testing image token packing (the same fusion and cross encoding over the valid tokens) and the layout cache. '''
+
+import os
+import sys
+
+import torch
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from models.encoder_decoder_layers import BiEncoderLayer, ImageMultiCALayer
+from models.image_backbone_module import POS_CACHE_SIZE, VisualBackbone, pack_image_tokens
+from utils.strefer_utils import letterbox_key, letterbox_mask
+
+D_MODEL = 288
+
+
+def backbone_outputs(canvas=384, pads=((0, 168), (0, 168), (128, 0), (0, 168))):
+    """The backbone end points of four letterboxed images (two samples of two frames)."""
+    torch.manual_seed(0)
+    backbone = VisualBackbone(D_MODEL, pretrained=False).eval()
+    mask = torch.stack([torch.from_numpy(letterbox_mask((canvas, canvas), *pad).copy()) for pad in pads])
+    with torch.no_grad():
+        return backbone(torch.rand(len(pads), 3, canvas, canvas) * mask[:, None], mask)
+
+
+def test_pack_image_tokens():
+    full = backbone_outputs()
+    packed = pack_image_tokens(dict(full))
+    counts = full['img_mask'].sum(1)
+    assert packed['image_feature'].shape == (4, D_MODEL, int(counts.max())) and counts.max() < 144
+    for i in range(4):
+        inds = packed['img_token_inds'][i]
+        valid = full['img_mask'][i].nonzero().squeeze(1)
+        assert torch.equal(inds[:len(valid)], valid)
+        assert torch.equal(packed['img_mask'][i], torch.arange(len(inds)) < len(valid))
+        assert torch.equal(packed['image_feature'][i], full['image_feature'][i][:, inds])
+        assert torch.equal(packed['img_pos'][i], full['img_pos'][i][:, inds])
+
+
+def fuse_and_encode(end_points, fuser, encoder, points):
+    """The image multi-fuser and a cross encoder layer, as WildRefer runs them on the backbone outputs."""
+    B, K = 2, 2
+    feature = end_points['image_feature'].view(B, K, D_MODEL, -1)
+    pos = end_points['img_pos'].view(B, K, D_MODEL, -1)
+    mask = ~end_points['img_mask'].view(B, K, -1)
+    image = fuser(query=feature[:, 0].transpose(1, 2), key=feature.transpose(-1, -2),
+                  value=feature.transpose(-1, -2), query_pos=pos[:, 0], key_pos=pos,
+                  multi_mask=torch.ones(B, K), key_mask=mask).transpose(1, 2)
+    vis_feats, text_feats = encoder(points['vis_feats'], points['pos_feats'], points['padding_mask'],
+                                    points['text_feats'], points['text_padding_mask'], {},
+                                    enhanced_feats=image, enhanced_mask=mask[:, 0])
+    return image, vis_feats, text_feats
+
+
+def test_packed_attention():
+    """Packing only drops masked keys, and queries nothing reads."""
+    full = backbone_outputs()
+    packed = pack_image_tokens(dict(full))
+    torch.manual_seed(0)
+    fuser = ImageMultiCALayer(D_MODEL, n_heads=8, dim_feedforward=256, frame_num=2).eval()
+    encoder = BiEncoderLayer(D_MODEL, n_heads=8, dim_feedforward=256, use_img_enc_attn=True).eval()
+    points = {'vis_feats': torch.randn(2, 64, D_MODEL), 'pos_feats': torch.randn(2, 64, D_MODEL),
+              'padding_mask': torch.zeros(2, 64, dtype=torch.bool), 'text_feats': torch.randn(2, 10, D_MODEL),
+              'text_padding_mask': torch.zeros(2, 10, dtype=torch.bool)}
+    with torch.no_grad():
+        image, vis_feats, text_feats = fuse_and_encode(full, fuser, encoder, points)
+        packed_image, packed_vis_feats, packed_text_feats = fuse_and_encode(packed, fuser, encoder, points)
+    assert torch.allclose(packed_vis_feats, vis_feats, atol=1e-5)
+    assert torch.allclose(packed_text_feats, text_feats, atol=1e-5)
+    for b in range(2):
+        frame = 2 * b
+        valid = packed['img_mask'][frame]
+        inds = packed['img_token_inds'][frame][valid]
+        assert torch.allclose(packed_image[b][valid], image[b][inds], atol=1e-5)
+
+
+def letterbox(pads, canvas=(384, 384)):
+    """(N, H, W) image masks of letterboxes and their layout names."""
+    mask = torch.stack([torch.from_numpy(letterbox_mask(canvas, *pad).copy()) for pad in pads])
+    return mask, [letterbox_key(canvas, *pad) for pad in pads]
+
+
+def test_cached_mask_and_pos():
+    torch.manual_seed(0)
+    backbone = VisualBackbone(D_MODEL, pretrained=False).eval()
+    mask, layout = letterbox([(0, 168), (0, 168), (128, 0), (0, 168), (128, 0), (0, 0)])
+    image = torch.rand(len(mask), 3, 384, 384) * mask[:, None]
+    calls = []
+    embedding = backbone.position_embedding.forward
+    backbone.position_embedding.forward = lambda x, mask: calls.append(len(mask)) or embedding(x, mask)
+    with torch.no_grad():
+        reference = backbone(image, mask)
+        for _ in range(2):
+            cached = backbone(image, mask, layout=layout)
+            for key in ('image_feature', 'img_mask', 'img_pos'):
+                assert torch.equal(cached[key], reference[key])
+    # one embedding per distinct layout, the other frames and the next batches share it
+    assert calls == [6, 3] and len(backbone.pos_cache) == 3
+
+    # a known layout never reads its mask back: here the mask has no data at all
+    x = torch.zeros(len(mask), D_MODEL, 12, 12)
+    token_mask, pos = backbone.cached_mask_and_pos(x, mask.to('meta'), layout)
+    assert torch.equal(token_mask.flatten(1), reference['img_mask'])
+    assert torch.equal(pos.flatten(2), reference['img_pos'])
+
+    # bounded, least recently used out
+    many, names = letterbox([(1, i) for i in range(POS_CACHE_SIZE + 2)])
+    x = torch.zeros(len(many), D_MODEL, 12, 12)
+    token_mask, pos = backbone.cached_mask_and_pos(x, many, names)
+    assert len(backbone.pos_cache) == POS_CACHE_SIZE
+    assert all(torch.equal(a, b) for a, b in zip((token_mask, pos), backbone.mask_and_pos(x, many)))
+    calls.clear()
+    backbone.cached_mask_and_pos(x[:2], many[-2:], names[-2:])
+    backbone.cached_mask_and_pos(x[:1], mask[:1], layout[:1])
+    assert calls == [1]
+    # another dtype or other parameters miss the old entries
+    backbone.cached_mask_and_pos(x[:1].double(), mask[:1], layout[:1])
+    backbone.position_embedding.temperature = 100
+    _, pos = backbone.cached_mask_and_pos(x[:1], mask[:1], layout[:1])
+    assert calls == [1, 1, 1] and torch.equal(pos, backbone.mask_and_pos(x[:1], mask[:1])[1])
+
+
+def test_cached_mask_and_pos_no_sync():
+    """On the GPU a batch of known layouts runs without a device to host sync."""
+    if not torch.cuda.is_available():
+        return
+    backbone = VisualBackbone(D_MODEL, pretrained=False).cuda().eval()
+    mask, layout = letterbox([(0, 168), (128, 0)])
+    x, mask = torch.zeros(2, D_MODEL, 12, 12, device='cuda'), mask.cuda()
+    backbone.cached_mask_and_pos(x, mask, layout)
+    torch.cuda.set_sync_debug_mode('error')
+    try:
+        backbone.cached_mask_and_pos(x, mask, layout[::-1])
+    finally:
+        torch.cuda.set_sync_debug_mode('default')
+
+
+if __name__ == '__main__':
+    test_pack_image_tokens()
+    test_packed_attention()
+    test_cached_mask_and_pos()
+    test_cached_mask_and_pos_no_sync()
@@ -0,0 +1,167 @@
+"""
+Inference-time rewrites of a trained model.
+
+optimize_for_inference folds every batch norm (nn.BatchNorm*, FrozenBatchNorm2d
+and the pointnet2 BatchNorm wrappers) into the conv / linear layer that feeds
+it, drops the dropout layers and lets the ReLU right after a conv or linear
+layer run in place. The folded model computes the same function with fewer
+kernels and allocations; its state dict no longer matches the checkpoint, so
+it is only meant for evaluation, never for saving.
+"""
+import copy
+
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_weights, fuse_linear_bn_weights
+
+from .image_backbone_module import FrozenBatchNorm2d
+
+FOLDABLE = (nn.Conv1d, nn.Conv2d, nn.Conv3d, nn.Linear)
+BATCH_NORMS = (nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d, FrozenBatchNorm2d)
+
+
+def _batch_norm(module):
+    """The batch norm `module` applies, unwrapping pointnet2's single-child Sequentials, or None."""
+    if isinstance(module, nn.Sequential) and len(module) == 1:
+        module = module[0]
+    if isinstance(module, FrozenBatchNorm2d):
+        return module
+    if isinstance(module, BATCH_NORMS) and module.running_mean is not None:
+        return module
+    return None
+
+
+def _fold(layer, bn):
+    """Fold `bn` into the weights of `layer`, in place."""
+    if isinstance(bn, FrozenBatchNorm2d):
+        eps = 1e-5  # as in FrozenBatchNorm2d.forward
+    else:
+        eps = bn.eps
+    weight = bn.weight if bn.weight is not None else torch.ones_like(bn.running_var)
+    bias = bn.bias if bn.bias is not None else torch.zeros_like(bn.running_mean)
+    if isinstance(layer, nn.Linear):
+        w, b = fuse_linear_bn_weights(layer.weight, layer.bias, bn.running_mean, bn.running_var, eps, weight, bias)
+    else:
+        w, b = fuse_conv_bn_weights(layer.weight, layer.bias, bn.running_mean, bn.running_var, eps, weight, bias)
+    layer.weight = nn.Parameter(w.detach(), requires_grad=False)
+    layer.bias = nn.Parameter(b.detach(), requires_grad=False)
+
+
+def _remove(parent, name):
+    """Drop child `name`: out of a Sequential, replaced by an Identity anywhere else."""
+    if isinstance(parent, nn.Sequential):
+        del parent._modules[name]
+    else:
+        setattr(parent, name, nn.Identity())
+
+
+def _check_fold(layer, bn, atol):
+    """Compare layer -> bn with the folded copy of layer on a random input."""
+    if isinstance(layer, nn.Linear):
+        x = torch.randn(4, layer.in_features)
+    else:
+        spatial = [2 * k + 8 for k in layer.kernel_size]
+        x = torch.randn(2, layer.in_channels, *spatial)
+    x = x.to(layer.weight.device)
+    folded = copy.deepcopy(layer)
+    _fold(folded, bn)
+    reference = bn(layer(x))
+    error = (folded(x) - reference).abs().max().item()
+    scale = reference.abs().max().item()
+    if error > atol * max(scale, 1.):
+        raise RuntimeError(f'folding {bn} into {layer} changes its output by {error:.3g}')
+
+
+def fold_batch_norms(model, check=True, atol=1e-3):
+    """
+    Fold every batch norm that directly follows a conv / linear layer of the
+    same parent into that layer's weights and remove it. Layers are paired in
+    registration order, which is their call order throughout this repo
+    (torchvision ResNet, pointnet2 SharedMLP, the heads in models/modules.py);
+    with `check` every fold is compared against the unfolded pair first.
+    Returns the number of folded batch norms.
+    """
+    count = 0
+    for parent in list(model.modules()):
+        children = list(parent.named_children())
+        for (_, layer), (name, module) in zip(children, children[1:]):
+            bn = _batch_norm(module)
+            if not isinstance(layer, FOLDABLE) or bn is None:
+                continue
+            out_features = layer.out_features if isinstance(layer, nn.Linear) else layer.out_channels
+            if bn.running_mean.numel() != out_features:
+                continue
+            if check:
+                _check_fold(layer, bn, atol)
+            _fold(layer, bn)
+            _remove(parent, name)
+            count += 1
+    return count
+
+
+def remove_dropout(model):
+    """Remove the dropout layers, which are the identity in eval mode. Returns how many."""
+    count = 0
+    for parent in list(model.modules()):
+        for name, module in list(parent.named_children()):
+            if isinstance(module, nn.modules.dropout._DropoutNd):
+                _remove(parent, name)
+                count += 1
+    return count
+
+
+def inplace_relus(model):
+    """
+    Make a ReLU run in place when it follows a conv / linear layer in a
+    Sequential, whose fresh output nothing else holds. Returns how many.
+    """
+    count = 0
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        for layer, relu in zip(module, list(module)[1:]):
+            if isinstance(layer, FOLDABLE) and isinstance(relu, nn.ReLU) and not relu.inplace:
+                relu.inplace = True
+                count += 1
+    return count
+
+
+def _max_difference(a, b):
+    """Largest difference between the tensors of two (nested) outputs, relative to values above 1."""
+    if isinstance(a, torch.Tensor):
+        if not a.is_floating_point():
+            return 0. if torch.equal(a, b) else float('inf')
+        if not a.numel():
+            return 0.
+        return ((a - b).abs() / a.abs().clamp(min=1)).max().item()
+    if isinstance(a, dict):
+        return max([_max_difference(a[k], b[k]) for k in a], default=0.)
+    if isinstance(a, (list, tuple)):
+        return max([_max_difference(x, y) for x, y in zip(a, b)], default=0.)
+    return 0.
+
+
+@torch.no_grad()
+def optimize_for_inference(model, example_inputs=None, check=True, atol=1e-3):
+    """
+    Rewrite `model` in place for evaluation (it is left in eval mode) and
+    return the number of folded batch norms, removed dropouts and in-place
+    ReLUs.
+
+    With `check`, every batch-norm fold is verified on a random input, and
+    when `example_inputs` (a tuple of forward arguments) are given, the
+    outputs of the whole model on them are compared with those of an
+    untouched copy; a difference above `atol` raises a RuntimeError.
+    """
+    model.eval()
+    reference = None
+    if check and example_inputs is not None:
+        reference = model(*copy.deepcopy(example_inputs))
+    folded = fold_batch_norms(model, check=check, atol=atol)
+    dropped = remove_dropout(model)
+    relus = inplace_relus(model)
+    if reference is not None:
+        error = _max_difference(reference, model(*copy.deepcopy(example_inputs)))
+        if error > atol:
+            raise RuntimeError(f'the optimized model differs from the original by {error:.3g}')
+    return {'batch_norms': folded, 'dropouts': dropped, 'relus': relus}
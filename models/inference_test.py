@@ -0,0 +1,89 @@
+''' Testing that the inference-time folding keeps the outputs of the model's building blocks. '''
+
+import os
+import sys
+
+import torch
+from torch import nn
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from models.image_backbone_module import FrozenBatchNorm2d, VisualBackbone
+from models.inference import BATCH_NORMS, optimize_for_inference
+from models.modules import PointsObjClsModule, PositionEmbeddingLearned, ThreeLayerMLP
+from pointnet2.pytorch_utils import SharedMLP
+
+
+def randomize_batch_norms(module, seed=0):
+    """Trained-looking statistics, the defaults would make every fold a no-op."""
+    g = torch.Generator().manual_seed(seed)
+    for m in module.modules():
+        if isinstance(m, BATCH_NORMS):
+            n = m.running_mean.numel()
+            m.running_mean.copy_(torch.rand(n, generator=g) - 0.5)
+            m.running_var.copy_(torch.rand(n, generator=g) + 0.5)
+            with torch.no_grad():
+                m.weight.copy_(torch.rand(n, generator=g) + 0.5)
+                m.bias.copy_(torch.rand(n, generator=g) - 0.5)
+    return module
+
+
+def check_parity(module, *inputs, batch_norms, dropouts=0):
+    module = randomize_batch_norms(module).eval()
+    with torch.no_grad():
+        expected = module(*inputs)
+    counts = optimize_for_inference(module, inputs)
+    assert counts['batch_norms'] == batch_norms and counts['dropouts'] == dropouts
+    assert not any(isinstance(m, (nn.Dropout,) + BATCH_NORMS) for m in module.modules())
+    with torch.no_grad():
+        assert torch.allclose(module(*inputs), expected, rtol=1e-4, atol=1e-4)
+
+
+def test_heads():
+    check_parity(ThreeLayerMLP(288, 3), torch.randn(2, 288, 64), batch_norms=2, dropouts=2)
+    check_parity(PointsObjClsModule(288), torch.randn(2, 288, 64), batch_norms=2)
+    check_parity(PositionEmbeddingLearned(3, 288), torch.randn(2, 64, 3), batch_norms=1)
+
+
+def test_shared_mlp():
+    check_parity(SharedMLP([6, 64, 128], bn=True), torch.randn(2, 6, 64, 16), batch_norms=2)
+
+
+def test_frozen_batch_norm_resnet():
+    backbone = VisualBackbone(288, name='resnet18', pretrained=False)
+    assert any(isinstance(m, FrozenBatchNorm2d) for m in backbone.modules())
+    module = randomize_batch_norms(backbone).eval()
+    image = torch.randn(1, 3, 96, 96)
+    with torch.no_grad():
+        expected = module(image)['image_feature']
+    assert optimize_for_inference(module, (image,))['batch_norms'] == 20
+    with torch.no_grad():
+        assert torch.allclose(module(image)['image_feature'], expected, rtol=1e-3, atol=1e-3)
+
+
+class NormFirst(nn.Module):
+    """Registers conv before bn but applies bn first, so the pair must not be folded."""
+
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv1d(8, 8, 1)
+        self.bn = nn.BatchNorm1d(8)
+
+    def forward(self, x):
+        return self.conv(self.bn(x))
+
+
+def test_parity_check_catches_wrong_fold():
+    module = randomize_batch_norms(NormFirst()).eval()
+    try:
+        optimize_for_inference(module, (torch.randn(2, 8, 4),))
+    except RuntimeError:
+        return
+    raise AssertionError('the folded model was accepted')
+
+
+if __name__ == '__main__':
+    test_heads()
+    test_shared_mlp()
+    test_frozen_batch_norm_resnet()
+    test_parity_check_catches_wrong_fold()
@@ -213,6 +213,17 @@ def compute_points_obj_cls_loss_hard_topk(end_points, topk):
     return objectness_loss
 
 
+def compute_seed_relevance_loss(end_points):
+    """Balanced BCE of the seed relevance logits, the seeds inside the referred box are relevant."""
+    seed_inds = end_points['seed_inds'].long()  # B, K
+    seed_logits = end_points['seed_relevance_logits']  # B, K
+    relevant = (torch.gather(end_points['point_instance_label'], 1, seed_inds) >= 0).float()
+    loss = F.binary_cross_entropy_with_logits(seed_logits, relevant, reduction='none')
+    positives = (loss * relevant).sum(1) / relevant.sum(1).clamp(min=1)
+    negatives = (loss * (1 - relevant)).sum(1) / (1 - relevant).sum(1).clamp(min=1)
+    return ((positives + negatives) / 2).mean()
+
+
 class HungarianMatcher(nn.Module):
     """
     Assign targets to predictions.
@@ -526,7 +537,9 @@ class SetCriterion(nn.Module):
             device=next(iter(outputs.values())).device
         )
         if is_dist_avail_and_initialized():
+            # DDP averages the gradients over the processes, so normalize by the mean count, not the total
             torch.distributed.all_reduce(num_boxes)
+            num_boxes = num_boxes / dist.get_world_size()
 
         # Compute all the requested losses
         losses = {}
@@ -593,9 +606,15 @@ def compute_hungarian_loss(end_points, num_decoder_layers, set_criterion,
     else:
         query_points_generation_loss = 0.0
 
+    if 'seed_relevance_logits' in end_points:
+        seed_relevance_loss = compute_seed_relevance_loss(end_points)
+    else:
+        seed_relevance_loss = 0.0
+
     # loss
     loss = (
         8 * query_points_generation_loss
+        + seed_relevance_loss
         + 1.0 / (num_decoder_layers + 1) * (
             loss_ce
             + 5 * loss_bbox
@@ -607,6 +626,7 @@ def compute_hungarian_loss(end_points, num_decoder_layers, set_criterion,
     end_points['loss_bbox'] = loss_bbox
     end_points['loss_giou'] = loss_giou
     end_points['query_points_generation_loss'] = query_points_generation_loss
+    end_points['seed_relevance_loss'] = seed_relevance_loss
     end_points['loss_constrastive_align'] = loss_contrastive_align
     end_points['loss'] = loss
     return loss, end_points
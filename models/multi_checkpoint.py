@@ -0,0 +1,128 @@
+"""
+Evaluation of several checkpoints of one architecture in a single data pass.
+
+The frozen parts of WildRefer (RoBERTa, the ResNet stem, and the backbones
+of runs trained with lr_backbone 0) hold the same weights in every
+checkpoint, and they only see the batch inputs, so their outputs are the
+same for every checkpoint too. MultiCheckpointModel makes the replicas share
+one instance of each such module, which computes once per batch and hands
+the cached output to the other replicas; the trainable modules run per
+checkpoint.
+
+Sharing follows SHARED_CHAINS, the modules in the order they consume each
+other's outputs: a module is shared when its weights are equal in all
+checkpoints and every module before it in its chain is shared, i.e. its
+inputs are the same for all replicas as well. Parameterless modules
+(ReLU, max pooling) are shared along with the chain.
+"""
+import copy
+
+import torch
+from torch import nn
+
+SHARED_CHAINS = (
+    ('text_encoder',),
+    ('point_backbone_net.sa1', 'point_backbone_net.sa2', 'point_backbone_net.sa3', 'point_backbone_net.sa4',
+     'point_backbone_net.fp1', 'point_backbone_net.fp2'),
+    tuple(f'image_backbone_net.body.{name}' for name in
+          ('conv1', 'bn1', 'relu', 'maxpool', 'layer1', 'layer2', 'layer3', 'layer4')) + ('image_backbone_net.proj',),
+)
+
+
+def _fresh(output):
+    """Callers may add keys to a returned dict (the backbones' end_points), give each its own."""
+    return copy.copy(output) if isinstance(output, dict) else output
+
+
+class SharedModule(nn.Module):
+    """A module several replicas call with the same inputs: the first call after reset() computes, the others reuse."""
+
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+        self.output = None
+
+    def reset(self):
+        self.output = None
+
+    def forward(self, *args, **kwargs):
+        if self.output is None:
+            self.output = self.module(*args, **kwargs)
+        return _fresh(self.output)
+
+
+class SharedTokenizer:
+    """The tokenizer of the replicas, tokenizing the texts of a batch once."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.output = None
+
+    def reset(self):
+        self.output = None
+
+    def batch_encode_plus(self, *args, **kwargs):
+        if self.output is None:
+            self.output = self.tokenizer.batch_encode_plus(*args, **kwargs)
+        return self.output
+
+    def __getattr__(self, name):
+        return getattr(self.tokenizer, name)
+
+
+def _same_weights(models, name):
+    try:
+        states = [model.get_submodule(name).state_dict() for model in models]
+    except AttributeError:
+        return False
+    return all(state.keys() == states[0].keys() and all(torch.equal(state[k], states[0][k]) for k in state)
+               for state in states[1:])
+
+
+def share_frozen_modules(models, chains=SHARED_CHAINS):
+    """Replace the modules that are equal in all `models` by one SharedModule. Returns their names."""
+    shared = []
+    for chain in chains:
+        for name in chain:
+            if not _same_weights(models, name):
+                break
+            module = SharedModule(models[0].get_submodule(name))
+            for model in models:
+                model.set_submodule(name, module)
+            shared.append(name)
+    return shared
+
+
+class MultiCheckpointModel(nn.Module):
+    """
+    Replicas of one architecture with different weights, evaluated together:
+    forward(inputs) returns the end_points of every replica on the batch.
+    Only meant for evaluation under torch.no_grad(); the shared outputs are
+    cached for the whole batch.
+    """
+
+    def __init__(self, models):
+        super().__init__()
+        self.models = nn.ModuleList(models)
+        self.shared = share_frozen_modules(models)
+        tokenizer = getattr(models[0], 'tokenizer', None)
+        if tokenizer is not None:
+            tokenizer = SharedTokenizer(tokenizer)
+            for model in models:
+                model.tokenizer = tokenizer
+
+    def reset(self):
+        for module in self.modules():
+            if isinstance(module, SharedModule):
+                module.reset()
+        tokenizer = getattr(self.models[0], 'tokenizer', None)
+        if isinstance(tokenizer, SharedTokenizer):
+            tokenizer.reset()
+
+    def forward(self, inputs):
+        self.reset()
+        try:
+            return [model(inputs) for model in self.models]
+        finally:
+            # do not keep the activations of the batch alive until the next one
+            self.reset()
@@ -0,0 +1,107 @@
+''' Testing that checkpoints evaluated together share their frozen modules and still give their own outputs. '''
+
+import copy
+import os
+import sys
+
+import torch
+from torch import nn
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from models.image_backbone_module import VisualBackbone
+from models.multi_checkpoint import SHARED_CHAINS, MultiCheckpointModel, share_frozen_modules
+from models.point_backbone_module import Pointnet2Backbone
+
+
+def count_calls(module):
+    calls = []
+    module.register_forward_hook(lambda *_: calls.append(1))
+    return calls
+
+
+class Holder(nn.Module):
+    def __init__(self, **modules):
+        super().__init__()
+        for name, module in modules.items():
+            setattr(self, name, module)
+
+
+def test_image_backbone_shares_the_equal_prefix():
+    torch.manual_seed(0)
+    first = VisualBackbone(32, pretrained=False).eval()
+    second = copy.deepcopy(first)
+    with torch.no_grad():
+        second.body.layer3[0].conv1.weight.mul_(1.1)
+    image, mask = torch.rand(2, 3, 96, 128), torch.ones(2, 96, 128, dtype=torch.bool)
+    with torch.no_grad():
+        expected = [first(image, mask), second(image, mask)]
+    models = [Holder(image_backbone_net=copy.deepcopy(m)) for m in (first, second)]
+    shared = share_frozen_modules(models, chains=SHARED_CHAINS[2:])
+    assert shared == [f'image_backbone_net.body.{n}' for n in ('conv1', 'bn1', 'relu', 'maxpool', 'layer1', 'layer2')]
+    calls = count_calls(models[0].image_backbone_net.body.conv1.module)
+    models[0].image_backbone_net.body.conv1.reset()
+    with torch.no_grad():
+        outputs = [m.image_backbone_net(image, mask) for m in models]
+    assert len(calls) == 1
+    for out, ref in zip(outputs, expected):
+        assert torch.equal(out['image_feature'], ref['image_feature'])
+    assert not torch.equal(outputs[0]['image_feature'], outputs[1]['image_feature'])
+
+
+class ToyReferrer(nn.Module):
+    """A frozen text encoder and tokenizer, and a trainable point backbone and head."""
+
+    def __init__(self, tokenizer):
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.text_encoder = nn.Linear(4, 8)
+        self.point_backbone_net = Pointnet2Backbone(input_feature_dim=0)
+        self.head = nn.Linear(8, 1)
+
+    def forward(self, inputs):
+        tokens = self.tokenizer.batch_encode_plus(inputs['text'])
+        end_points = self.point_backbone_net(inputs['point_clouds'], end_points={})
+        end_points['score'] = self.head(self.text_encoder(tokens)).sum() + end_points['fp2_features'].mean()
+        return end_points
+
+
+class CountingTokenizer:
+    def __init__(self):
+        self.calls = 0
+
+    def batch_encode_plus(self, texts):
+        self.calls += 1
+        return torch.tensor([[len(t), 1., 2., 3.] for t in texts])
+
+
+def test_multi_checkpoint_model():
+    torch.manual_seed(0)
+    tokenizer = CountingTokenizer()
+    models = [ToyReferrer(tokenizer).eval()]
+    models.append(copy.deepcopy(models[0]))
+    models[1].tokenizer = tokenizer
+    with torch.no_grad():
+        models[1].head.weight.mul_(2)
+    inputs = {'text': ['a man', 'the red car'], 'point_clouds': torch.rand(2, 2048, 3) * 4}
+    with torch.no_grad():
+        expected = [m(inputs)['score'] for m in models]
+    tokenizer.calls = 0
+    model = MultiCheckpointModel(models)
+    assert model.shared == ['text_encoder'] + [f'point_backbone_net.{n}' for n in
+                                               ('sa1', 'sa2', 'sa3', 'sa4', 'fp1', 'fp2')]
+    calls = count_calls(models[0].point_backbone_net.sa1.module)
+    with torch.no_grad():
+        for _ in range(2):
+            outputs = model(inputs)
+    assert tokenizer.calls == 2 and len(calls) == 2
+    for out, score in zip(outputs, expected):
+        assert torch.allclose(out['score'], score)
+    # every replica gets its own end_points dict
+    assert outputs[0] is not outputs[1] and 'score' in outputs[0]
+    assert outputs[0]['fp2_features'] is outputs[1]['fp2_features']
+
+
+if __name__ == '__main__':
+    test_image_backbone_shares_the_equal_prefix()
+    test_multi_checkpoint_model()
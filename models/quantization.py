@@ -0,0 +1,225 @@
+"""
+Int8 variants of a trained WildRefer for CPU serving.
+
+quantize_dynamic_model stores the weights of the text encoder, the text
+projector, the attention / FFN projections of the fusion encoder, the
+multi-frame fusers and the decoder, and the contrastive projections as int8;
+their activations are quantized on the fly, so it needs no calibration.
+nn.MultiheadAttention keeps its q/k/v projections in one parameter that
+quantize_dynamic leaves alone, so every instance is first swapped for a
+LinearMultiheadAttention holding them as nn.Linear.
+
+quantize_static_backbones additionally quantizes the convolutions of the
+ResNet body and of the pointnet2 SharedMLPs, weights and activations, from
+the ranges observed on a few calibration batches.
+
+Both use torch.ao.quantization, whose quantized kernels are CPU-only.
+"""
+import io
+import warnings
+from contextlib import contextmanager
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from .inference import fold_batch_norms, optimize_for_inference
+
+# submodules of WildRefer whose nn.Linear layers are quantized dynamically
+DYNAMIC_MODULES = ('text_encoder', 'text_projector', 'cross_encoder_text_points', 'multi_fuser',
+                   'image_multi_fuser', 'decoder', 'contrastive_align_projection_image',
+                   'contrastive_align_projection_text')
+MODES = ('dynamic', 'static')
+
+
+@contextmanager
+def _quiet():
+    # torch.ao.quantization warns that it moves to torchao, which is not a dependency here
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        warnings.filterwarnings('ignore', message='.*quantize_per_tensor.*')
+        warnings.filterwarnings('ignore', message='.*quant_min and quant_max.*')
+        yield
+
+
+class LinearMultiheadAttention(nn.Module):
+    """
+    nn.MultiheadAttention (sequence first, equal q/k/v sizes, no bias_k/v)
+    with its input projections as three nn.Linear. Returns (output, None):
+    the attention weights are never used in this repo.
+    """
+
+    def __init__(self, attention):
+        super().__init__()
+        assert attention._qkv_same_embed_dim and not attention.batch_first
+        assert attention.bias_k is None and not attention.add_zero_attn
+        embed_dim = attention.embed_dim
+        self.num_heads = attention.num_heads
+        self.dropout = attention.dropout
+        self.q_proj, self.k_proj, self.v_proj = [nn.Linear(embed_dim, embed_dim) for _ in range(3)]
+        for i, proj in enumerate((self.q_proj, self.k_proj, self.v_proj)):
+            rows = slice(i * embed_dim, (i + 1) * embed_dim)
+            proj.weight.data.copy_(attention.in_proj_weight.data[rows])
+            proj.bias.data.copy_(attention.in_proj_bias.data[rows])
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+        self.out_proj.load_state_dict(attention.out_proj.state_dict())
+
+    def _heads(self, x):
+        L, B, E = x.shape
+        return x.view(L, B, self.num_heads, E // self.num_heads).permute(1, 2, 0, 3)
+
+    def forward(self, query, key, value, key_padding_mask=None, need_weights=True, attn_mask=None):
+        L, B, E = query.shape
+        q, k, v = self._heads(self.q_proj(query)), self._heads(self.k_proj(key)), self._heads(self.v_proj(value))
+        # additive (B, H, L, S) mask, True in the torch masks means "not attended"
+        mask = None
+        if attn_mask is not None:
+            mask = attn_mask if attn_mask.is_floating_point() else \
+                torch.zeros(attn_mask.shape, dtype=q.dtype, device=q.device).masked_fill(attn_mask, float('-inf'))
+            mask = mask.view(B, self.num_heads, L, -1) if mask.dim() == 3 else mask
+        if key_padding_mask is not None:
+            padding = torch.zeros(key_padding_mask.shape, dtype=q.dtype, device=q.device)
+            padding = padding.masked_fill(key_padding_mask, float('-inf'))[:, None, None, :]
+            mask = padding if mask is None else mask + padding
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask,
+                                             dropout_p=self.dropout if self.training else 0.)
+        return self.out_proj(out.permute(2, 0, 1, 3).reshape(L, B, E)), None
+
+
+def swap_multihead_attention(module):
+    """Replace every nn.MultiheadAttention under `module` by a LinearMultiheadAttention. Returns how many."""
+    count = 0
+    for parent in list(module.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, nn.MultiheadAttention):
+                setattr(parent, name, LinearMultiheadAttention(child))
+                count += 1
+    return count
+
+
+@torch.no_grad()
+def quantize_dynamic_model(model, modules=DYNAMIC_MODULES):
+    """Quantize the nn.Linear layers of `modules` of `model` to dynamic int8, in place (eval mode)."""
+    model.eval()
+    for name in modules:
+        module = getattr(model, name, None)
+        if module is None:
+            continue
+        swap_multihead_attention(module)
+        with _quiet():
+            torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def _static_targets(model):
+    """Names of the ResNet body and of every SharedMLP of the point backbone."""
+    # the same module object pointnet2_modules builds its MLPs from (via sys.path, see point_backbone_module)
+    from pytorch_utils import SharedMLP
+    names = ['image_backbone_net.body']
+    names += [f'point_backbone_net.{name}' for name, module in model.point_backbone_net.named_modules()
+              if isinstance(module, SharedMLP)]
+    return names
+
+
+def _prepare_static(model, example_inputs):
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx
+    fold_batch_norms(model.image_backbone_net)
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    with _quiet():
+        for name, inputs in example_inputs.items():
+            model.set_submodule(name, prepare_fx(model.get_submodule(name), qconfig_mapping, example_inputs=inputs))
+
+
+def _convert_static(model, names):
+    from torch.ao.quantization.quantize_fx import convert_fx
+    with _quiet():
+        for name in names:
+            model.set_submodule(name, convert_fx(model.get_submodule(name)))
+
+
+@torch.no_grad()
+def quantize_static_backbones(model, calibration_batches):
+    """
+    Quantize the ResNet body and the pointnet2 SharedMLPs of `model` to
+    static int8 in place, calibrating the activation ranges by running
+    `model` on `calibration_batches` (input dicts as the model takes them).
+    The frozen batch norms are folded first, so FX sees plain conv+ReLU.
+    Returns the input shapes of the quantized modules, which
+    build_quantized needs to rebuild them.
+    """
+    model.eval()
+    # record the inputs of every target on the first batch, FX needs example inputs
+    example_inputs = {}
+    hooks = [model.get_submodule(name).register_forward_pre_hook(
+        lambda module, inputs, name=name: example_inputs.setdefault(name, inputs))
+        for name in _static_targets(model)]
+    model(calibration_batches[0])
+    for hook in hooks:
+        hook.remove()
+    _prepare_static(model, example_inputs)
+    with _quiet():
+        for batch in calibration_batches:
+            model(batch)
+    _convert_static(model, example_inputs)
+    return {name: [list(x.shape) for x in inputs] for name, inputs in example_inputs.items()}
+
+
+def quantize_model(model, mode, calibration_batches=None):
+    """
+    Quantize `model` for CPU serving, in place: with 'static' the backbones
+    first (calibrated on `calibration_batches`), then the remaining batch
+    norms are folded and the linear layers quantized dynamically. Returns the
+    recipe that save_quantized stores.
+    """
+    assert mode in MODES, mode
+    input_shapes = {}
+    if mode == 'static':
+        input_shapes = quantize_static_backbones(model, calibration_batches)
+    optimize_for_inference(model)
+    quantize_dynamic_model(model)
+    return {'mode': mode, 'input_shapes': input_shapes}
+
+
+@torch.no_grad()
+def build_quantized(model, recipe):
+    """Give the float `model` the structure quantize_model gave the model of `recipe`, without calibrating."""
+    model.eval()
+    if recipe['mode'] == 'static':
+        example_inputs = {name: tuple(torch.zeros(shape) for shape in shapes)
+                          for name, shapes in recipe['input_shapes'].items()}
+        _prepare_static(model, example_inputs)
+        _convert_static(model, example_inputs)
+    optimize_for_inference(model, check=False)
+    quantize_dynamic_model(model)
+    return model
+
+
+def serialized_size(model):
+    """Bytes of the state dict of `model` as torch.save writes it."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def save_quantized(model, recipe, path, **meta):
+    """
+    Save a quantized model: its state dict (int8 weights, activation scales)
+    and the recipe to rebuild its structure. Pickling the module itself does
+    not work, FX graphs of quantized modules fail to unpickle.
+    """
+    torch.save(dict(meta, recipe=recipe, model=model.state_dict()), path)
+
+
+def load_quantized(path, model):
+    """
+    Load a model written by save_quantized into `model`, a float model of the
+    same architecture (e.g. create_model(args, pretrained=False)); returns
+    (model, meta).
+    """
+    with _quiet():
+        # packed int8 weights are not plain tensors, weights_only refuses them
+        state = torch.load(path, map_location='cpu', weights_only=False)
+    build_quantized(model, state.pop('recipe'))
+    model.load_state_dict(state.pop('model'))
+    return model, state
@@ -0,0 +1,107 @@
+''' Testing the int8 variants: the attention swap is exact, the quantized parts stay close to float. '''
+
+import os
+import sys
+import tempfile
+
+import torch
+from torch import nn
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from models.encoder_decoder_layers import BiDecoderLayer
+from models.image_backbone_module import VisualBackbone
+from models.point_backbone_module import Pointnet2Backbone
+from models.quantization import (LinearMultiheadAttention, load_quantized, quantize_dynamic_model, quantize_model,
+                                 save_quantized, serialized_size)
+
+
+def relative_error(a, b):
+    return ((a - b).norm() / b.norm()).item()
+
+
+def test_linear_multihead_attention():
+    torch.manual_seed(0)
+    attention = nn.MultiheadAttention(64, 4).eval()
+    swapped = LinearMultiheadAttention(attention).eval()
+    query, key = torch.randn(5, 2, 64), torch.randn(7, 2, 64)
+    key_padding_mask = torch.zeros(2, 7, dtype=torch.bool)
+    key_padding_mask[0, 5:] = True
+    attn_mask = torch.zeros(5, 7, dtype=torch.bool)
+    attn_mask[0, 1] = True
+    with torch.no_grad():
+        expected = attention(query, key, key, key_padding_mask=key_padding_mask, attn_mask=attn_mask)[0]
+        out = swapped(query, key, key, key_padding_mask=key_padding_mask, attn_mask=attn_mask)[0]
+    assert torch.allclose(out, expected, atol=1e-5)
+
+
+class Decoder(nn.Module):
+    """The decoder and a contrastive projection, under their WildRefer names."""
+
+    def __init__(self):
+        super().__init__()
+        self.decoder = nn.ModuleList([BiDecoderLayer(288, n_heads=8, dim_feedforward=256, dropout=0.1,
+                                                     self_position_embedding='loc_learned')])
+        self.contrastive_align_projection_text = nn.Sequential(nn.Linear(288, 288), nn.ReLU(), nn.Linear(288, 64))
+
+    def forward(self, query, vis_feats, lang_feats, query_pos, text_mask):
+        query = self.decoder[0](query, vis_feats, lang_feats, query_pos, None, text_mask)
+        return self.contrastive_align_projection_text(query)
+
+
+def test_dynamic():
+    torch.manual_seed(0)
+    model = Decoder().eval()
+    inputs = (torch.randn(2, 32, 288), torch.randn(2, 128, 288), torch.randn(2, 12, 288), torch.randn(2, 32, 6),
+              torch.zeros(2, 12, dtype=torch.bool))
+    with torch.no_grad():
+        expected = model(*inputs)
+    size = serialized_size(model)
+    quantize_dynamic_model(model)
+    assert not any(isinstance(m, (nn.Linear, nn.MultiheadAttention)) for m in model.modules())
+    assert serialized_size(model) < size / 2
+    with torch.no_grad():
+        assert relative_error(model(*inputs), expected) < 0.05
+
+
+class Backbones(nn.Module):
+    """The two backbones, under their WildRefer names."""
+
+    def __init__(self):
+        super().__init__()
+        self.image_backbone_net = VisualBackbone(288, name='resnet18', pretrained=False)
+        self.point_backbone_net = Pointnet2Backbone(input_feature_dim=3)
+
+    def forward(self, inputs):
+        image = self.image_backbone_net(inputs['image'])['image_feature']
+        points = self.point_backbone_net(inputs['point_clouds'], {})['fp2_features']
+        return image, points
+
+
+def test_static_and_artifact():
+    torch.manual_seed(0)
+    model = Backbones().eval()
+    batches = [{'image': torch.rand(1, 3, 96, 96),
+                'point_clouds': torch.rand(1, 4096, 6) * torch.tensor([10., 10., 2., 1., 1., 1.])}
+               for _ in range(2)]
+    with torch.no_grad():
+        expected = model(batches[0])
+    recipe = quantize_model(model, 'static', batches)
+    assert isinstance(model.image_backbone_net.body, torch.fx.GraphModule)
+    with torch.no_grad():
+        out = model(batches[0])
+    assert all(relative_error(o, e) < 0.15 for o, e in zip(out, expected))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'int8.pth')
+        save_quantized(model, recipe, path, step=1)
+        loaded, meta = load_quantized(path, Backbones())
+    assert meta == {'step': 1}
+    with torch.no_grad():
+        assert all(torch.equal(a, b) for a, b in zip(loaded(batches[0]), out))
+
+
+if __name__ == '__main__':
+    test_linear_multihead_attention()
+    test_dynamic()
+    test_static_and_artifact()
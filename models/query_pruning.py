@@ -0,0 +1,58 @@
+"""
+Query pruning for inference.
+
+WildRefer decodes num_queries proposals through every decoder layer, and in
+the end test.get_prediction keeps the single query that matches the text
+best: the one least aligned with the "not mentioned" token. A pruning
+schedule ranks the queries by that same score at chosen points of the
+decoder and carries only the top k on, so the self- and cross-attention of
+the later layers run on a fraction of the queries.
+
+A schedule maps the number of decoder layers already run to the number of
+queries kept: {0: 64, 3: 16} keeps the 64 best proposals before the first
+decoder layer and the 16 best queries after the third one, 256 -> 64 -> 16.
+On the command line it is written '0:64,3:16'. Pruning only applies in
+eval mode; training always decodes every query.
+"""
+import torch
+
+TEMPERATURE = 0.07  # of the contrastive alignment, as in the loss
+
+
+def parse_schedule(text, num_decoder_layers=None):
+    """'0:64,3:16' -> {0: 64, 3: 16}; '' and 'none' -> {} (no pruning)."""
+    if text in ('', 'none'):
+        return {}
+    schedule = {}
+    for item in text.split(','):
+        layers, k = (int(v) for v in item.split(':'))
+        schedule[layers] = k
+    layers = sorted(schedule)
+    if num_decoder_layers is not None and not all(0 <= l < num_decoder_layers for l in layers):
+        raise ValueError(f'prune after 0 to {num_decoder_layers - 1} decoder layers, got {text}')
+    if any(schedule[a] <= schedule[b] for a, b in zip(layers, layers[1:])) or schedule[layers[-1]] < 1:
+        raise ValueError(f'the number of kept queries must decrease and stay positive, got {text}')
+    return schedule
+
+
+def format_schedule(schedule, num_queries):
+    """{0: 64, 3: 16} -> '256->64@0->16@3', the table label of a schedule."""
+    return '->'.join([str(num_queries)] + [f'{k}@{l}' for l, k in sorted(schedule.items())])
+
+
+def text_scores(proj_queries, proj_tokens, attention_mask):
+    """
+    (B, Q) match of every query with its description: one minus the softmax
+    weight of the "not mentioned" token, the token before </s>.
+    """
+    sem_scores = torch.softmax(torch.matmul(proj_queries, proj_tokens.transpose(-1, -2)) / TEMPERATURE, dim=-1)
+    last_pos = (attention_mask.sum(1) - 2).to(sem_scores.device)
+    return 1 - sem_scores.gather(2, last_pos.view(-1, 1, 1).expand(-1, sem_scores.shape[1], 1)).squeeze(2)
+
+
+def keep_top_queries(scores, k, *tensors):
+    """The (B, k) indices of the best scores and each (B, Q, ...) tensor gathered at them."""
+    inds = scores.topk(k, dim=1).indices
+    gathered = [t.gather(1, inds.view(inds.shape + (1,) * (t.dim() - 2)).expand((-1, -1) + t.shape[2:]))
+                for t in tensors]
+    return inds, gathered
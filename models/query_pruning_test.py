@@ -0,0 +1,124 @@
+''' Testing query pruning: the schedule, the kept queries and their bookkeeping, no effect in training. '''
+
+import os
+import sys
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from models.encoder_decoder_layers import BiDecoderLayer
+from models.modules import ClsAgnosticPredictHead, GeneralSamplingModule, PointsObjClsModule
+from models.query_pruning import format_schedule, keep_top_queries, parse_schedule, text_scores
+from models.wildrefer import WildRefer
+
+D_MODEL = 288
+
+
+class Decoding(nn.Module):
+    """The query generation and decoder of WildRefer, under their WildRefer names."""
+    _generate_queries = WildRefer._generate_queries
+    _decode = WildRefer._decode
+    _prune_queries = WildRefer._prune_queries
+
+    def __init__(self, num_queries=64, num_decoder_layers=3):
+        super().__init__()
+        self.num_queries = num_queries
+        self.num_decoder_layers = num_decoder_layers
+        self.self_position_embedding = 'loc_learned'
+        self.contrastive_align_loss = True
+        self.butd = False
+        self.query_pruning = {}
+        self.points_obj_cls = PointsObjClsModule(D_MODEL)
+        self.gsample_module = GeneralSamplingModule()
+        self.decoder_query_proj = nn.Conv1d(D_MODEL, D_MODEL, kernel_size=1)
+        head = lambda: ClsAgnosticPredictHead(10, 1, num_queries, D_MODEL, objectness=False, heading=False,
+                                              compute_sem_scores=True)
+        self.proposal_head = head()
+        self.decoder = nn.ModuleList([BiDecoderLayer(D_MODEL, n_heads=8, dim_feedforward=256, dropout=0.1,
+                                                     self_position_embedding='loc_learned')
+                                      for _ in range(num_decoder_layers)])
+        self.decoder_stages = tuple(f'model/decoder_{i}' for i in range(num_decoder_layers))
+        self.prediction_heads = nn.ModuleList([head() for _ in range(num_decoder_layers)])
+        self.contrastive_align_projection_image = nn.Sequential(nn.Linear(D_MODEL, D_MODEL), nn.ReLU(),
+                                                                nn.Linear(D_MODEL, 64))
+
+    def forward(self, inputs):
+        end_points = {'proj_tokens': inputs['proj_tokens'], 'tokenized': {'attention_mask': inputs['attention_mask']}}
+        return self._decode(inputs['points_xyz'], inputs['points_features'], inputs['text_feats'],
+                            inputs['attention_mask'].ne(1), None, None, end_points)
+
+
+def random_inputs(batch=2, num_points=256, num_tokens=12):
+    generator = torch.Generator().manual_seed(0)
+    attention_mask = torch.ones(batch, num_tokens, dtype=torch.long)
+    attention_mask[0, 9:] = 0
+    return {
+        'points_xyz': torch.rand(batch, num_points, 3, generator=generator) * 10,
+        'points_features': torch.randn(batch, D_MODEL, num_points, generator=generator),
+        'text_feats': torch.randn(batch, num_tokens, D_MODEL, generator=generator),
+        'proj_tokens': F.normalize(torch.randn(batch, num_tokens, 64, generator=generator), dim=-1),
+        'attention_mask': attention_mask,
+    }
+
+
+def test_parse_schedule():
+    assert parse_schedule('') == parse_schedule('none') == {}
+    assert parse_schedule('0:64,3:16', 6) == {0: 64, 3: 16}
+    assert format_schedule({0: 64, 3: 16}, 256) == '256->64@0->16@3'
+    for text in ('0:16,3:64', '6:16', '0:0'):
+        try:
+            parse_schedule(text, 6)
+        except ValueError:
+            continue
+        raise AssertionError(f'accepted {text}')
+
+
+def test_text_scores():
+    """The score get_prediction picks the box by, written out per sample."""
+    inputs = random_inputs()
+    queries = F.normalize(torch.randn(2, 20, 64), dim=-1)
+    scores = text_scores(queries, inputs['proj_tokens'], inputs['attention_mask'])
+    for i in range(2):
+        last_pos = inputs['attention_mask'][i].sum() - 2
+        sem = torch.softmax(queries[i] @ inputs['proj_tokens'][i].T / 0.07, dim=-1)
+        assert torch.allclose(scores[i], 1 - sem[:, last_pos])
+    inds, (kept,) = keep_top_queries(scores, 5, queries)
+    assert torch.equal(kept, torch.stack([queries[i, inds[i]] for i in range(2)]))
+    assert torch.equal(scores.gather(1, inds), scores.topk(5, dim=1).values)
+
+
+def test_pruned_decoding():
+    torch.manual_seed(0)
+    model = Decoding().eval()
+    inputs = random_inputs()
+    with torch.no_grad():
+        full = model(inputs)
+        model.query_pruning = {0: 64}  # keeping everything is a no-op
+        assert torch.equal(model(inputs)['last_center'], full['last_center'])
+        model.query_pruning = {0: 32, 2: 8}
+        pruned = model(inputs)
+    assert [pruned[f'{p}center'].shape[1] for p in ('proposal_', '0head_', '1head_', 'last_')] == [64, 32, 32, 8]
+    # the proposals are ranked before any decoding, so the first cut is exact
+    first = text_scores(full['proposal_proj_queries'], inputs['proj_tokens'], inputs['attention_mask'])
+    assert torch.equal(pruned['proposal_center'], full['proposal_center'])
+    kept = pruned['query_inds']
+    assert kept.shape == (2, 8) and set(kept[0].tolist()) <= set(first[0].topk(32).indices.tolist())
+    # the remaining queries still refine their own proposals
+    assert torch.equal(pruned['last_base_xyz'], full['query_points_xyz'].gather(1, kept[..., None].expand(-1, -1, 3)))
+
+
+def test_training_decodes_every_query():
+    torch.manual_seed(0)
+    model = Decoding().train()
+    model.query_pruning = {0: 16}
+    assert model(random_inputs())['last_center'].shape[1] == 64
+
+
+if __name__ == '__main__':
+    test_parse_schedule()
+    test_text_scores()
+    test_pruned_decoding()
+    test_training_decodes_every_query()
@@ -0,0 +1,63 @@
+"""
+Text-guided seed pruning before the cross-modal encoder.
+
+The cross encoder attends over every fp2 seed of the point backbone (1024)
+in each of its layers, whatever the description asks for. With seed pruning
+a light scorer rates each seed against the pooled text, the top k seeds go
+through the encoder and the others skip it: their fused features are
+scattered back next to the encoded ones, so query generation still samples
+from all the seeds. Self-attention is quadratic in the seeds, keeping half
+of them leaves about a quarter of its cost.
+
+The scorer learns from the seeds inside the referred box, see
+models.losses.compute_seed_relevance_loss. Unlike query pruning it changes
+the architecture: a model trained with --seed_keep k is evaluated with it.
+"""
+import torch
+from torch import nn
+
+
+def pooled_text(text_feats, text_padding_mask):
+    """(B, F) mean of the (B, L, F) token features over the unpadded tokens."""
+    keep = (~text_padding_mask).unsqueeze(-1).to(text_feats.dtype)
+    return (text_feats * keep).sum(1) / keep.sum(1).clamp(min=1)
+
+
+class SeedRelevanceScorer(nn.Module):
+    """Relevance logit of every seed to the description, a dot product of two small projections."""
+
+    def __init__(self, d_model=288, hidden_dim=64):
+        super().__init__()
+        self.seed_proj = nn.Sequential(
+            nn.Conv1d(d_model, hidden_dim, kernel_size=1),
+            nn.ReLU(),
+            nn.Conv1d(hidden_dim, hidden_dim, kernel_size=1)
+        )
+        self.text_proj = nn.Sequential(
+            nn.Linear(d_model, hidden_dim),
+            nn.ReLU(),
+            nn.Linear(hidden_dim, hidden_dim)
+        )
+        self.scale = hidden_dim ** -0.5
+
+    def forward(self, seed_features, text_feats, text_padding_mask):
+        """(B, F, N) seeds, (B, L, F) tokens, (B, L) padding -> (B, N) logits."""
+        seeds = self.seed_proj(seed_features)  # (B, H, N)
+        text = self.text_proj(pooled_text(text_feats, text_padding_mask))  # (B, H)
+        return torch.einsum('bhn,bh->bn', seeds, text) * self.scale
+
+
+def keep_top_seeds(scores, k, *tensors):
+    """
+    The (B, k) indices of the best seeds, in their original order, and each
+    (B, N, ...) tensor gathered at them.
+    """
+    inds = scores.topk(k, dim=1).indices.sort(dim=1).values
+    gathered = [t.gather(1, inds.view(inds.shape + (1,) * (t.dim() - 2)).expand((-1, -1) + t.shape[2:]))
+                for t in tensors]
+    return inds, gathered
+
+
+def scatter_seeds(features, kept_features, inds):
+    """The (B, N, F) `features` with the rows `inds` replaced by the (B, k, F) `kept_features`."""
+    return features.scatter(1, inds.unsqueeze(-1).expand(-1, -1, features.shape[-1]), kept_features)
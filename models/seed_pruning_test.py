@@ -0,0 +1,136 @@
+''' Testing seed pruning: the relevance scorer, the seeds skipping the cross encoder and the relevance loss. '''
+
+import os
+import sys
+
+import torch
+from torch import nn
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from models.encoder_decoder_layers import BiEncoder, BiEncoderLayer
+from models.losses import compute_seed_relevance_loss
+from models.modules import PositionEmbeddingLearned
+from models.seed_pruning import SeedRelevanceScorer, keep_top_seeds, pooled_text, scatter_seeds
+from models.wildrefer import WildRefer
+
+D_MODEL = 288
+
+
+class Encoding(nn.Module):
+    """The cross encoder of WildRefer, under its WildRefer names."""
+    _encode = WildRefer._encode
+
+    def __init__(self, seed_keep=0):
+        super().__init__()
+        self.seed_keep = seed_keep
+        self.pos_embed = PositionEmbeddingLearned(3, D_MODEL)
+        self.cross_encoder_text_points = BiEncoder(BiEncoderLayer(D_MODEL, n_heads=8, dim_feedforward=256,
+                                                                  use_img_enc_attn=True), 2)
+        self.seed_scorer = SeedRelevanceScorer(D_MODEL)
+
+    def forward(self, inputs, end_points):
+        return self._encode(inputs['points_xyz'], inputs['points_features'], inputs['points_mask'],
+                            inputs['text_feats'], inputs['text_padding_mask'], inputs['image_features'],
+                            inputs['img_mask'], None, None, end_points)
+
+
+def random_inputs(batch=2, num_points=128, num_tokens=12, num_pixels=36):
+    generator = torch.Generator().manual_seed(0)
+    text_padding_mask = torch.zeros(batch, num_tokens, dtype=torch.bool)
+    text_padding_mask[0, 9:] = True
+    return {
+        'points_xyz': torch.rand(batch, num_points, 3, generator=generator) * 10,
+        'points_features': torch.randn(batch, D_MODEL, num_points, generator=generator),
+        'points_mask': torch.zeros(batch, num_points, dtype=torch.bool),
+        'text_feats': torch.randn(batch, num_tokens, D_MODEL, generator=generator),
+        'text_padding_mask': text_padding_mask,
+        'image_features': torch.randn(batch, num_pixels, D_MODEL, generator=generator),
+        'img_mask': torch.zeros(batch, num_pixels, dtype=torch.bool),
+    }
+
+
+def test_scorer():
+    inputs = random_inputs()
+    pooled = pooled_text(inputs['text_feats'], inputs['text_padding_mask'])
+    assert torch.allclose(pooled[0], inputs['text_feats'][0, :9].mean(0), atol=1e-6)
+    assert torch.allclose(pooled[1], inputs['text_feats'][1].mean(0), atol=1e-6)
+    scorer = SeedRelevanceScorer(D_MODEL)
+    logits = scorer(inputs['points_features'], inputs['text_feats'], inputs['text_padding_mask'])
+    assert logits.shape == (2, 128)
+    # the padded tokens do not count
+    text_feats = inputs['text_feats'].clone()
+    text_feats[0, 9:] = 100
+    assert torch.equal(scorer(inputs['points_features'], text_feats, inputs['text_padding_mask']), logits)
+
+
+def test_keep_and_scatter():
+    scores = torch.randn(2, 50)
+    features = torch.randn(2, 50, 8)
+    inds, (kept,) = keep_top_seeds(scores, 10, features)
+    assert (inds[:, 1:] > inds[:, :-1]).all()
+    assert set(inds[0].tolist()) == set(scores[0].topk(10).indices.tolist())
+    assert torch.equal(kept, torch.stack([features[i, inds[i]] for i in range(2)]))
+    updated = scatter_seeds(features, kept + 1, inds)
+    for i in range(2):
+        mask = torch.zeros(50, dtype=torch.bool)
+        mask[inds[i]] = True
+        assert torch.equal(updated[i, mask], features[i, mask] + 1)
+        assert torch.equal(updated[i, ~mask], features[i, ~mask])
+
+
+def test_pruned_encoding():
+    torch.manual_seed(0)
+    model = Encoding().eval()
+    inputs = random_inputs()
+    with torch.no_grad():
+        full, _ = model(inputs, {})
+        for seed_keep in (128, 1024):  # keeping every seed, or more than there are, is a no-op
+            model.seed_keep = seed_keep
+            end_points = {}
+            assert torch.equal(model(inputs, end_points)[0], full)
+            assert end_points['seed_relevance_logits'].shape == (2, 128)
+            assert 'encoded_seed_inds' not in end_points
+
+        model.seed_keep = 32
+        end_points = {}
+        pruned, _ = model(inputs, end_points)
+        inds = end_points['encoded_seed_inds']
+        assert inds.shape == (2, 32) and pruned.shape == full.shape
+        for i in range(2):
+            skipped = torch.ones(128, dtype=torch.bool)
+            skipped[inds[i]] = False
+            # the other seeds keep their features, the kept ones are encoded among themselves
+            assert torch.equal(pruned[i][:, skipped], inputs['points_features'][i][:, skipped])
+            alone = {k: v[i:i + 1] for k, v in inputs.items()}
+            alone['points_xyz'] = alone['points_xyz'][:, inds[i]]
+            alone['points_features'] = alone['points_features'][..., inds[i]]
+            alone['points_mask'] = alone['points_mask'][:, inds[i]]
+            model.seed_keep = 0
+            assert torch.allclose(model(alone, {})[0][0], pruned[i][:, inds[i]], atol=1e-5)
+            model.seed_keep = 32
+
+
+def test_relevance_loss():
+    torch.manual_seed(0)
+    model = Encoding(seed_keep=32).train()
+    inputs = random_inputs()
+    end_points = {'seed_inds': torch.arange(0, 256, 2).repeat(2, 1)}
+    model(inputs, end_points)
+    point_instance_label = -torch.ones(2, 256, dtype=torch.long)
+    point_instance_label[:, :40] = 0  # 20 of the seeds are in the box
+    end_points['point_instance_label'] = point_instance_label
+    loss = compute_seed_relevance_loss(end_points)
+    loss.backward()
+    assert loss.item() > 0
+    assert all(p.grad is not None for p in model.seed_scorer.parameters())
+    # relevant and other seeds weigh the same, whatever their numbers
+    end_points['seed_relevance_logits'] = torch.where(torch.arange(128) < 20, 1., -1.).repeat(2, 1)
+    assert torch.isclose(compute_seed_relevance_loss(end_points), torch.nn.functional.softplus(torch.tensor(-1.)))
+
+
+if __name__ == '__main__':
+    test_scorer()
+    test_keep_and_scatter()
+    test_pruned_encoding()
+    test_relevance_loss()
@@ -1,10 +1,11 @@
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
-from transformers import RobertaModel, RobertaTokenizerFast
+
+from utils.profiler import profiler
 
 from .point_backbone_module import Pointnet2Backbone
-from .image_backbone_module import VisualBackbone
+from .image_backbone_module import VisualBackbone, pack_image_tokens
 
 from .modules import (
     PointsObjClsModule, GeneralSamplingModule,
@@ -13,6 +14,25 @@ from .modules import (
 from .encoder_decoder_layers import (
     BiEncoder, BiEncoderLayer, BiDecoderLayer, MultiCALayer, ImageMultiCALayer
 )
+from .query_pruning import keep_top_queries, text_scores
+from .seed_pruning import SeedRelevanceScorer, keep_top_seeds, scatter_seeds
+
+
+def from_pretrained(cls, name, **kwargs):
+    """cls.from_pretrained that only goes to the network when nothing is cached."""
+    try:
+        return cls.from_pretrained(name, local_files_only=True, **kwargs)
+    except OSError:
+        return cls.from_pretrained(name, **kwargs)
+
+
+def gather_frames(end_points, frame_index, num_frames):
+    """Expand the per-frame tensors of a backbone run on unique frames to the (B*K) frames of the batch."""
+    return {
+        key: value.index_select(0, frame_index)
+        if isinstance(value, torch.Tensor) and value.dim() > 0 and value.shape[0] == num_frames else value
+        for key, value in end_points.items()
+    }
 
 
 class WildRefer(nn.Module):
@@ -24,7 +44,10 @@ class WildRefer(nn.Module):
                  d_model=288, pointnet_ckpt=None, resnet_ckpt=None,
                  self_attend=True,
                  frame_num=2,
-                 butd=False):
+                 butd=False,
+                 seed_keep=0,
+                 pack_image_tokens=False,
+                 pretrained=True):
         super().__init__()   
         self.args = args     
         self.num_queries = num_queries
@@ -32,6 +55,12 @@ class WildRefer(nn.Module):
         self.self_position_embedding = self_position_embedding
         self.contrastive_align_loss = contrastive_align_loss
         self.butd = butd
+        # {decoder layers run: queries kept}, see models.query_pruning
+        self.query_pruning = {}
+        # seeds through the cross encoder, 0 for all of them, see models.seed_pruning
+        self.seed_keep = seed_keep
+        # drop the letterbox padding tokens after the image backbone
+        self.pack_image_tokens = pack_image_tokens
 
         # Visual encoder
         self.point_backbone_net = Pointnet2Backbone(
@@ -45,7 +74,7 @@ class WildRefer(nn.Module):
             for p in self.point_backbone_net.parameters():
                 p.requires_grad = False
 
-        self.image_backbone_net = VisualBackbone(d_model=d_model)
+        self.image_backbone_net = VisualBackbone(d_model=d_model, pretrained=pretrained)
         if resnet_ckpt is not None:
             self.image_backbone_net.load_state_dict(torch.load(
                 resnet_ckpt
@@ -77,9 +106,14 @@ class WildRefer(nn.Module):
             ))
         
         # Text Encoder
+        from transformers import RobertaConfig, RobertaModel, RobertaTokenizerFast
         t_type = "roberta-base"
-        self.tokenizer = RobertaTokenizerFast.from_pretrained(t_type)
-        self.text_encoder = RobertaModel.from_pretrained(t_type)
+        self.tokenizer = from_pretrained(RobertaTokenizerFast, t_type)
+        if pretrained:
+            self.text_encoder = from_pretrained(RobertaModel, t_type)
+        else:
+            # weights will come from a checkpoint, only build the architecture
+            self.text_encoder = RobertaModel(from_pretrained(RobertaConfig, t_type))
         for param in self.text_encoder.parameters():
             param.requires_grad = False
 
@@ -100,6 +134,8 @@ class WildRefer(nn.Module):
             use_butd_enc_attn=butd
         )
         self.cross_encoder_text_points = BiEncoder(bi_layer_pc, 3)
+        if self.seed_keep:
+            self.seed_scorer = SeedRelevanceScorer(d_model)
 
         # Query initialization
         self.points_obj_cls = PointsObjClsModule(d_model)
@@ -121,6 +157,8 @@ class WildRefer(nn.Module):
                 dropout=0.1, activation="relu",
                 self_position_embedding=self_position_embedding, butd=self.butd
             ))
+        # profiler stage names, built once rather than per layer and forward
+        self.decoder_stages = tuple(f'model/decoder_{i}' for i in range(self.num_decoder_layers))
 
         # Prediction heads
         self.prediction_heads = nn.ModuleList()
@@ -154,14 +192,24 @@ class WildRefer(nn.Module):
     def _run_backbones(self, inputs):
         """Run visual and text backbones."""
         # Visual encoder
-        point_clouds = inputs['point_clouds']
-        B, K, N, C = point_clouds.shape
-        point_clouds = point_clouds.view(B*K, N, C)
-        if self.args.lr_backbone > 0:
-            end_points = self.point_backbone_net(point_clouds, end_points={})
+        if 'frame_index' in inputs:
+            # batch from collate_unique_frames: one backbone pass per unique frame
+            B, K = inputs['frame_index'].shape
+            frame_index = inputs['frame_index'].view(B*K)
+            point_clouds = inputs['unique_point_clouds']
         else:
-            with torch.no_grad():
+            frame_index = None
+            point_clouds = inputs['point_clouds']
+            B, K, N, C = point_clouds.shape
+            point_clouds = point_clouds.view(B*K, N, C)
+        with profiler.stage('model/point_backbone'):
+            if self.args.lr_backbone > 0:
                 end_points = self.point_backbone_net(point_clouds, end_points={})
+            else:
+                with torch.no_grad():
+                    end_points = self.point_backbone_net(point_clouds, end_points={})
+        if frame_index is not None:
+            end_points = gather_frames(end_points, frame_index, len(point_clouds))
         if K == 1:
             end_points['seed_inds'] = end_points['fp2_inds']
             end_points['seed_xyz'] = end_points['fp2_xyz']
@@ -184,16 +232,31 @@ class WildRefer(nn.Module):
             end_points['fp2_features'] = end_points['seed_features']
         
         # Image encoder
-        image = inputs['image']
-        img_mask = inputs['img_mask']
-        B, K, H, W = img_mask.shape
-        image = image.view(B*K, -1, H, W)
-        img_mask = img_mask.view(B*K, H, W)
-        if self.args.lr_backbone > 0:
-            end_points = self.image_backbone_net(image, img_mask, end_points=end_points)
+        if frame_index is not None:
+            image = inputs['unique_image']
+            img_mask = inputs['unique_img_mask']
+            img_layout = inputs.get('unique_img_layout')
         else:
-            with torch.no_grad():
-                end_points = self.image_backbone_net(image, img_mask, end_points=end_points)
+            image = inputs['image']
+            img_mask = inputs['img_mask']
+            B, K, H, W = img_mask.shape
+            image = image.view(B*K, -1, H, W)
+            img_mask = img_mask.view(B*K, H, W)
+            img_layout = inputs.get('img_layout')
+            if img_layout is not None:
+                # collated as K lists of B names, the frames are B*K
+                img_layout = [name for sample in zip(*img_layout) for name in sample]
+        with profiler.stage('model/image_backbone'):
+            if self.args.lr_backbone > 0:
+                image_end_points = self.image_backbone_net(image, img_mask, end_points={}, layout=img_layout)
+            else:
+                with torch.no_grad():
+                    image_end_points = self.image_backbone_net(image, img_mask, end_points={}, layout=img_layout)
+        if frame_index is not None:
+            image_end_points = gather_frames(image_end_points, frame_index, len(image))
+        if self.pack_image_tokens:
+            image_end_points = pack_image_tokens(image_end_points)
+        end_points.update(image_end_points)
         image_feature = end_points['image_feature'].view(B, K, end_points['image_feature'].shape[-2], end_points['image_feature'].shape[-1])
         image_mask = ~end_points['img_mask'].view(B, K, end_points['image_feature'].shape[-1])
         image_pos = end_points['img_pos'].view(B, K, end_points['img_pos'].shape[-2], end_points['img_pos'].shape[-1])
@@ -205,12 +268,14 @@ class WildRefer(nn.Module):
         end_points['additional_img_pos'] = image_pos
         
         # Text encoder
-        tokenized = self.tokenizer.batch_encode_plus(
-            inputs['text'], padding="longest", return_tensors="pt"
-        ).to(point_clouds.device)
+        with profiler.stage('model/tokenize'):
+            tokenized = self.tokenizer.batch_encode_plus(
+                inputs['text'], padding="longest", return_tensors="pt"
+            ).to(point_clouds.device)
         
-        encoded_text = self.text_encoder(**tokenized)
-        text_feats = self.text_projector(encoded_text.last_hidden_state)
+        with profiler.stage('model/text_encoder'):
+            encoded_text = self.text_encoder(**tokenized)
+            text_feats = self.text_projector(encoded_text.last_hidden_state)
 
         # Invert attention mask that we get from huggingface
         # because its the opposite in pytorch transformer
@@ -265,15 +330,16 @@ class WildRefer(nn.Module):
         # Point Multi-Fuser
         additional_points_xyz = end_points['additional_seed_xyz']
         additional_points_features = end_points['additional_seed_features']
-        for i in range(self.multi_fuser_layers):
-            points_features = self.multi_fuser[i](
-                query=points_features.transpose(1, 2).contiguous(),
-                key=additional_points_features.transpose(-1, -2).contiguous(),
-                value=additional_points_features.transpose(-1, -2).contiguous(),
-                query_pos=points_xyz,
-                key_pos=additional_points_xyz,
-                multi_mask=inputs['dynamic_mask']
-            )
+        with profiler.stage('model/point_fuser'):
+            for i in range(self.multi_fuser_layers):
+                points_features = self.multi_fuser[i](
+                    query=points_features.transpose(1, 2).contiguous(),
+                    key=additional_points_features.transpose(-1, -2).contiguous(),
+                    value=additional_points_features.transpose(-1, -2).contiguous(),
+                    query_pos=points_xyz,
+                    key_pos=additional_points_xyz,
+                    multi_mask=inputs['dynamic_mask']
+                )
 
         # Image Multi-Fuser
         image_features = end_points['image_feature']  # (B, F, N)
@@ -283,16 +349,17 @@ class WildRefer(nn.Module):
         additional_image_pos = end_points['additional_img_pos']
         additional_img_mask = end_points['additional_img_mask']
 
-        for i in range(self.multi_fuser_layers):
-            image_features = self.image_multi_fuser[i](
-                query=image_features.transpose(1, 2).contiguous(),
-                key=additional_image_feature.transpose(-1, -2).contiguous(),
-                value=additional_image_feature.transpose(-1, -2).contiguous(),
-                query_pos=img_pos,
-                key_pos=additional_image_pos,
-                multi_mask=inputs['dynamic_mask'],
-                key_mask=additional_img_mask
-            )
+        with profiler.stage('model/image_fuser'):
+            for i in range(self.multi_fuser_layers):
+                image_features = self.image_multi_fuser[i](
+                    query=image_features.transpose(1, 2).contiguous(),
+                    key=additional_image_feature.transpose(-1, -2).contiguous(),
+                    value=additional_image_feature.transpose(-1, -2).contiguous(),
+                    query_pos=img_pos,
+                    key_pos=additional_image_pos,
+                    multi_mask=inputs['dynamic_mask'],
+                    key_mask=additional_img_mask
+                )
         image_features = image_features.transpose(1, 2).contiguous()
 
 
@@ -306,21 +373,11 @@ class WildRefer(nn.Module):
             detected_feats = None
         
         # Cross-modality encoding (Text-Points)
-        points_features, text_feats = self.cross_encoder_text_points(
-            vis_feats=points_features.transpose(1, 2).contiguous(),
-            pos_feats=self.pos_embed(points_xyz).transpose(1, 2).contiguous(),
-            padding_mask=points_mask,
-            text_feats=original_text_feats,
-            text_padding_mask=text_padding_mask,
-            end_points=end_points,
-            enhanced_feats=image_features,
-            enhanced_mask=img_mask,
-            detected_feats=detected_feats,
-            detected_mask=detected_mask
-        )
-        
-        points_features = points_features.transpose(1, 2)
-        points_features = points_features.contiguous()  # (B, F, points)
+        with profiler.stage('model/cross_encoder'):
+            points_features, text_feats = self._encode(
+                points_xyz, points_features, points_mask, original_text_feats, text_padding_mask,
+                image_features, img_mask, detected_feats, detected_mask, end_points
+            )
         end_points["text_memory"] = text_feats
         end_points['seed_features'] = points_features
         if self.contrastive_align_loss:
@@ -329,10 +386,51 @@ class WildRefer(nn.Module):
             )
             end_points['proj_tokens'] = proj_tokens
         
-        # Query Points Generation
-        end_points = self._generate_queries(
-            points_xyz, points_features, end_points
+        return self._decode(points_xyz, points_features, text_feats, text_padding_mask,
+                            detected_feats, detected_mask, end_points)
+
+    def _encode(self, points_xyz, points_features, points_mask, text_feats, text_padding_mask,
+                image_features, img_mask, detected_feats, detected_mask, end_points):
+        """The cross encoder over the seeds, or over the self.seed_keep most relevant ones."""
+        vis_feats = points_features.transpose(1, 2).contiguous()  # (B, points, F)
+        pos_feats = self.pos_embed(points_xyz).transpose(1, 2).contiguous()
+        prune = False
+        if self.seed_keep:
+            seed_logits = self.seed_scorer(points_features, text_feats, text_padding_mask)
+            end_points['seed_relevance_logits'] = seed_logits  # (B, points)
+            # keeping every seed is no pruning
+            prune = self.seed_keep < seed_logits.shape[1]
+        if prune:
+            seed_inds, (vis_feats, pos_feats, points_mask) = keep_top_seeds(
+                seed_logits, self.seed_keep, vis_feats, pos_feats, points_mask
+            )
+            end_points['encoded_seed_inds'] = seed_inds  # (B, seed_keep)
+        encoded_feats, text_feats = self.cross_encoder_text_points(
+            vis_feats=vis_feats,
+            pos_feats=pos_feats,
+            padding_mask=points_mask,
+            text_feats=text_feats,
+            text_padding_mask=text_padding_mask,
+            end_points=end_points,
+            enhanced_feats=image_features,
+            enhanced_mask=img_mask,
+            detected_feats=detected_feats,
+            detected_mask=detected_mask
         )
+        if prune:
+            # the other seeds skip the encoder with their fused features
+            encoded_feats = scatter_seeds(points_features.transpose(1, 2), encoded_feats, seed_inds)
+        points_features = encoded_feats.transpose(1, 2).contiguous()  # (B, F, points)
+        return points_features, text_feats
+
+    def _decode(self, points_xyz, points_features, text_feats, text_padding_mask,
+                detected_feats, detected_mask, end_points):
+        """Query generation, proposals and the decoder layers, pruning the queries by self.query_pruning."""
+        # Query Points Generation
+        with profiler.stage('model/query_generation'):
+            end_points = self._generate_queries(
+                points_xyz, points_features, end_points
+            )
         cluster_feature = end_points['query_points_feature']  # (B, F, V)
         cluster_xyz = end_points['query_points_xyz']  # (B, V, 3)
         query = self.decoder_query_proj(cluster_feature)
@@ -353,6 +451,9 @@ class WildRefer(nn.Module):
         base_xyz = proposal_center.detach().clone()  # (B, V, 3)
         base_size = proposal_size.detach().clone()  # (B, V, 3)
         query_mask = None
+        query, cluster_xyz, base_xyz, base_size = self._prune_queries(
+            0, 'proposal_', end_points, query, cluster_xyz, base_xyz, base_size
+        )
 
         # Decoder
         for i in range(self.num_decoder_layers):
@@ -369,17 +470,18 @@ class WildRefer(nn.Module):
                 raise NotImplementedError
 
             # Transformer Decoder Layer
-            query = self.decoder[i](
-                query, points_features.transpose(1, 2).contiguous(),
-                text_feats, query_pos,
-                query_mask,
-                text_padding_mask,
-                detected_feats=(
-                    detected_feats if self.butd
-                    else None
-                ),
-                detected_mask=detected_mask if self.butd else None
-            )  # (B, V, F)
+            with profiler.stage(self.decoder_stages[i]):
+                query = self.decoder[i](
+                    query, points_features.transpose(1, 2).contiguous(),
+                    text_feats, query_pos,
+                    query_mask,
+                    text_padding_mask,
+                    detected_feats=(
+                        detected_feats if self.butd
+                        else None
+                    ),
+                    detected_mask=detected_mask if self.butd else None
+                )  # (B, V, F)
 
             if self.contrastive_align_loss:
                 end_points[f'{prefix}proj_queries'] = F.normalize(
@@ -395,9 +497,27 @@ class WildRefer(nn.Module):
             )
             base_xyz = base_xyz.detach().clone()
             base_size = base_size.detach().clone()
+            query, cluster_xyz, base_xyz, base_size = self._prune_queries(
+                i + 1, prefix, end_points, query, cluster_xyz, base_xyz, base_size
+            )
 
         return end_points
 
+    def _prune_queries(self, num_layers_run, prefix, end_points, *tensors):
+        """In eval mode, keep the queries query_pruning asks for after `num_layers_run` decoder layers."""
+        k = self.query_pruning.get(num_layers_run)
+        if self.training or k is None or k >= tensors[0].shape[1]:
+            return tensors
+        scores = text_scores(
+            end_points[f'{prefix}proj_queries'], end_points['proj_tokens'],
+            end_points['tokenized']['attention_mask']
+        )
+        inds, tensors = keep_top_queries(scores, k, *tensors)
+        # the proposals the remaining queries started from
+        kept = end_points.get('query_inds')
+        end_points['query_inds'] = inds if kept is None else kept.gather(1, inds)
+        return tensors
+
     def init_bn_momentum(self):
         """Initialize batch-norm momentum."""
         for m in self.modules():
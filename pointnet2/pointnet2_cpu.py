@@ -0,0 +1,104 @@
+''' Pure PyTorch versions of the pointnet2 ops for CPU tensors, matching the CUDA kernels. '''
+import torch
+
+# elements of the distance blocks computed at once
+_BLOCK = 1 << 24
+
+
+def _squared_distances(a, b):
+    """(B, M, N) squared distances between a (B, M, 3) and b (B, N, 3), as the kernels compute them."""
+    return ((a[:, :, None, :] - b[:, None, :, :]) ** 2).sum(-1)
+
+
+def furthest_point_sample(xyz, npoint):
+    """
+    (B, npoint) int32 indices of the furthest point sampling of xyz (B, N, 3),
+    starting from point 0. Points closer than 1e-3 to the origin are never
+    picked, as in the kernel.
+    """
+    B, N, _ = xyz.shape
+    xyz = xyz.detach().float()
+    coords = xyz.permute(2, 0, 1).contiguous()  # (3, B, N)
+    batch = torch.arange(B)
+    # padding points get -1 so they stay below every real distance
+    temp = torch.full((B, N), 1e10)
+    temp[(xyz ** 2).sum(-1) <= 1e-3] = -1
+    inds = torch.zeros(B, npoint, dtype=torch.int32)
+    last = torch.zeros(B, dtype=torch.long)
+    diff = torch.empty(3, B, N)
+    dist = torch.empty(B, N)
+    for i in range(1, npoint):
+        torch.sub(coords, coords[:, batch, last][:, :, None], out=diff)
+        diff.mul_(diff)
+        torch.sum(diff, 0, out=dist)
+        torch.minimum(temp, dist, out=temp)
+        last = temp.argmax(1)
+        inds[:, i] = last.int()
+    return inds
+
+
+def gather_points(features, idx):
+    """features (B, C, N), idx (B, M) -> (B, C, M)"""
+    idx = idx.long()
+    return features.gather(2, idx[:, None, :].expand(-1, features.shape[1], -1))
+
+
+def group_points(features, idx):
+    """features (B, C, N), idx (B, M, S) -> (B, C, M, S)"""
+    B, M, S = idx.shape
+    flat = idx.long().reshape(B, 1, M * S).expand(-1, features.shape[1], -1)
+    return features.gather(2, flat).reshape(B, -1, M, S)
+
+
+def ball_query(new_xyz, xyz, radius, nsample):
+    """
+    (B, M, nsample) int32 indices of the first nsample points of xyz (B, N, 3)
+    within radius of each center of new_xyz (B, M, 3), in index order. Free
+    slots repeat the first neighbour; a center without neighbours gets zeros.
+    The distances are expanded into a matrix product, so a point within
+    float rounding of the radius can fall on the other side than in the kernel.
+    """
+    B, N, _ = xyz.shape
+    M = new_xyz.shape[1]
+    xyz, new_xyz = xyz.detach().float(), new_xyz.detach().float()
+    squared_norms = (xyz ** 2).sum(-1)[:, None, :]
+    order = torch.arange(N, dtype=torch.int32)
+    k = min(nsample, N)
+    inds = torch.empty(B, M, nsample, dtype=torch.long)
+    step = max(1, _BLOCK // 4 // (B * N))
+    for start in range(0, M, step):
+        centers = new_xyz[:, start:start + step]
+        d2 = torch.baddbmm(squared_norms, centers, xyz.transpose(1, 2), alpha=-2)
+        d2 += (centers ** 2).sum(-1, keepdim=True)
+        # indices of the points inside, N for the outside ones, the first nsample of them
+        candidates = torch.where(d2 < radius ** 2, order, N)
+        first = candidates.topk(k, dim=-1, largest=False, sorted=True).values.long()
+        if k < nsample:
+            first = torch.cat([first, first.new_full(first.shape[:-1] + (nsample - k,), N)], -1)
+        first = torch.where(first == N, first[..., :1], first)
+        inds[:, start:start + step] = first.masked_fill(first == N, 0)
+    return inds.int()
+
+
+def three_nn(unknown, known):
+    """squared distances and int32 indices (B, n, 3) of the 3 nearest points of known (B, m, 3)"""
+    B, n, _ = unknown.shape
+    m = known.shape[1]
+    unknown, known = unknown.detach(), known.detach()
+    dist2 = torch.empty(B, n, 3)
+    inds = torch.empty(B, n, 3, dtype=torch.int32)
+    step = max(1, _BLOCK // (B * m * 3))
+    for start in range(0, n, step):
+        d2 = _squared_distances(unknown[:, start:start + step], known)
+        values, indices = d2.topk(min(3, m), dim=-1, largest=False, sorted=True)
+        dist2[:, start:start + step, :values.shape[-1]] = values
+        inds[:, start:start + step, :indices.shape[-1]] = indices.int()
+    if m < 3:
+        dist2[..., m:] = 1e40
+        inds[..., m:] = 0
+    return dist2, inds
+
+
+def three_interpolate(features, idx, weight):
+    """features (B, c, m), idx and weight (B, n, 3) -> (B, c, n)"""
+    return (group_points(features, idx) * weight[:, None]).sum(-1)
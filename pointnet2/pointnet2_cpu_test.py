@@ -0,0 +1,101 @@
+''' Testing the CPU ops against loop transcriptions of the CUDA kernels. '''
+
+import os
+import sys
+
+import numpy as np
+import torch
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.dirname(BASE_DIR))
+import pointnet2_cpu
+
+
+def reference_furthest_point_sample(xyz, npoint):
+    B, N, _ = xyz.shape
+    inds = np.zeros((B, npoint), dtype=np.int32)
+    for b in range(B):
+        temp = np.full(N, 1e10)
+        old = 0
+        for j in range(1, npoint):
+            best, besti = -1, 0
+            for k in range(N):
+                if (xyz[b, k] ** 2).sum() <= 1e-3:
+                    continue
+                d = min(((xyz[b, k] - xyz[b, old]) ** 2).sum(), temp[k])
+                temp[k] = d
+                if d > best:
+                    best, besti = d, k
+            inds[b, j] = old = besti
+    return inds
+
+
+def reference_ball_query(new_xyz, xyz, radius, nsample):
+    B, M, _ = new_xyz.shape
+    inds = np.zeros((B, M, nsample), dtype=np.int32)
+    for b in range(B):
+        for j in range(M):
+            cnt = 0
+            for k in range(xyz.shape[1]):
+                if cnt >= nsample:
+                    break
+                if ((new_xyz[b, j] - xyz[b, k]) ** 2).sum() < radius ** 2:
+                    if cnt == 0:
+                        inds[b, j, :] = k
+                    inds[b, j, cnt] = k
+                    cnt += 1
+    return inds
+
+
+def test_furthest_point_sample():
+    torch.manual_seed(0)
+    xyz = torch.rand(2, 64, 3)
+    xyz[0, 5] = 0  # padding point, never sampled
+    inds = pointnet2_cpu.furthest_point_sample(xyz, 16)
+    assert inds.dtype == torch.int32
+    assert np.array_equal(inds.numpy(), reference_furthest_point_sample(xyz.double().numpy(), 16))
+    assert 5 not in inds[0]
+
+
+def test_ball_query():
+    torch.manual_seed(0)
+    xyz = torch.rand(2, 50, 3)
+    new_xyz = torch.cat([xyz[:, :6], torch.full((2, 1, 3), 5.)], 1)  # the last center has no neighbour
+    inds = pointnet2_cpu.ball_query(new_xyz, xyz, 0.3, 8)
+    assert inds.dtype == torch.int32
+    assert np.array_equal(inds.numpy(), reference_ball_query(new_xyz.numpy(), xyz.numpy(), 0.3, 8))
+
+
+def test_grouping_and_interpolation():
+    torch.manual_seed(0)
+    features = torch.rand(2, 4, 10)
+    idx = torch.randint(10, (2, 3, 5), dtype=torch.int32)
+    grouped = pointnet2_cpu.group_points(features, idx)
+    for b in range(2):
+        assert torch.equal(grouped[b], features[b][:, idx[b].long()])
+    assert torch.equal(pointnet2_cpu.gather_points(features, idx[:, 0]), grouped[:, :, 0])
+
+    unknown, known = torch.rand(2, 7, 3), torch.rand(2, 10, 3)
+    dist2, nn_idx = pointnet2_cpu.three_nn(unknown, known)
+    expected = torch.cdist(unknown.double(), known.double()) ** 2
+    assert torch.equal(nn_idx.long(), expected.argsort(-1)[..., :3])
+    assert torch.allclose(dist2.double(), expected.sort(-1).values[..., :3], atol=1e-6)
+    weight = torch.rand(2, 7, 3)
+    interpolated = pointnet2_cpu.three_interpolate(features, nn_idx, weight)
+    assert torch.allclose(interpolated, (pointnet2_cpu.group_points(features, nn_idx) * weight[:, None]).sum(-1))
+
+
+def test_backbone_runs_on_cpu():
+    from models.point_backbone_module import Pointnet2Backbone
+    backbone = Pointnet2Backbone(input_feature_dim=3).eval()
+    with torch.no_grad():
+        end_points = backbone(torch.rand(1, 4096, 6), {})
+    assert end_points['fp2_features'].shape == (1, 288, 1024)
+
+
+if __name__ == '__main__':
+    test_furthest_point_sample()
+    test_ball_query()
+    test_grouping_and_interpolation()
+    test_backbone_runs_on_cpu()
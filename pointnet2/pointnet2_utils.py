@@ -15,6 +15,7 @@ import torch
 from torch.autograd import Function
 import torch.nn as nn
 import pytorch_utils as pt_utils
+import pointnet2_cpu  # the compiled ops are CUDA-only, CPU tensors take these
 import sys
 
 try:
@@ -77,7 +78,10 @@ class FurthestPointSampling(Function):
         return None, None
 
 
-furthest_point_sample = FurthestPointSampling.apply
+def furthest_point_sample(xyz, npoint):
+    if not xyz.is_cuda:
+        return pointnet2_cpu.furthest_point_sample(xyz, npoint)
+    return FurthestPointSampling.apply(xyz, npoint)
 
 
 class GatherOperation(Function):
@@ -114,7 +118,10 @@ class GatherOperation(Function):
         return grad_features, None
 
 
-gather_operation = GatherOperation.apply
+def gather_operation(features, idx):
+    if not features.is_cuda:
+        return pointnet2_cpu.gather_points(features, idx)
+    return GatherOperation.apply(features, idx)
 
 
 class ThreeNN(Function):
@@ -146,7 +153,11 @@ class ThreeNN(Function):
         return None, None
 
 
-three_nn = ThreeNN.apply
+def three_nn(unknown, known):
+    if not unknown.is_cuda:
+        dist2, idx = pointnet2_cpu.three_nn(unknown, known)
+        return torch.sqrt(dist2), idx
+    return ThreeNN.apply(unknown, known)
 
 
 class ThreeInterpolate(Function):
@@ -203,7 +214,10 @@ class ThreeInterpolate(Function):
         return grad_features, None, None
 
 
-three_interpolate = ThreeInterpolate.apply
+def three_interpolate(features, idx, weight):
+    if not features.is_cuda:
+        return pointnet2_cpu.three_interpolate(features, idx, weight)
+    return ThreeInterpolate.apply(features, idx, weight)
 
 
 class GroupingOperation(Function):
@@ -254,7 +268,10 @@ class GroupingOperation(Function):
         return grad_features, None
 
 
-grouping_operation = GroupingOperation.apply
+def grouping_operation(features, idx):
+    if not features.is_cuda:
+        return pointnet2_cpu.group_points(features, idx)
+    return GroupingOperation.apply(features, idx)
 
 
 class BallQuery(Function):
@@ -288,7 +305,10 @@ class BallQuery(Function):
         return None, None, None, None
 
 
-ball_query = BallQuery.apply
+def ball_query(radius, nsample, xyz, new_xyz):
+    if not xyz.is_cuda:
+        return pointnet2_cpu.ball_query(new_xyz, xyz, radius, nsample)
+    return BallQuery.apply(radius, nsample, xyz, new_xyz)
 
 
 class QueryAndGroup(nn.Module):
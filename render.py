@@ -0,0 +1,40 @@
+import os
+import sys
+sys.path.append(os.getcwd())
+
+import argparse
+import time
+
+from tqdm import tqdm
+from datasets.results import read_results
+from utils.visualize import render_results
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Render evaluation results')
+    parser.add_argument('--results_dir', required=True, type=str, help='the --results_dir of a test.py run')
+    parser.add_argument('--src_path', required=True, type=str, help='dataset root with the image/ and points_rgbd/ folders')
+    parser.add_argument('--out_dir', default='outputs/render', type=str)
+    parser.add_argument('--workers', default=8, type=int, help='rendering processes, 0 renders in this process')
+    parser.add_argument('--scene_ids', default=None, type=str, nargs='+', help='only render these scenes')
+    parser.add_argument('--min_iou', default=None, type=float, help='only render samples with at least this IoU')
+    parser.add_argument('--max_iou', default=None, type=float, help='only render samples below this IoU, e.g. 0.25 for the misses')
+    parser.add_argument('--no_images', action='store_true', help='skip the image overlays')
+    parser.add_argument('--no_points', action='store_true', help='skip the point cloud PLYs')
+    parser.add_argument('--no_boxes', action='store_true', help='skip the box mesh PLYs')
+    parser.add_argument('--max_points', default=0, type=int, help='subsample the exported point clouds, 0 keeps all points')
+    return parser.parse_args()
+
+def main(args):
+    results = read_results(args.results_dir, scene_ids=args.scene_ids, min_iou=args.min_iou, max_iou=args.max_iou)
+    print(f"rendering {len(results['index'])} samples")
+    start = time.time()
+    written = 0
+    frames = render_results(results, args.src_path, args.out_dir, workers=args.workers, images=not args.no_images,
+                            points=not args.no_points, boxes=not args.no_boxes, max_points=args.max_points)
+    for count in tqdm(frames, desc='frames'):
+        written += count
+    print(f'wrote {written} files to {args.out_dir} in {time.time() - start:.1f}s')
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    main(args)
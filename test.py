@@ -3,13 +3,23 @@ import sys
 sys.path.append(os.getcwd())
 
 import argparse
+import functools
 import numpy as np
 import random
+import time
 import torch
-from datasets import create_dataset
-from models import create_model
-from torch.utils.data import DataLoader
+from datasets import create_dataset, required_fields
+from datasets.cache import CachedDataset, fingerprint
+from datasets.collate import collate_unique_frames
+from models import create_model, create_model_from_checkpoint, optimize_for_inference
+from models.multi_checkpoint import MultiCheckpointModel
+from models.query_pruning import format_schedule, parse_schedule, text_scores
+from models.quantization import load_quantized, quantize_model, save_quantized, serialized_size
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
+from utils.checkpoint import load_state
+from utils.profiler import profiler, PROFILE_KEY
+from utils.sharded_eval import ShardWriter, check_manifest, file_identity, merge_shards, run_shards, shard_range
 
 def set_random_seed(seed):
     random.seed(seed)
@@ -21,7 +31,14 @@ def set_random_seed(seed):
 def get_args_parser():
     parser = argparse.ArgumentParser('Set config')
     parser.add_argument('--dataset', default='', type=str)
-    parser.add_argument('--img_size', default=384, type=int)
+    parser.add_argument('--src_path', default='', type=str, help='dataset root, defaults to the SRC_PATH of the dataset')
+    parser.add_argument('--data_root', default='data', type=str, help='directory of the annotation json files')
+    parser.add_argument('--img_size', default=[384], type=int, nargs='+',
+                        help='letterbox canvas, S for a square or H W')
+    parser.add_argument('--fit_camera', action='store_true',
+                        help='fit the canvas to the aspect ratio of the camera, --img_size is its long side')
+    parser.add_argument('--pack_image_tokens', action='store_true',
+                        help='drop the letterbox padding tokens before the attention layers, same outputs')
     parser.add_argument('--max_obj_num', default=100, type=int)
     parser.add_argument('--max_lang_num', default=100, type=int)
     parser.add_argument('--num_queries', default=256, type=int)
@@ -30,6 +47,16 @@ def get_args_parser():
     parser.add_argument('--batch_size', default=16, type=int)
     parser.add_argument('--num_workers', default=8, type=int)
     parser.add_argument('--frame_num', default=2, type=int)
+    parser.add_argument('--num_points', default=30000, type=int, help='points sampled per frame')
+    parser.add_argument('--crop', action='store_true', help='crop the frames to the dataset range before sampling')
+    parser.add_argument('--ground_height', default=0., type=float, help='drop points this close to the ground, 0 keeps them')
+    parser.add_argument('--voxel_size', default=0., type=float, help='keep one point per voxel before sampling, 0 disables')
+    parser.add_argument('--own_previous_points', action='store_true',
+                        help="give the previous frames their own points instead of the current frame's, "
+                             "which the released checkpoints were trained on; changes the model inputs")
+    parser.add_argument('--dedup_frames', action='store_true',
+                        help='sample points per frame and run the backbones once per unique frame of a batch, '
+                             'previous frames are only shared between samples with --own_previous_points')
     parser.add_argument('--dynamic', default=True, action='store_true')
 
     parser.add_argument('--epochs', default=100, type=int)
@@ -45,8 +72,40 @@ def get_args_parser():
     parser.add_argument('--verbose_step', default=10, type=int)
     parser.add_argument('--pretrain', default='', type=str)
     parser.add_argument('--work_dir', default='outputs/debug', type=str)
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--eval_cache', default='', type=str,
+                        help='directory caching the preprocessed test samples for later runs, e.g. under /dev/shm; '
+                             'the cache lives in a subdirectory named after the data fingerprint')
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--butd', action='store_true')
+    parser.add_argument('--seed_keep', default=0, type=int,
+                        help='the --seed_keep the model was trained with')
+    parser.add_argument('--optimize_inference', action='store_true',
+                        help='fold the batch norms into the convs and drop the dropouts before evaluating, '
+                             'checked against the original model on the first test batch')
+    parser.add_argument('--device', default='cuda', type=str)
+    parser.add_argument('--quantize', default='', choices=['', 'dynamic', 'static'],
+                        help='evaluate the float model, quantize it to int8 (CPU only) and evaluate it again')
+    parser.add_argument('--calib_batches', default=8, type=int, help='train batches observed by --quantize static')
+    parser.add_argument('--save_quantized', default='', type=str, help='where to save the --quantize model')
+    parser.add_argument('--quantized', default='', type=str, help='evaluate a model saved by --save_quantized')
+    parser.add_argument('--query_pruning', default=[''], type=str, nargs='+',
+                        help="keep only the best queries as decoding goes, '0:64,3:16' keeps 64 before the first "
+                             "decoder layer and 16 after the third; several schedules (and 'none') are evaluated "
+                             "one after the other into an accuracy / latency table")
+    parser.add_argument('--results_dir', default='', type=str,
+                        help='stream the per-sample results there, read them with datasets.results.read_results')
+    parser.add_argument('--checkpoints', default=[], type=str, nargs='+',
+                        help='evaluate these checkpoints in one pass over the data, sharing their frozen modules')
+    parser.add_argument('--num_shards', default=0, type=int,
+                        help='split the test set into this many shards, each predicted by its own process')
+    parser.add_argument('--shard_dir', default='', type=str,
+                        help='where the shards stream their predictions, rerun with it to redo only failed shards')
+    parser.add_argument('--shard_devices', default=[], type=str, nargs='+',
+                        help='one concurrent process per entry, e.g. cuda:0 cuda:1 or cpu cpu cpu cpu; '
+                             'defaults to --device once per shard')
+    parser.add_argument('--shard_threads', default=0, type=int, help='torch threads per shard process, 0 keeps the default')
+    parser.add_argument('--retries', default=1, type=int, help='restarts of a failed shard process')
     args = parser.parse_args()
     if args.debug:
         args.work_dir = "debug"
@@ -58,35 +117,33 @@ def get_prediction(end_points):
     pred_center = end_points['last_center'].detach().cpu()
     pred_size = end_points["last_pred_size"].detach().cpu()
     pred_boxes = torch.concat([pred_center, pred_size], dim=-1).numpy()
-    proj_tokens = end_points['proj_tokens']  # (B, tokens, 64)
-    proj_queries = end_points['last_proj_queries']  # (B, Q, 64)
-    sem_scores = torch.matmul(proj_queries, proj_tokens.transpose(-1, -2))
-    sem_scores_ = sem_scores / 0.07  # (B, Q, tokens)
-    sem_scores = torch.softmax(sem_scores_, dim=-1)
-    token = end_points['tokenized']
-    mask = token['attention_mask'].detach().cpu()
-    last_pos = mask.sum(1) - 2
-
-    bs = sem_scores.shape[0]
-    pred_box = np.zeros((bs, 7))
-    for i in range(bs):
-        sim = 1 - sem_scores[i, :, last_pos[i]]
-        max_idx = torch.argmax(sim)
-        box = pred_boxes[i, max_idx.item()]
-        pred_box[i, :6] = box
+    # the query least aligned with the "not mentioned" token
+    scores = text_scores(end_points['last_proj_queries'], end_points['proj_tokens'],
+                         end_points['tokenized']['attention_mask'])
+    best = scores.argmax(1).cpu().numpy()
+
+    pred_box = np.zeros((len(best), 7))
+    pred_box[:, :6] = pred_boxes[np.arange(len(best)), best]
     return pred_box
 
 @torch.no_grad()
 def evaluate(args, model, dataset, dataloader):
     model.eval()
     loss = 0
+    forward_time = 0
     total_predict_boxes = []
-    for input_data in tqdm(dataloader, colour='red', unit=' data'):
+    for input_data in tqdm(profiler.iterate(dataloader, 'test/data_wait'), colour='red', unit=' data'):
+        if PROFILE_KEY in input_data:
+            profiler.merge(input_data.pop(PROFILE_KEY))
         for key in input_data:
             if isinstance(input_data[key], torch.Tensor):
-                input_data[key] = input_data[key].cuda()
+                input_data[key] = input_data[key].to(args.device)
 
+        start = time.perf_counter()
         end_points = model(input_data)
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        forward_time += time.perf_counter() - start
 
         for key in input_data:
             if key not in end_points:
@@ -96,27 +153,216 @@ def evaluate(args, model, dataset, dataloader):
         total_predict_boxes.append(pred_box)
     predict_boxes = np.vstack(total_predict_boxes)
     
-    acc25, acc50, m_iou = dataset.evaluate(predict_boxes, output_path=f"")  # /public/home/linzx/visual_results/{args.dataset}/ours.pkl
+    acc25, acc50, m_iou = dataset.evaluate(predict_boxes, output_path=args.results_dir)
     loss = loss / len(dataloader)
 
     info = f"Acc25={acc25} Acc50={acc50} mIoU={m_iou}"
     print(info)
+    return {'Acc25': acc25, 'Acc50': acc50, 'mIoU': m_iou, 'ms/batch': 1000 * forward_time / len(dataloader)}
+
+def source_dataset(args, dataset, allocate=True):
+    """The dataset, through --eval_cache if set; allocate=False only opens a cache another process built."""
+    if args.eval_cache:
+        return CachedDataset(dataset, args.eval_cache, fingerprint(args, 'test', len(dataset), dataset.fields),
+                             allocate=allocate)
+    return dataset
+
+def example_inputs(args, loader):
+    """The forward arguments of the --optimize_inference check: the first batch of `loader` on args.device."""
+    batch = next(iter(loader), None)
+    if batch is None:
+        return None
+    batch.pop(PROFILE_KEY, None)
+    return ({k: v.to(args.device) if isinstance(v, torch.Tensor) else v for k, v in batch.items()},)
+
+def build_model(args, loader=None):
+    """The model to evaluate; the --optimize_inference rewrite is checked on the first batch of `loader`."""
+    if args.quantized:
+        assert args.device == 'cpu', 'quantized kernels are CPU-only, run with --device cpu'
+        model, meta = load_quantized(args.quantized, create_model(args, pretrained=False))
+        print("Loaded int8 model, its quantization report:")
+        print_report(meta['reports'])
+    else:
+        model = create_model_from_checkpoint(args, load_state(args.pretrain), device=args.device)
+    if args.optimize_inference:
+        example = example_inputs(args, loader) if loader is not None else None
+        print("Optimized for inference:", optimize_for_inference(model, example))
+    model.query_pruning = parse_schedule(args.query_pruning[0], args.num_decoder_layers)
+    return model
+
+@torch.no_grad()
+def predict_shard(args, shard, device):
+    """Predict the boxes of one shard of the test set, streaming them to args.shard_dir."""
+    args = argparse.Namespace(**vars(args))
+    args.device = device
+    if args.shard_threads > 0:
+        torch.set_num_threads(args.shard_threads)
+    set_random_seed(args.seed)
+    dataset = create_dataset(args, 'test', required_fields(args, 'infer'))
+    indices = shard_range(len(dataset), args.num_shards, shard)
+    writer = ShardWriter(args.shard_dir, shard, args.num_shards, width=7)
+    # a retried shard continues after the rows it wrote before failing
+    remaining = Subset(source_dataset(args, dataset, allocate=False), indices[writer.rows:])
+    collate_fn = collate_unique_frames if args.dedup_frames else None
+    loader = DataLoader(remaining, args.batch_size, shuffle=False, num_workers=args.num_workers, collate_fn=collate_fn)
+    model = build_model(args, loader)
+    model.eval()
+    for input_data in tqdm(loader, desc=f'shard {shard}', unit=' data', position=shard % 8):
+        input_data.pop(PROFILE_KEY, None)
+        for key in input_data:
+            if isinstance(input_data[key], torch.Tensor):
+                input_data[key] = input_data[key].to(args.device)
+        end_points = model(input_data)
+        for key in input_data:
+            if key not in end_points:
+                end_points[key] = input_data[key]
+        writer.write(get_prediction(end_points))
+    writer.finish(len(indices))
+
+def evaluate_sharded(args, dataset):
+    """Predict the shards in parallel processes, merge them in dataset order and compute the metrics."""
+    assert not args.quantize, '--quantize evaluates in one process, save the model and pass --quantized instead'
+    args.shard_dir = args.shard_dir or os.path.join(args.work_dir, 'shards')
+    check_manifest(args.shard_dir, {
+        'checkpoint': file_identity(args.quantized or args.pretrain),
+        'data': fingerprint(args, 'test', len(dataset), dataset.fields),
+        'num_shards': args.num_shards,
+        'optimize_inference': args.optimize_inference,
+        'query_pruning': args.query_pruning[0],
+    })
+    # the shards, and the retries of failed ones, only open the cache built here
+    source_dataset(args, dataset)
+    devices = args.shard_devices or [args.device] * args.num_shards
+    start = time.perf_counter()
+    failed = run_shards(functools.partial(predict_shard, args), args.shard_dir, args.num_shards, devices,
+                        retries=args.retries)
+    if failed:
+        raise RuntimeError(f'shards {failed} failed, rerun with --shard_dir {args.shard_dir} to redo only them')
+    predict_boxes = merge_shards(args.shard_dir, args.num_shards)
+    print(f"Predicted {len(predict_boxes)} samples in {args.num_shards} shards in {time.perf_counter() - start:.1f}s")
+    acc25, acc50, m_iou = dataset.evaluate(predict_boxes, output_path=args.results_dir)
+    print(f"Acc25={acc25} Acc50={acc50} mIoU={m_iou}")
+    return {'Acc25': acc25, 'Acc50': acc50, 'mIoU': m_iou}
+
+@torch.no_grad()
+def evaluate_checkpoints(args, dataset, dataloader):
+    """Evaluate every checkpoint of args.checkpoints in a single pass over the data, one report per checkpoint."""
+    models = []
+    example = example_inputs(args, dataloader) if args.optimize_inference else None
+    for path in args.checkpoints:
+        model = create_model_from_checkpoint(args, load_state(path), device=args.device)
+        if args.optimize_inference:
+            optimize_for_inference(model, example)
+        model.query_pruning = parse_schedule(args.query_pruning[0], args.num_decoder_layers)
+        models.append(model)
+    model = MultiCheckpointModel(models).eval()
+    print(f"Shared by the {len(models)} checkpoints: {', '.join(model.shared) or 'nothing'}")
+    total_predict_boxes = [[] for _ in models]
+    forward_time = 0
+    for input_data in tqdm(profiler.iterate(dataloader, 'test/data_wait'), colour='red', unit=' data'):
+        if PROFILE_KEY in input_data:
+            profiler.merge(input_data.pop(PROFILE_KEY))
+        for key in input_data:
+            if isinstance(input_data[key], torch.Tensor):
+                input_data[key] = input_data[key].to(args.device)
+
+        start = time.perf_counter()
+        outputs = model(input_data)
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        forward_time += time.perf_counter() - start
+
+        for boxes, end_points in zip(total_predict_boxes, outputs):
+            for key in input_data:
+                if key not in end_points:
+                    end_points[key] = input_data[key]
+            boxes.append(get_prediction(end_points))
+
+    reports = {}
+    for i, (path, boxes) in enumerate(zip(args.checkpoints, total_predict_boxes)):
+        output_path = os.path.join(args.results_dir, str(i)) if args.results_dir else ''
+        acc25, acc50, m_iou = dataset.evaluate(np.vstack(boxes), output_path=output_path)
+        reports[path] = {'Acc25': acc25, 'Acc50': acc50, 'mIoU': m_iou}
+    print_report(reports, columns=['Acc25', 'Acc50', 'mIoU'])
+    print(f"{1000 * forward_time / len(dataloader):.1f} ms/batch for all {len(models)} checkpoints")
+    return reports
+
+def evaluate_query_pruning(args, model, dataset, dataloader):
+    """Evaluate the model under every schedule of args.query_pruning, one accuracy / latency row each."""
+    assert not args.quantize, 'compare the pruning schedules of one model, quantize it in another run'
+    results_dir = args.results_dir
+    reports = {}
+    for i, text in enumerate(args.query_pruning):
+        model.query_pruning = parse_schedule(text, args.num_decoder_layers)
+        args.results_dir = os.path.join(results_dir, str(i)) if results_dir else ''
+        reports[format_schedule(model.query_pruning, args.num_queries)] = evaluate(args, model, dataset, dataloader)
+    args.results_dir = results_dir
+    print_report(reports, columns=['Acc25', 'Acc50', 'mIoU', 'ms/batch'])
+    return reports
+
+def calibration_batches(args, collate_fn):
+    """The first --calib_batches batches of a seeded shuffle of the train split."""
+    dataset = create_dataset(args, 'train', required_fields(args, 'infer'))
+    loader = DataLoader(dataset, args.batch_size, shuffle=True, num_workers=args.num_workers,
+                        generator=torch.Generator().manual_seed(args.seed), collate_fn=collate_fn)
+    batches = []
+    for batch, _ in zip(loader, range(args.calib_batches)):
+        batch.pop(PROFILE_KEY, None)
+        batches.append({k: v.to(args.device) if isinstance(v, torch.Tensor) else v for k, v in batch.items()})
+    return batches
+
+def print_report(reports, columns=('Acc25', 'Acc50', 'mIoU', 'ms/batch', 'MB')):
+    width = max([10] + [len(name) + 2 for name in reports])
+    print(f"{'model':<{width}}" + ''.join(f'{c:>10}' for c in columns))
+    for name, report in reports.items():
+        print(f'{name:<{width}}' + ''.join(f'{float(report[c]):>10.4f}' for c in columns))
 
 def main(args):
     set_random_seed(args.seed)
+    if args.profile:
+        profiler.enable()
 
+    assert len(args.query_pruning) == 1 or not (args.num_shards or args.checkpoints), \
+        'several --query_pruning schedules are compared in a plain evaluation, without shards or --checkpoints'
     print("Create Dataset")
-    test_dataset = create_dataset(args, 'test')
+    test_dataset = create_dataset(args, 'test', required_fields(args, 'infer'))
+    if args.num_shards > 0:
+        evaluate_sharded(args, test_dataset)
+        return
     generator = torch.Generator()
-    test_loader = DataLoader(test_dataset, args.batch_size, shuffle=False, num_workers=args.num_workers, generator=generator)
+    collate_fn = collate_unique_frames if args.dedup_frames else None
+    test_loader = DataLoader(source_dataset(args, test_dataset), args.batch_size, shuffle=False, num_workers=args.num_workers,
+                             generator=generator, collate_fn=collate_fn)
+
+    if args.checkpoints:
+        evaluate_checkpoints(args, test_dataset, test_loader)
+        return
 
     print("Create Model")
-    model = create_model(args)
-    model.load_state_dict(torch.load(args.pretrain, map_location='cpu')['model'], strict=True)
+    start = time.perf_counter()
+    model = build_model(args, test_loader)
+    print(f"Model ready in {time.perf_counter() - start:.2f}s")
 
-    model.cuda()
-    evaluate(args, model, test_dataset, test_loader)
+    if len(args.query_pruning) > 1:
+        evaluate_query_pruning(args, model, test_dataset, test_loader)
+    elif not args.quantize:
+        evaluate(args, model, test_dataset, test_loader)
+    else:
+        assert args.device == 'cpu', 'quantized kernels are CPU-only, run with --device cpu'
+        reports = {'float': evaluate(args, model, test_dataset, test_loader)}
+        reports['float']['MB'] = serialized_size(model) / 2 ** 20
+        calibration = calibration_batches(args, collate_fn) if args.quantize == 'static' else None
+        recipe = quantize_model(model, args.quantize, calibration)
+        reports[args.quantize] = evaluate(args, model, test_dataset, test_loader)
+        reports[args.quantize]['MB'] = serialized_size(model) / 2 ** 20
+        print_report(reports)
+        if args.save_quantized:
+            save_quantized(model, recipe, args.save_quantized, reports=reports)
 
+    if profiler.enabled:
+        print(profiler.format_summary())
+        os.makedirs(args.work_dir, exist_ok=True)
+        profiler.export_chrome_trace(os.path.join(args.work_dir, 'trace.json'))
     return
 
 if __name__ == '__main__':
@@ -6,11 +6,19 @@ import argparse
 import numpy as np
 import random
 import torch
-from datasets import create_dataset
+from datasets import create_dataset, required_fields
+from datasets.cache import fingerprint, shared_cache
+from datasets.collate import collate_unique_frames
 from models import create_model
+from models.activation_checkpoint import STAGES, enable_activation_checkpointing
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
+from datasets.samplers import DistributedSampler, ResumableSampler, SceneAwareSampler, seed_worker
 from time import time
 from utils.logger import Logger
+from utils.checkpoint import load_state, load_model_state
+from utils.profiler import profiler, PROFILE_KEY
+from utils.dist import cleanup, gather_in_order, get_rank, get_world_size, init_distributed, is_main_process, reduce_mean
 from tqdm import tqdm
 from models.losses import HungarianMatcher, SetCriterion, compute_hungarian_loss
 from transformers import RobertaTokenizerFast
@@ -26,7 +34,14 @@ def set_random_seed(seed):#随机数种子
 def get_args_parser():#参数调用
     parser = argparse.ArgumentParser('Set config')
     parser.add_argument('--dataset', default='', type=str)
-    parser.add_argument('--img_size', default=384, type=int)
+    parser.add_argument('--src_path', default='', type=str, help='dataset root, defaults to the SRC_PATH of the dataset')
+    parser.add_argument('--data_root', default='data', type=str, help='directory of the annotation json files')
+    parser.add_argument('--img_size', default=[384], type=int, nargs='+',
+                        help='letterbox canvas, S for a square or H W')
+    parser.add_argument('--fit_camera', action='store_true',
+                        help='fit the canvas to the aspect ratio of the camera, --img_size is its long side')
+    parser.add_argument('--pack_image_tokens', action='store_true',
+                        help='drop the letterbox padding tokens before the attention layers, same outputs')
     parser.add_argument('--max_obj_num', default=100, type=int)
     parser.add_argument('--max_lang_num', default=100, type=int)
     parser.add_argument('--num_queries', default=256, type=int)
@@ -35,6 +50,18 @@ def get_args_parser():#参数调用
     parser.add_argument('--batch_size', default=8, type=int)
     parser.add_argument('--num_workers', default=8, type=int)
     parser.add_argument('--frame_num', default=2, type=int)
+    parser.add_argument('--num_points', default=30000, type=int, help='points sampled per frame')
+    parser.add_argument('--crop', action='store_true', help='crop the frames to the dataset range before sampling')
+    parser.add_argument('--ground_height', default=0., type=float, help='drop points this close to the ground, 0 keeps them')
+    parser.add_argument('--voxel_size', default=0., type=float, help='keep one point per voxel before sampling, 0 disables')
+    parser.add_argument('--own_previous_points', action='store_true',
+                        help="give the previous frames their own points instead of the current frame's, "
+                             "which the released checkpoints were trained on; changes the model inputs")
+    parser.add_argument('--dedup_frames', action='store_true',
+                        help='sample points per frame and run the backbones once per unique frame of a batch, '
+                             'previous frames are only shared between samples with --own_previous_points')
+    parser.add_argument('--scene_group', default=0, type=int,
+                        help='batch runs of this many samples of nearby frames of a scene, 0 shuffles uniformly')
     parser.add_argument('--dynamic', default=True, action='store_true')
 
     parser.add_argument('--epochs', default=100, type=int)
@@ -49,9 +76,22 @@ def get_args_parser():#参数调用
     parser.add_argument('--val_epoch', default=1, type=int)
     parser.add_argument('--verbose_step', default=10, type=int)
     parser.add_argument('--pretrain', default='', type=str)
+    parser.add_argument('--keep_last_ckpt', default=0, type=int)
+    parser.add_argument('--resume', default='', type=str)
+    parser.add_argument('--ckpt_interval', default=0, type=int)
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--checkpoint_stages', default=[], type=str, nargs='*', choices=list(STAGES) + ['all'],
+                        help='recompute the activations of these stages in backward instead of keeping them')
+    parser.add_argument('--eval_cache', default='', type=str,
+                        help='directory caching the preprocessed val samples after the first eval, e.g. under /dev/shm; '
+                             'the cache lives in a subdirectory named after the data fingerprint')
     parser.add_argument('--work_dir', default='outputs/debug', type=str)
+    parser.add_argument('--device', default='cuda', type=str, help='cuda or cpu, one process per device under torchrun')
+    parser.add_argument('--dist_backend', default='', type=str, help='defaults to nccl on cuda and gloo on cpu')
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--butd', action='store_true')
+    parser.add_argument('--seed_keep', default=0, type=int,
+                        help='send only the k seeds most relevant to the text through the cross encoder, 0 sends all')
     args = parser.parse_args()
     if args.debug:
         args.work_dir = "debug"
@@ -101,49 +141,71 @@ def get_prediction(end_points):
         pred_box[i, :6] = box
     return pred_box
 
-def train_one_epoch(ep, dataloader, model, criterion, set_criterion, optimizer, scheduler, epochs, logger, verbose_step=1):
+def train_one_epoch(ep, dataloader, model, criterion, set_criterion, optimizer, scheduler, epochs, logger, verbose_step=1,
+                    sampler=None, ckpt_interval=0, save_checkpoint=None, device='cuda'):
     model.train()
-    for idx, input_data in enumerate(tqdm(dataloader, ncols=0, unit=' data')):
-        for key in input_data:
-            if isinstance(input_data[key], torch.Tensor):
-                input_data[key] = input_data[key].cuda()
+    # when resuming mid-epoch the sampler only yields the remaining samples
+    start_idx = sampler.cursor // dataloader.batch_size if sampler is not None else 0
+    num_iters = start_idx + len(dataloader)
+    for idx, input_data in enumerate(tqdm(profiler.iterate(dataloader, 'train/data_wait'), ncols=0, unit=' data',
+                                          disable=not is_main_process()), start_idx):
+        if PROFILE_KEY in input_data:
+            profiler.merge(input_data.pop(PROFILE_KEY))
+        with profiler.stage('train/to_device'):
+            for key in input_data:
+                if isinstance(input_data[key], torch.Tensor):
+                    input_data[key] = input_data[key].to(device)
 
         optimizer.zero_grad()
-        end_points = model(input_data)
+        with profiler.stage('train/forward'):
+            end_points = model(input_data)
 
         for key in input_data:
             if key not in end_points:
                 end_points[key] = input_data[key]
         
         # Compute loss
-        loss, end_points = compute_loss(
-            end_points, criterion, set_criterion
-        )
+        with profiler.stage('train/loss'):
+            loss, end_points = compute_loss(
+                end_points, criterion, set_criterion
+            )
 
         optimizer.zero_grad()
-        loss.backward()
-        grad_total_norm = torch.nn.utils.clip_grad_norm_(
-            model.parameters(), 0.1
-        )
-        optimizer.step()
-        scheduler.step()
+        with profiler.stage('train/backward'):
+            loss.backward()
+        with profiler.stage('train/optimizer'):
+            grad_total_norm = torch.nn.utils.clip_grad_norm_(
+                model.parameters(), 0.1
+            )
+            optimizer.step()
+            scheduler.step()
+        if sampler is not None:
+            sampler.cursor += len(input_data['text'])
+            if ckpt_interval > 0 and (idx + 1) % ckpt_interval == 0:
+                save_checkpoint()
 
-        logger.tf_log("TrainIter/Loss", loss.item(), ep * len(dataloader) + idx)
-        if idx % verbose_step == 0:
-            info = f"TRN Epoch[{ep}|{epochs}][{idx}|{len(dataloader)}] loss={round(loss.item(), 4)} "\
+        logger.tf_log("TrainIter/Loss", loss.item(), ep * num_iters + idx)
+        if idx % verbose_step == 0 and is_main_process():
+            info = f"TRN Epoch[{ep}|{epochs}][{idx}|{num_iters}] loss={round(loss.item(), 4)} "\
                    f"lr={optimizer.param_groups[0]['lr']}"
             print(' ', info)
             logger(info)
+            if profiler.enabled:
+                profiler.log_tensorboard(logger, ep * num_iters + idx)
 
 @torch.no_grad()
-def evaluate(ep, model, dataset, dataloader, criterion, set_criterion, epochs, logger, best_score, name):
+def evaluate(ep, model, dataset, dataloader, criterion, set_criterion, epochs, logger, best_score, name, device='cuda'):
     model.eval()
     loss = 0
     total_predict_boxes = []
-    for input_data in tqdm(dataloader, colour='red', unit=' data'):
+    # under torchrun every process predicts its share, the boxes are gathered back into dataset order
+    sample_indices = list(dataloader.sampler)
+    for input_data in tqdm(dataloader, colour='red', unit=' data', disable=not is_main_process()):
+        if PROFILE_KEY in input_data:
+            profiler.merge(input_data.pop(PROFILE_KEY))
         for key in input_data:
             if isinstance(input_data[key], torch.Tensor):
-                input_data[key] = input_data[key].cuda()
+                input_data[key] = input_data[key].to(device)
 
         end_points = model(input_data)
 
@@ -158,13 +220,14 @@ def evaluate(ep, model, dataset, dataloader, criterion, set_criterion, epochs, l
 
         pred_box = get_prediction(end_points)
         total_predict_boxes.append(pred_box)
-    predict_boxes = np.vstack(total_predict_boxes)
+    predict_boxes = gather_in_order(sample_indices, np.vstack(total_predict_boxes), len(dataset))
     
     acc25, acc50, m_iou = dataset.evaluate(predict_boxes)
-    loss = loss / len(dataloader)
+    loss = reduce_mean(loss / len(dataloader))
 
-    info = f"{name} Epoch[{ep}] Acc25={acc25} Acc50={acc50} mIoU={m_iou} loss={round(loss.item(), 4)}"
-    print(info)
+    info = f"{name} Epoch[{ep}] Acc25={acc25} Acc50={acc50} mIoU={m_iou} loss={round(loss, 4)}"
+    if is_main_process():
+        print(info)
     logger(info)
     logger.tf_log(f"{name}/Acc25", acc25, ep)
     logger.tf_log(f"{name}/Acc50", acc50, ep)
@@ -172,32 +235,64 @@ def evaluate(ep, model, dataset, dataloader, criterion, set_criterion, epochs, l
     logger.tf_log(f"{name}/loss", loss, ep)
 
     if name == 'EVAL' and acc25 > best_score:
-        logger.save_model(model, f"best_model.pth")
+        logger.save_model(model, f"best_model.pth", epoch=ep, best_score=acc25)
         best_score = acc25
         best_info = f"Best Epoch[{ep}] Acc25={best_score}"
-        print(best_info)
+        if is_main_process():
+            print(best_info)
         logger(best_info)
 
     return best_score
 
 def main(args):
+    device = init_distributed(args.device, args.dist_backend)
+    rank, world_size = get_rank(), get_world_size()
     set_random_seed(args.seed)
+    if args.profile:
+        # before the DataLoaders fork their workers
+        profiler.enable()
     print("Create Logger")
-    logger = Logger(args.work_dir)
+    logger = Logger(args.work_dir, args.keep_last_ckpt, enabled=is_main_process())
     logger(str(args))
     
     print("Create Dataset")
-    train_dataset = create_dataset(args, 'train')
-    val_dataset = create_dataset(args, 'val')
+    train_dataset = create_dataset(args, 'train', required_fields(args, 'train'))
+    val_dataset = create_dataset(args, 'val', required_fields(args, 'eval'))
     generator = torch.Generator()
-    train_loader = DataLoader(train_dataset, args.batch_size, shuffle=True, num_workers=args.num_workers, generator=generator)
-    val_loader = DataLoader(val_dataset, args.batch_size, shuffle=False, num_workers=args.num_workers, generator=generator)
-    overfit_loader = DataLoader(train_dataset, args.batch_size, shuffle=False, num_workers=args.num_workers, generator=generator)
+    generator.manual_seed(args.seed)
+    if args.scene_group > 0:
+        train_sampler = SceneAwareSampler(train_dataset, group_size=args.scene_group, seed=args.seed)
+    else:
+        train_sampler = ResumableSampler(train_dataset, shuffle=True, seed=args.seed)
+
+    def shard(sampler):
+        if world_size == 1:
+            return sampler
+        return DistributedSampler(sampler, world_size, rank, args.batch_size)
+
+    train_sampler = shard(train_sampler)
+    collate_fn = collate_unique_frames if args.dedup_frames else None
+    train_loader = DataLoader(train_dataset, args.batch_size, sampler=train_sampler, num_workers=args.num_workers,
+                              generator=generator, worker_init_fn=seed_worker, collate_fn=collate_fn)
+    val_source = val_dataset
+    if args.eval_cache:
+        # rank 0 builds the cache, the other ranks open it once it is there
+        val_source = shared_cache(val_dataset, args.eval_cache,
+                                  fingerprint(args, 'val', len(val_dataset), val_dataset.fields))
+    val_loader = DataLoader(val_source, args.batch_size, sampler=shard(ResumableSampler(val_source, shuffle=False)),
+                            num_workers=args.num_workers, generator=generator, worker_init_fn=seed_worker,
+                            collate_fn=collate_fn)
+    overfit_loader = DataLoader(train_dataset, args.batch_size, sampler=shard(ResumableSampler(train_dataset, shuffle=False)),
+                                num_workers=args.num_workers, generator=generator, worker_init_fn=seed_worker,
+                                collate_fn=collate_fn)
 
     print("Create Model")
     model = create_model(args)
+    if args.checkpoint_stages:
+        print(f"Checkpoint {enable_activation_checkpointing(model, args.checkpoint_stages)} modules "
+              f"of {', '.join(args.checkpoint_stages)}")
     if args.pretrain:
-        missing_keys, unexpected_keys = model.load_state_dict(torch.load(args.pretrain, map_location='cpu')['model'], strict=False)
+        missing_keys, unexpected_keys = load_model_state(model, load_state(args.pretrain), strict=False)
         print(f"missing_keys: {missing_keys}")
         print(f"unexpected_keys: {unexpected_keys}")
     
@@ -229,16 +324,46 @@ def main(args):
     best_score = -1
     start_epoch = 0
     print(torch.cuda.is_available())
-    model.cuda(0)
+    model.to(device)
+    model_without_ddp = model
+    if world_size > 1:
+        # some branches (butd, the image fuser without images) leave parameters without gradients
+        model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None,
+                                        find_unused_parameters=True)
+        model_without_ddp = model.module
+    if args.resume:
+        # model, optimizer, scheduler, sampler cursor and every RNG in one go
+        start_epoch, best_score = logger.load_checkpoint(model_without_ddp, args.resume, criterion, optimizer, scheduler,
+                                                         sampler=train_sampler, generator=generator)
+        print(f"Resume from epoch {start_epoch} (+{train_sampler.cursor} samples), best_score={best_score}")
     print("Start to train the model")
     for i in range(start_epoch, args.epochs):
         ep = i + 1
-        train_one_epoch(ep, train_loader, model, criterion, set_criterion, optimizer, scheduler, args.epochs, logger, args.verbose_step)
+        train_sampler.set_epoch(i)
+        train_dataset.set_epoch(i)
+
+        def save_last():
+            logger.save_model(model_without_ddp, "last.pth", epoch=i, best_score=best_score,\
+                                criterion=criterion, optimizer=optimizer, scheduler=scheduler,\
+                                sampler=train_sampler, generator=generator)
+
+        train_one_epoch(ep, train_loader, model, criterion, set_criterion, optimizer, scheduler, args.epochs, logger, args.verbose_step,
+                        sampler=train_sampler, ckpt_interval=args.ckpt_interval, save_checkpoint=save_last, device=device)
         if ep % 1 == 0:
-            evaluate(ep, model, train_dataset, overfit_loader, criterion, set_criterion, args.epochs, logger, best_score, 'TRAIN')
-            best_score = evaluate(ep, model, val_dataset, val_loader, criterion, set_criterion, args.epochs, logger, best_score, 'EVAL')
-            logger.save_model(model, f"epoch_{ep}_model.pth", epoch=ep, best_score=best_score,\
-                                criterion=criterion, optimizer=optimizer, scheduler=scheduler)
+            evaluate(ep, model_without_ddp, train_dataset, overfit_loader, criterion, set_criterion, args.epochs, logger,
+                     best_score, 'TRAIN', device=device)
+            best_score = evaluate(ep, model_without_ddp, val_dataset, val_loader, criterion, set_criterion, args.epochs,
+                                  logger, best_score, 'EVAL', device=device)
+            logger.save_model(model_without_ddp, f"epoch_{ep}_model.pth", epoch=ep, best_score=best_score,\
+                                criterion=criterion, optimizer=optimizer, scheduler=scheduler,\
+                                sampler=train_sampler, generator=generator)
+        if profiler.enabled and is_main_process():
+            summary = profiler.format_summary()
+            print(summary)
+            logger(summary)
+            profiler.export_chrome_trace(os.path.join(logger.work_dir, 'trace.json'))
+    logger.close()
+    cleanup()
     return
 
 if __name__ == '__main__':
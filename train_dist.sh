@@ -0,0 +1,4 @@
+export CUDA_VISIBLE_DEVICES=0,1,2,3
+# one process per GPU; --batch_size is per process
+torchrun --standalone --nproc_per_node 4 train.py --dataset strefer --max_lang_num 100 --work_dir log/STRefer --batch_size 8
+# python train.py on a single device is unchanged; on CPU, gloo: torchrun --standalone --nproc_per_node 2 train.py --device cpu ...
@@ -11,7 +11,6 @@ from __future__ import print_function
 import torch
 
 import numpy as np
-from scipy.spatial import ConvexHull
 import cv2
 
 def resize_img_keep_ratio(img, target_size):
@@ -107,6 +106,7 @@ def convex_hull_intersection(p1, p2):
     """
     inter_p = polygon_clip(p1,p2)
     if inter_p is not None:
+        from scipy.spatial import ConvexHull
         hull_inter = ConvexHull(inter_p)
         return inter_p, hull_inter.volume
     else:
@@ -0,0 +1,234 @@
+"""
+Checkpoint I/O.
+
+Checkpoints only store the tensors that training can change. Parameters and
+buffers that come straight from a pretrained source (RoBERTa, the frozen
+ResNet-34 layers) are listed in a manifest instead, and are taken from the
+freshly constructed model when the checkpoint is loaded.
+
+Saving snapshots the tensors to CPU on the calling thread and serializes them
+from a background thread, so the training loop only pays for the device copy.
+Files use the torch zip format, which `torch.load(..., mmap=True)` maps
+without reading the whole file up front.
+"""
+import copy
+import inspect
+import os
+import os.path as osp
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+CKPT_FORMAT = 'wildrefer-ckpt'
+CKPT_VERSION = 1
+
+# State-dict prefixes whose untrained tensors are restored from a pretrained
+# source rather than from the checkpoint file.
+PRETRAINED_SOURCES = {
+    'text_encoder.': 'huggingface:roberta-base',
+    'image_backbone_net.body.': 'torchvision:resnet34',
+}
+
+_LOAD_KWARGS = inspect.signature(torch.load).parameters
+
+
+def frozen_state_keys(model, sources=PRETRAINED_SOURCES):
+    """Return state-dict keys that come from a pretrained source and are not trained."""
+    trainable = {n for n, p in model.named_parameters() if p.requires_grad}
+    keys = []
+    for key in model.state_dict().keys():
+        if key in trainable:
+            continue
+        if any(key.startswith(prefix) for prefix in sources):
+            keys.append(key)
+    return keys
+
+
+def _fingerprint(tensors):
+    """Cheap content signature (sum, norm) per tensor, computed with one sync."""
+    if len(tensors) == 0:
+        return torch.zeros((0, 2), dtype=torch.float64)
+    sig = []
+    for t in tensors:
+        t = t.detach()
+        if not t.is_floating_point():
+            t = t.double()
+        sig.append(torch.stack([
+            t.sum(dtype=torch.float64),
+            torch.linalg.vector_norm(t, dtype=torch.float64)
+        ]))
+    return torch.stack(sig).cpu()
+
+
+def to_cpu(obj):
+    """Recursively copy every tensor in obj to CPU so training can keep mutating the originals."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        # copy first so dict subclasses (Counter, OrderedDict, ...) keep their type
+        out = copy.copy(obj)
+        for k, v in obj.items():
+            out[k] = to_cpu(v)
+        return out
+    if isinstance(obj, tuple) and hasattr(obj, '_fields'):
+        return type(obj)(*(to_cpu(v) for v in obj))
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def capture_rng_state(generator=None):
+    """Return the python, numpy, torch (and cuda) RNG states, plus `generator`'s if given."""
+    state = dict()
+    state['python'] = random.getstate()
+    state['numpy'] = np.random.get_state()
+    state['torch'] = torch.get_rng_state()
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    if generator is not None:
+        state['generator'] = generator.get_state()
+    return state
+
+
+def restore_rng_state(state, generator=None):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    if generator is not None and 'generator' in state:
+        generator.set_state(state['generator'])
+
+
+def load_state(path):
+    """Load a checkpoint dict on CPU, memory-mapping it when the file format allows."""
+    kwargs = dict(map_location='cpu')
+    if 'weights_only' in _LOAD_KWARGS:
+        kwargs['weights_only'] = False
+    if 'mmap' in _LOAD_KWARGS:
+        try:
+            return torch.load(path, mmap=True, **kwargs)
+        except RuntimeError:
+            # legacy (non-zip) files cannot be mapped
+            pass
+    return torch.load(path, **kwargs)
+
+
+def load_model_state(model, state, strict=True):
+    """
+    Load state['model'] into model.
+
+    Keys listed as frozen in the manifest are expected to be missing, they
+    keep the values the model was constructed with. Returns the remaining
+    (missing_keys, unexpected_keys).
+    """
+    manifest = state.get('manifest', {})
+    frozen = set(manifest.get('frozen_keys', []))
+    missing_keys, unexpected_keys = model.load_state_dict(state['model'], strict=False)
+    missing_keys = [k for k in missing_keys if k not in frozen]
+    if strict and (missing_keys or unexpected_keys):
+        raise RuntimeError(
+            f"Error(s) in loading state_dict for {model.__class__.__name__}:\n"
+            f"\tMissing key(s): {missing_keys}\n\tUnexpected key(s): {unexpected_keys}"
+        )
+    return missing_keys, unexpected_keys
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints of `model` from a background thread.
+
+    Args:
+        work_dir: directory the checkpoint paths are relative to
+        model: the model to checkpoint, used to find frozen pretrained tensors
+        keep_last: number of rolling checkpoints to keep, 0 keeps all
+        protected: file names never removed by the retention policy
+        max_pending: snapshots allowed to wait for the writer before save() blocks
+    """
+
+    def __init__(self, work_dir, model, keep_last=0, protected=('best_model.pth',),
+                 max_pending=2, sources=PRETRAINED_SOURCES):
+        self.work_dir = work_dir
+        self.keep_last = keep_last
+        self.protected = set(protected)
+        self.sources = dict(sources)
+        self.frozen_keys = frozen_state_keys(model, self.sources)
+        state = model.state_dict()
+        self._frozen_signature = _fingerprint([state[k] for k in self.frozen_keys])
+        self._rolling = []
+        self._errors = []
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    def snapshot(self, model, **extras):
+        """Copy the trainable (or changed) model tensors and extras to CPU."""
+        state = model.state_dict()
+        signature = _fingerprint([state[k] for k in self.frozen_keys])
+        changed = (signature != self._frozen_signature).any(dim=1).tolist()
+        frozen = [k for k, c in zip(self.frozen_keys, changed) if not c]
+        skip = set(frozen)
+        ckpt = dict()
+        ckpt['format'] = CKPT_FORMAT
+        ckpt['version'] = CKPT_VERSION
+        ckpt['manifest'] = {
+            'sources': self.sources,
+            'frozen_keys': frozen,
+        }
+        ckpt['model'] = to_cpu({k: v for k, v in state.items() if k not in skip})
+        for key, value in extras.items():
+            ckpt[key] = to_cpu(value)
+        return ckpt
+
+    def save(self, path, model, **extras):
+        """Snapshot now and write to work_dir/path in the background."""
+        self._raise_errors()
+        ckpt = self.snapshot(model, **extras)
+        self._queue.put((osp.join(self.work_dir, path), ckpt))
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        self._queue.join()
+        self._raise_errors()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _raise_errors(self):
+        if self._errors:
+            raise RuntimeError('checkpoint writer failed') from self._errors.pop(0)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            path, ckpt = item
+            try:
+                tmp_path = path + '.tmp'
+                torch.save(ckpt, tmp_path)
+                os.replace(tmp_path, path)
+                self._apply_retention(path)
+            except Exception as e:
+                self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def _apply_retention(self, path):
+        if osp.basename(path) in self.protected:
+            return
+        if path in self._rolling:
+            self._rolling.remove(path)
+        self._rolling.append(path)
+        if self.keep_last <= 0:
+            return
+        while len(self._rolling) > self.keep_last:
+            old = self._rolling.pop(0)
+            if osp.exists(old):
+                os.remove(old)
@@ -0,0 +1,118 @@
+''' Testing resumable training: an interrupted run must continue bit for bit. '''
+
+import glob
+import os
+import sys
+import tempfile
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, Dataset
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from datasets.samplers import ResumableSampler, seed_worker
+from utils.logger import Logger
+
+EPOCHS = 3
+BATCH_SIZE = 4
+
+
+class ToyDataset(Dataset):
+    """Draws its randomness from (seed, epoch, index) like the STRefer datasets."""
+
+    def __init__(self, n=22, seed=0):
+        self.n = n
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __getitem__(self, index):
+        rng = np.random.default_rng((self.seed, self.epoch, index))
+        x = rng.standard_normal(8).astype(np.float32)
+        return {'x': x, 'y': np.float32(x.sum() > 0), 'text': str(index)}
+
+    def __len__(self):
+        return self.n
+
+
+def build(seed=0):
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    model = nn.Sequential(nn.Linear(8, 16), nn.ReLU(), nn.Dropout(0.5), nn.Linear(16, 1))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2, weight_decay=0.0005)
+    scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=[7, 12], gamma=0.1)
+    dataset = ToyDataset(seed=seed)
+    sampler = ResumableSampler(dataset, shuffle=True, seed=seed)
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    loader = DataLoader(dataset, BATCH_SIZE, sampler=sampler, num_workers=2,
+                        generator=generator, worker_init_fn=seed_worker)
+    return model, optimizer, scheduler, dataset, sampler, generator, loader
+
+
+def run(work_dir, resume='', stop_at=None):
+    """Train like train.py; `stop_at=(epoch, iteration)` saves last.pth there and returns."""
+    model, optimizer, scheduler, dataset, sampler, generator, loader = build()
+    logger = Logger(work_dir)
+    start_epoch, best_score = 0, -1
+    if resume:
+        start_epoch, best_score = logger.load_checkpoint(model, resume, None, optimizer, scheduler,
+                                                         sampler=sampler, generator=generator)
+    for i in range(start_epoch, EPOCHS):
+        sampler.set_epoch(i)
+        dataset.set_epoch(i)
+        model.train()
+        start_idx = sampler.cursor // BATCH_SIZE
+        for idx, batch in enumerate(loader, start_idx):
+            loss = nn.functional.binary_cross_entropy_with_logits(model(batch['x']).squeeze(-1), batch['y'])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            sampler.cursor += len(batch['text'])
+            if stop_at == (i, idx):
+                logger.save_model(model, 'last.pth', epoch=i, best_score=best_score, optimizer=optimizer,
+                                  scheduler=scheduler, sampler=sampler, generator=generator)
+                logger.close()
+                return os.path.join(logger.work_dir, 'last.pth')
+        best_score = max(best_score, -loss.item())
+        logger.save_model(model, f'epoch_{i + 1}_model.pth', epoch=i + 1, best_score=best_score,
+                          optimizer=optimizer, scheduler=scheduler, sampler=sampler, generator=generator)
+    logger.close()
+    return model, optimizer, best_score, logger.work_dir
+
+
+def assert_identical(reference, resumed):
+    ref_model, ref_optimizer, ref_best, _ = reference
+    model, optimizer, best, _ = resumed
+    assert ref_best == best
+    for (name, a), b in zip(ref_model.state_dict().items(), model.state_dict().values()):
+        assert torch.equal(a, b), name
+    for a, b in zip(ref_optimizer.state_dict()['state'].values(), optimizer.state_dict()['state'].values()):
+        assert torch.equal(a['exp_avg'], b['exp_avg'])
+        assert torch.equal(a['exp_avg_sq'], b['exp_avg_sq'])
+
+
+def test_resume_mid_epoch():
+    with tempfile.TemporaryDirectory() as work_dir:
+        reference = run(os.path.join(work_dir, 'reference'))
+        last = run(os.path.join(work_dir, 'interrupted'), stop_at=(1, 2))
+        resumed = run(os.path.join(work_dir, 'resumed'), resume=last)
+        assert_identical(reference, resumed)
+
+
+def test_resume_epoch_boundary():
+    with tempfile.TemporaryDirectory() as work_dir:
+        reference = run(os.path.join(work_dir, 'reference'))
+        last = glob.glob(os.path.join(reference[-1], 'epoch_1_model.pth'))[0]
+        resumed = run(os.path.join(work_dir, 'resumed'), resume=last)
+        assert_identical(reference, resumed)
+
+
+if __name__ == '__main__':
+    test_resume_mid_epoch()
+    test_resume_epoch_boundary()
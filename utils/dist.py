@@ -0,0 +1,93 @@
+"""
+Distributed data-parallel helpers.
+
+train.py runs one process per device, started by torchrun (see
+train_dist.sh), which sets RANK, WORLD_SIZE and LOCAL_RANK:
+
+    torchrun --standalone --nproc_per_node N train.py ...
+
+init_distributed joins the process group: NCCL on CUDA, gloo on CPU, which
+is how the multi-process code paths are tested without GPUs. Without
+torchrun's variables it leaves the process alone and every helper below
+behaves as for a single process, so the single-device path is unchanged.
+"""
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def is_dist_avail_and_initialized():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_dist_avail_and_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_dist_avail_and_initialized() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_dist_avail_and_initialized():
+        dist.barrier()
+
+
+def init_distributed(device='cuda', backend=''):
+    """
+    Join the process group described by torchrun's environment and return
+    the device of this process: cuda:<LOCAL_RANK> on CUDA, `device`
+    otherwise. The backend defaults to NCCL on CUDA and gloo on CPU.
+    """
+    if 'WORLD_SIZE' not in os.environ:
+        return torch.device(device)
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    cuda = torch.device(device).type == 'cuda'
+    if cuda:
+        torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend or ('nccl' if cuda else 'gloo'))
+    return torch.device('cuda', local_rank) if cuda else torch.device(device)
+
+
+def cleanup():
+    if is_dist_avail_and_initialized():
+        dist.destroy_process_group()
+
+
+def reduce_mean(value):
+    """Mean of a float or tensor over the processes, as a float."""
+    if not is_dist_avail_and_initialized():
+        return float(value)
+    # gloo cannot reduce CUDA tensors and NCCL cannot reduce CPU ones
+    device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+    value = torch.as_tensor(float(value), dtype=torch.float64, device=device)
+    dist.all_reduce(value)
+    return value.item() / get_world_size()
+
+
+def gather_in_order(indices, values, size):
+    """
+    Assemble per-process results into dataset order: `values[i]` (rows of a
+    NumPy array) belongs to sample `indices[i]` of this process. Every process
+    gets the rows of all `size` samples; the duplicates a padded sampler
+    produces write the same sample twice.
+    """
+    values = np.asarray(values)
+    if not is_dist_avail_and_initialized():
+        parts = [(indices, values)]
+    else:
+        parts = [None] * get_world_size()
+        dist.all_gather_object(parts, (list(indices), values))
+    out = np.zeros((size,) + values.shape[1:], dtype=values.dtype)
+    seen = np.zeros(size, dtype=bool)
+    for part_indices, part_values in parts:
+        out[part_indices] = part_values
+        seen[part_indices] = True
+    assert seen.all(), f'{size - seen.sum()} samples have no result'
+    return out
@@ -0,0 +1,144 @@
+''' Testing distributed training on CPU with gloo: sharding, gathering and DDP gradients match one process. '''
+
+import os
+import socket
+import sys
+import tempfile
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from datasets.cache import shared_cache
+from datasets.samplers import DistributedSampler, ResumableSampler
+from models.losses import HungarianMatcher, SetCriterion
+from utils.dist import cleanup, gather_in_order, get_world_size, init_distributed, reduce_mean
+
+WORLD_SIZE = 2
+BATCH_SIZE = 3
+QUERIES = 8
+
+
+def test_sampler_shards():
+    data = list(range(22))
+    base = ResumableSampler(data, shuffle=True, seed=3)
+    shards = [DistributedSampler(ResumableSampler(data, shuffle=True, seed=3), WORLD_SIZE, rank, BATCH_SIZE)
+              for rank in range(WORLD_SIZE)]
+    parts = [s.indices() for s in shards]
+    # equal lengths, padded by wrapping around, every sample covered
+    assert len(parts[0]) == len(parts[1]) == len(shards[0]) == 12
+    assert sorted(set(parts[0] + parts[1])) == data
+    # every batch is a contiguous slice of the global order
+    order = base.indices()
+    assert parts[0][:BATCH_SIZE] == order[:BATCH_SIZE]
+    assert parts[1][:BATCH_SIZE] == order[BATCH_SIZE:2 * BATCH_SIZE]
+    # resume mid-epoch from the state of one process
+    shards[0].set_epoch(2)
+    shards[0].cursor = 6
+    resumed = DistributedSampler(ResumableSampler(data, shuffle=True, seed=0), WORLD_SIZE, 0, BATCH_SIZE)
+    resumed.load_state_dict(shards[0].state_dict())
+    assert list(resumed) == list(shards[0]) == shards[0].indices()[6:]
+    resumed.set_epoch(3)
+    assert resumed.cursor == 0
+
+
+def sample(i):
+    g = torch.Generator().manual_seed(i)
+    target = {
+        'labels': torch.zeros(1, dtype=torch.long),
+        'boxes': torch.cat([torch.rand(1, 3, generator=g), torch.rand(1, 3, generator=g) + 0.5], -1),
+        'positive_map': torch.tensor([[1., 0., 0., 0.]]),
+    }
+    return torch.randn(QUERIES, 16, generator=g), target
+
+
+def step(model, criterion, indices):
+    features, targets = zip(*[sample(i) for i in indices])
+    out = model(torch.stack(features))
+    boxes = torch.cat([out[..., :3], out[..., 3:6].exp()], -1)
+    losses, _ = criterion({'pred_logits': out[..., 6:], 'pred_boxes': boxes}, list(targets))
+    loss = losses['loss_bbox'] + losses['loss_giou']
+    loss.backward()
+    return loss.item()
+
+
+def make_model():
+    torch.manual_seed(0)
+    return nn.Linear(16, 10), SetCriterion(HungarianMatcher(1, 5, 2, True), losses=['boxes'], eos_coef=0.1,
+                                           temperature=0.07)
+
+
+def worker(rank, port, out_dir):
+    os.environ.update(RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(WORLD_SIZE),
+                      MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    device = init_distributed('cpu')
+    assert device.type == 'cpu' and get_world_size() == WORLD_SIZE
+    model, criterion = make_model()
+    model = DistributedDataParallel(model)
+    sampler = DistributedSampler(ResumableSampler(list(range(10)), shuffle=False), WORLD_SIZE, rank, BATCH_SIZE)
+    batch = sampler.indices()[:BATCH_SIZE]
+    step(model, criterion, batch)
+    predictions = np.asarray([[i, i * 10.] for i in sampler.indices()])
+    gathered = gather_in_order(sampler.indices(), predictions, 10)
+    torch.save({'grads': [p.grad for p in model.parameters()], 'gathered': gathered,
+                'mean': reduce_mean(rank + 1)}, os.path.join(out_dir, f'{rank}.pth'))
+    cleanup()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_ddp_matches_single_process():
+    with tempfile.TemporaryDirectory() as out_dir:
+        mp.spawn(worker, args=(free_port(), out_dir), nprocs=WORLD_SIZE)
+        results = [torch.load(os.path.join(out_dir, f'{rank}.pth'), weights_only=False) for rank in range(WORLD_SIZE)]
+    # the two processes together took the first two batches of the global order
+    model, criterion = make_model()
+    step(model, criterion, list(range(2 * BATCH_SIZE)))
+    for result in results:
+        for grad, expected in zip(result['grads'], model.parameters()):
+            assert torch.allclose(grad, expected.grad, atol=1e-6)
+        assert np.array_equal(result['gathered'], np.stack([np.arange(10), np.arange(10) * 10.], 1))
+        assert result['mean'] == 1.5
+
+
+class SeededSamples:
+    """A deterministic dataset, the samples each process reads from the shared cache."""
+
+    def __getitem__(self, index):
+        return {'point_clouds': np.random.default_rng(index).random((4, 6), dtype=np.float32), 'text': str(index)}
+
+    def __len__(self):
+        return 10
+
+
+def cache_worker(rank, port, cache_dir):
+    os.environ.update(RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(WORLD_SIZE),
+                      MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    init_distributed('cpu')
+    cached = shared_cache(SeededSamples(), cache_dir, 'val')
+    sampler = DistributedSampler(ResumableSampler(cached, shuffle=False), WORLD_SIZE, rank, BATCH_SIZE)
+    for i in sampler.indices():
+        assert np.array_equal(cached[i]['point_clouds'], SeededSamples()[i]['point_clouds'])
+    cleanup()
+
+
+def test_shared_cache():
+    """The ranks share one cache: rank 0 allocates it, the others fill their rows of it."""
+    with tempfile.TemporaryDirectory() as cache_dir:
+        mp.spawn(cache_worker, args=(free_port(), cache_dir), nprocs=WORLD_SIZE)
+        cached = shared_cache(SeededSamples(), cache_dir, 'val')
+        assert cached.is_complete() and os.listdir(cache_dir) == ['val']
+
+
+if __name__ == '__main__':
+    test_sampler_shards()
+    test_ddp_matches_single_process()
+    test_shared_cache()
@@ -0,0 +1,62 @@
+''' Testing the import cost of the inference path with `python -X importtime`. '''
+
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# what the model and the preprocessing need to be importable
+CORE_IMPORTS = ['models', 'datasets', 'utils.box_util', 'utils.pc_utils', 'utils.strefer_utils']
+# training, text parsing and visualization dependencies, loaded on first use
+LAZY_MODULES = ['spacy', 'transformers', 'torchvision', 'scipy', 'matplotlib',
+                'trimesh', 'plyfile', 'shapely']
+# third party packages the core path cannot avoid, not charged to the budget
+REQUIRED_MODULES = ['torch', 'numpy', 'cv2']
+# seconds spent importing everything else
+BUDGET = 0.5
+
+
+def import_times(modules):
+    """
+    Import `modules` in a fresh interpreter and return [(depth, name, self_us)]
+    in the post-order `-X importtime` prints them.
+    """
+    cmd = [sys.executable, '-X', 'importtime', '-c', 'import ' + ', '.join(modules)]
+    out = subprocess.run(cmd, cwd=ROOT_DIR, capture_output=True, text=True, check=True)
+    times = []
+    for line in out.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.append((depth, name.strip(), int(self_us)))
+    return times
+
+
+def charged_seconds(times, required=REQUIRED_MODULES):
+    """Total import time, leaving out everything imported under a required package."""
+    pending = []
+    for depth, name, self_us in times:
+        children = []
+        while pending and pending[-1][0] > depth:
+            children.append(pending.pop()[1])
+        charged = 0 if name.split('.')[0] in required else self_us + sum(children)
+        pending.append((depth, charged))
+    return sum(charged for _, charged in pending) / 1e6
+
+
+def test_lazy_modules_not_imported():
+    times = import_times(CORE_IMPORTS)
+    loaded = sorted({name.split('.')[0] for _, name, _ in times} & set(LAZY_MODULES))
+    assert not loaded, f'imported eagerly: {loaded}'
+
+
+def test_startup_budget():
+    seconds = charged_seconds(import_times(CORE_IMPORTS))
+    assert seconds < BUDGET, f'importing {CORE_IMPORTS} took {seconds:.2f}s beyond {REQUIRED_MODULES}'
+
+
+if __name__ == '__main__':
+    test_lazy_modules_not_imported()
+    test_startup_budget()
@@ -4,8 +4,17 @@ import datetime
 from tensorboardX import SummaryWriter
 import torch
 
+from utils.checkpoint import (
+    CheckpointWriter, load_state, load_model_state, capture_rng_state, restore_rng_state
+)
+
 class Logger:
-    def __init__(self, work_dir=None) -> None:
+    def __init__(self, work_dir=None, keep_last_ckpt=0, enabled=True) -> None:
+        # in distributed training only the main process logs and saves, the others get a disabled Logger
+        self.enabled = enabled
+        self.checkpoint_writer = None
+        if not enabled:
+            return
         current_date = datetime.datetime.now()
         month = current_date.month
         day = current_date.day
@@ -22,42 +31,77 @@ class Logger:
         self.log = osp.join(self.work_dir, "log.log")
 
         self.tensorboard_log = SummaryWriter(self.work_dir)
+        self.keep_last_ckpt = keep_last_ckpt
+        self.checkpoint_writer = None
 
         f = open(self.log, 'w')
         f.close()
     
     def __call__(self, info):
+        if not self.enabled:
+            return
         with open(self.log, 'a') as f:
             info += "\n"
             f.write(info)
     
     def tf_log(self, key, value, iter):
+        if not self.enabled:
+            return
         self.tensorboard_log.add_scalar(key, value, iter)
 
     
     def save_model(self, model, path, epoch=None, best_score=None,\
-                            criterion=None, optimizer=None, scheduler=None):
+                            criterion=None, optimizer=None, scheduler=None, sampler=None, generator=None):
+        if not self.enabled:
+            return
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter(
+                self.work_dir, model, keep_last=self.keep_last_ckpt,
+                protected=('best_model.pth', 'last.pth')
+            )
         state = dict()
-        state['model'] = model.state_dict()
         if epoch is not None:
             state['epoch'] = epoch
         if best_score is not None:
-            state['best_score'] = epoch
+            state['best_score'] = best_score
+        if hasattr(criterion, 'state_dict'):
+            state['criterion'] = criterion.state_dict()
         if optimizer is not None:
             state['optimizer'] = optimizer.state_dict()
         if scheduler is not None:
             state['scheduler'] = scheduler.state_dict()
-        torch.save(state, osp.join(self.work_dir, path))
+        if sampler is not None:
+            state['sampler'] = sampler.state_dict()
+        if epoch is not None:
+            state['rng'] = capture_rng_state(generator)
+        self.checkpoint_writer.save(path, model, **state)
     
-    def load_checkpoint(self, model, path, criterion=None, optimizer=None, scheduler=None):
-        state = torch.load(path, map_location='cpu')
-        model.load_state_dict(state['model'])
+    def load_checkpoint(self, model, path, criterion=None, optimizer=None, scheduler=None,\
+                            sampler=None, generator=None):
+        """Restore everything save_model stored, returns (epoch, best_score)."""
+        state = load_state(path)
+        load_model_state(model, state)
         epoch = state['epoch']
         best_score = state['best_score']
-        criterion.load_state_dict(state['criterion'])
-        optimizer.load_state_dict(state['optimizer'])
-        scheduler.load_state_dict(state['scheduler'])
+        if hasattr(criterion, 'load_state_dict') and 'criterion' in state:
+            criterion.load_state_dict(state['criterion'])
+        if optimizer is not None:
+            optimizer.load_state_dict(state['optimizer'])
+        if scheduler is not None:
+            scheduler.load_state_dict(state['scheduler'])
+        if sampler is not None and 'sampler' in state:
+            sampler.load_state_dict(state['sampler'])
+        if 'rng' in state:
+            restore_rng_state(state['rng'], generator)
         return epoch, best_score
     
     def load_model(self, model, path):
-        return model.load_state_dict(torch.load(path)['model'])
\ No newline at end of file
+        return load_model_state(model, load_state(path))
+
+    def close(self):
+        """Wait for pending checkpoints and flush tensorboard."""
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+            self.checkpoint_writer = None
+        if self.enabled:
+            self.tensorboard_log.close()
@@ -12,20 +12,11 @@ import sys
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(BASE_DIR)
 
-# Point cloud IO
 import numpy as np
-try:
-    from plyfile import PlyData, PlyElement
-except:
-    print("Please install the module 'plyfile' for PLY i/o, e.g.")
-    print("pip install plyfile")
-    sys.exit(-1)
-
 
-# Mesh IO
-import trimesh
-
-import matplotlib.pyplot as pyplot
+# Point cloud IO (plyfile), mesh IO (trimesh), plotting (matplotlib) and
+# polygon IoU (shapely) are imported by the functions that need them, so
+# importing this module for the sampling helpers stays cheap.
 
 # ----------------------------------------
 # Point Cloud Sampling
@@ -191,6 +182,7 @@ def point_cloud_to_image(points, imgsize, radius=1.0, num_sample=128):
 
 def read_ply(filename):
     """ read XYZ point cloud from filename PLY file """
+    from plyfile import PlyData
     plydata = PlyData.read(filename)
     pc = plydata['vertex'].data
     pc_array = np.array([[x, y, z] for x,y,z in pc])
@@ -199,13 +191,18 @@ def read_ply(filename):
 
 def write_ply(points, filename, text=True):
     """ input: Nx3, write points to filename as PLY format. """
-    points = [(points[i,0], points[i,1], points[i,2]) for i in range(points.shape[0])]
-    vertex = np.array(points, dtype=[('x', 'f4'), ('y', 'f4'),('z', 'f4')])
+    from plyfile import PlyData, PlyElement
+    vertex = np.empty(points.shape[0], dtype=[('x', 'f4'), ('y', 'f4'),('z', 'f4')])
+    vertex['x'], vertex['y'], vertex['z'] = points[:,0], points[:,1], points[:,2]
     el = PlyElement.describe(vertex, 'vertex', comments=['vertices'])
     PlyData([el], text=text).write(filename)
 
-def write_ply_color(points, labels, filename, num_classes=None, colormap=pyplot.cm.jet):
+def write_ply_color(points, labels, filename, num_classes=None, colormap=None):
     """ Color (N,3) points with labels (N) within range 0 ~ num_classes-1 as OBJ file """
+    from plyfile import PlyData, PlyElement
+    if colormap is None:
+        from matplotlib import cm
+        colormap = cm.jet
     labels = labels.astype(int)
     N = points.shape[0]
     if num_classes is None:
@@ -213,14 +210,10 @@ def write_ply_color(points, labels, filename, num_classes=None, colormap=pyplot.
     else:
         assert(num_classes>np.max(labels))
     
-    vertex = []
-    #colors = [pyplot.cm.jet(i/float(num_classes)) for i in range(num_classes)]    
-    colors = [colormap(i/float(num_classes)) for i in range(num_classes)]    
-    for i in range(N):
-        c = colors[labels[i]]
-        c = [int(x*255) for x in c]
-        vertex.append( (points[i,0],points[i,1],points[i,2],c[0],c[1],c[2]) )
-    vertex = np.array(vertex, dtype=[('x', 'f4'), ('y', 'f4'),('z', 'f4'),('red', 'u1'), ('green', 'u1'),('blue', 'u1')])
+    colors = (np.array([colormap(i/float(num_classes)) for i in range(num_classes)]) * 255).astype(int)
+    vertex = np.empty(N, dtype=[('x', 'f4'), ('y', 'f4'),('z', 'f4'),('red', 'u1'), ('green', 'u1'),('blue', 'u1')])
+    vertex['x'], vertex['y'], vertex['z'] = points[:,0], points[:,1], points[:,2]
+    vertex['red'], vertex['green'], vertex['blue'] = colors[labels, 0], colors[labels, 1], colors[labels, 2]
     
     el = PlyElement.describe(vertex, 'vertex', comments=['vertices'])
     PlyData([el], text=True).write(filename)
@@ -228,12 +221,9 @@ def write_ply_color(points, labels, filename, num_classes=None, colormap=pyplot.
 def write_ply_rgb(points, colors, out_filename, num_classes=None):
     """ Color (N,3) points with RGB colors (N,3) within range [0,255] as OBJ file """
     colors = colors.astype(int)
-    N = points.shape[0]
-    fout = open(out_filename, 'w')
-    for i in range(N):
-        c = colors[i,:]
-        fout.write('v %f %f %f %d %d %d\n' % (points[i,0],points[i,1],points[i,2],c[0],c[1],c[2]))
-    fout.close()
+    with open(out_filename, 'w') as fout:
+        np.savetxt(fout, np.concatenate([points[:,0:3].astype(np.float64), colors[:,0:3]], axis=1),
+                   fmt='v %f %f %f %d %d %d')
 
 # ----------------------------------------
 # Simple Point cloud and Volume Renderers
@@ -374,6 +364,7 @@ def write_bbox(scene_bbox, out_filename):
         box_trimesh_fmt = trimesh.creation.box(lengths, trns)
         return box_trimesh_fmt
 
+    import trimesh
     scene = trimesh.scene.Scene()
     for box in scene_bbox:
         scene.add_geometry(convert_box_to_trimesh_fmt(box))        
@@ -392,35 +383,12 @@ def write_oriented_bbox(scene_bbox, out_filename):
             Y forward, X right, Z upward. heading angle of positive X is 0,
             heading angle of positive Y is 90 degrees.
         out_filename: (string) filename
+    Note:
+        All boxes are one mesh built from their batched corners, written as binary PLY.
     """
-    def heading2rotmat(heading_angle):
-        pass
-        rotmat = np.zeros((3,3))
-        rotmat[2,2] = 1
-        cosval = np.cos(heading_angle)
-        sinval = np.sin(heading_angle)
-        rotmat[0:2,0:2] = np.array([[cosval, -sinval],[sinval, cosval]])
-        return rotmat
-
-    def convert_oriented_box_to_trimesh_fmt(box):
-        ctr = box[:3]
-        lengths = box[3:6]
-        trns = np.eye(4)
-        trns[0:3, 3] = ctr
-        trns[3,3] = 1.0            
-        trns[0:3,0:3] = heading2rotmat(box[6])
-        box_trimesh_fmt = trimesh.creation.box(lengths, trns)
-        return box_trimesh_fmt
-
-    scene = trimesh.scene.Scene()
-    for box in scene_bbox:
-        scene.add_geometry(convert_oriented_box_to_trimesh_fmt(box))        
-    
-    mesh_list = trimesh.util.concatenate(scene.dump())
-    # save to ply file    
-    trimesh.io.export.export_mesh(mesh_list, out_filename, file_type='ply')
-    
-    return
+    from utils.visualize import box_mesh, write_ply_binary
+    vertices, faces, _ = box_mesh(scene_bbox)
+    write_ply_binary(out_filename, vertices, faces=faces)
 
 def write_oriented_bbox_camera_coord(scene_bbox, out_filename):
     """Export oriented (around Y axis) scene bbox to meshes
@@ -451,6 +419,7 @@ def write_oriented_bbox_camera_coord(scene_bbox, out_filename):
         box_trimesh_fmt = trimesh.creation.box(lengths, trns)
         return box_trimesh_fmt
 
+    import trimesh
     scene = trimesh.scene.Scene()
     for box in scene_bbox:
         scene.add_geometry(convert_oriented_box_to_trimesh_fmt(box))        
@@ -469,6 +438,7 @@ def write_lines_as_cylinders(pcl, filename, rad=0.005, res=64):
         rad: radius for the cylinder
         res: number of sections used to create the cylinder
     """
+    import trimesh
     scene = trimesh.scene.Scene()
     for src,tgt in pcl:
         # compute line
@@ -484,59 +454,18 @@ def write_lines_as_cylinders(pcl, filename, rad=0.005, res=64):
 # ----------------------------------------
 # Calculate IOU
 # ----------------------------------------
-import math
 import numpy as np
-from shapely.geometry import Polygon
-
-def cal_corner_after_rotation(corner, center, r):
-        x1, y1 = corner
-        x0, y0 = center
-        x2 = math.cos(r) * (x1 - x0) - math.sin(r) * (y1 - y0) + x0
-        y2 = math.sin(r) * (x1 - x0) + math.cos(r) * (y1 - y0) + y0
-        return x2, y2
 
 def eight_points(center, size, rotation=0):
-    x, y, z = center
-    w, l, h = size
-    w = w/2
-    l = l/2
-    h = h/2
-
-    x1, y1, z1 = x-w, y-l, z+h
-    x2, y2, z2 = x+w, y-l, z+h
-    x3, y3, z3 = x+w, y-l, z-h
-    x4, y4, z4 = x-w, y-l, z-h
-    x5, y5, z5 = x-w, y+l, z+h
-    x6, y6, z6 = x+w, y+l, z+h
-    x7, y7, z7 = x+w, y+l, z-h
-    x8, y8, z8 = x-w, y+l, z-h
-
-    if rotation != 0:
-        x1, y1 = cal_corner_after_rotation(corner=(x1, y1), center=(x, y), r=rotation)
-        x2, y2 = cal_corner_after_rotation(corner=(x2, y2), center=(x, y), r=rotation)
-        x3, y3 = cal_corner_after_rotation(corner=(x3, y3), center=(x, y), r=rotation)
-        x4, y4 = cal_corner_after_rotation(corner=(x4, y4), center=(x, y), r=rotation)
-        x5, y5 = cal_corner_after_rotation(corner=(x5, y5), center=(x, y), r=rotation)
-        x6, y6 = cal_corner_after_rotation(corner=(x6, y6), center=(x, y), r=rotation)
-        x7, y7 = cal_corner_after_rotation(corner=(x7, y7), center=(x, y), r=rotation)
-        x8, y8 = cal_corner_after_rotation(corner=(x8, y8), center=(x, y), r=rotation)
-
-    conern1 = np.array([x1, y1, z1])
-    conern2 = np.array([x2, y2, z2])
-    conern3 = np.array([x3, y3, z3])
-    conern4 = np.array([x4, y4, z4])
-    conern5 = np.array([x5, y5, z5])
-    conern6 = np.array([x6, y6, z6])
-    conern7 = np.array([x7, y7, z7])
-    conern8 = np.array([x8, y8, z8])
-    
-    eight_corners = np.stack([conern1, conern2, conern6, conern5, conern4, conern3, conern7, conern8], axis=0)
-    return eight_corners
+    """ The corners of strefer_utils.eight_points, reordered so that the first four are the top face as a ring """
+    from utils.strefer_utils import box_corners
+    return box_corners(np.concatenate([center, size, [rotation]]))[[0, 1, 5, 4, 3, 2, 6, 7]]
 
 def cal_inter_area(box1, box2):
     """
     box: [x1, y1, x2, y2, x3, y3, x4, y4]
     """
+    from shapely.geometry import Polygon
     a=np.array(box1).reshape(4, 2)   #四边形二维坐标表示
     poly1 = Polygon(a).convex_hull  #python四边形对象，会自动计算四个点，最后四个点顺序为：左上 左下  右下 右上 
     
@@ -588,25 +517,13 @@ def cal_iou3d(box1, box2):
     return iou
 
 def cal_accuracy(pred_bboxes, gt_bboxes):
-    total = 0
-    tp25 = 0
-    tp50 = 0
-    miou = 0
-    for i in range(len(gt_bboxes)):
-        gt_bbox = gt_bboxes[i]
-        p_bbox = pred_bboxes[i]        
-        bbox = p_bbox[:7]
-        iou = cal_iou3d(bbox, gt_bbox)
-
-        if iou >= 0.5:
-            tp25 += 1
-            tp50 += 1
-        elif iou >= 0.25:
-            tp25 += 1
-        total += 1
-        miou += iou
-
-    acc25 = round(tp25/total, 4)
-    acc50 = round(tp50/total, 4)
-    miou = round(miou/total, 4)
+    ious = [cal_iou3d(p_bbox[:7], gt_bbox) for p_bbox, gt_bbox in zip(pred_bboxes, gt_bboxes)]
+    return accuracy_from_ious(ious)
+
+def accuracy_from_ious(ious):
+    """Acc@0.25, Acc@0.5 and mean IoU, rounded to 4 digits as cal_accuracy reports them."""
+    ious = np.asarray(ious, dtype=np.float64)
+    acc25 = round(float((ious >= 0.25).mean()), 4)
+    acc50 = round(float((ious >= 0.5).mean()), 4)
+    miou = round(float(ious.mean()), 4)
     return acc25, acc50, miou
\ No newline at end of file
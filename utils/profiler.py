@@ -0,0 +1,240 @@
+"""
+Per-stage wall time and peak memory.
+
+Stages are named once, where the work happens:
+
+    from utils.profiler import profiler
+
+    with profiler.stage('model/point_backbone'):
+        ...
+
+Profiling is off by default and stage() then returns one shared no-op
+context manager, so instrumented code only pays an attribute check.
+train.py and test.py switch it on with --profile.
+
+When on, CUDA is synchronized at stage boundaries so GPU work is charged to
+the stage that launched it. Peak memory is torch.cuda.max_memory_allocated()
+within the stage when CUDA is in use. Otherwise it is the process peak RSS
+(ru_maxrss), which never decreases.
+
+Dataset stages run in DataLoader workers. __getitem__ captures them with
+capture() and ships them in the sample under PROFILE_KEY. The training loop
+hands them back to merge().
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+PROFILE_KEY = 'profile'
+
+_NULL = contextlib.nullcontext()
+
+
+def _peak_rss():
+    if resource is None:
+        return 0
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Stage:
+    __slots__ = ('profiler', 'name', 'start', 'peak')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.peak = 0
+        self.profiler._enter(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._exit(self, time.perf_counter())
+        return False
+
+
+class Profiler:
+    """
+    Collects (name, start, duration, peak_memory) records per stage.
+
+    Args:
+        max_trace_events: records kept for the Chrome trace; percentiles
+            use every record regardless
+    """
+
+    def __init__(self, max_trace_events=200000):
+        self.enabled = False
+        self.max_trace_events = max_trace_events
+        self.reset()
+        self._local = threading.local()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.durations = defaultdict(list)
+        self.peaks = defaultdict(int)
+        self.events = []
+
+    def stage(self, name):
+        """Context manager timing `name`; a no-op when profiling is off."""
+        if not self.enabled:
+            return _NULL
+        return _Stage(self, name)
+
+    def iterate(self, iterable, name):
+        """Yield from iterable, timing every next() as stage `name` (e.g. data wait)."""
+        if not self.enabled:
+            return iterable
+        return _TimedIterable(self, iterable, name)
+
+    @contextlib.contextmanager
+    def capture(self):
+        """Divert the records of this thread into the yielded list instead of the totals."""
+        records = []
+        previous = getattr(self._local, 'capture', None)
+        self._local.capture = records
+        try:
+            yield records
+        finally:
+            self._local.capture = previous
+
+    def merge(self, records):
+        """Add records captured elsewhere; accepts a list or a batch (list) of json strings."""
+        if isinstance(records, str):
+            records = json.loads(records)
+        elif len(records) > 0 and isinstance(records[0], str):
+            for r in records:
+                self.merge(r)
+            return
+        for record in records:
+            self._add(*record)
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _cuda(self):
+        return torch.cuda.is_available() and torch.cuda.is_initialized()
+
+    def _enter(self, stage):
+        stack = self._stack()
+        if self._cuda():
+            torch.cuda.synchronize()
+            if stack:
+                # the reset below would lose the parent's peak so far
+                stack[-1].peak = max(stack[-1].peak, torch.cuda.max_memory_allocated())
+            torch.cuda.reset_peak_memory_stats()
+        stack.append(stage)
+
+    def _exit(self, stage, end):
+        if self._cuda():
+            torch.cuda.synchronize()
+            end = time.perf_counter()
+            peak = max(stage.peak, torch.cuda.max_memory_allocated())
+        else:
+            peak = _peak_rss()
+        stack = self._stack()
+        stack.pop()
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, peak)
+        self._record(stage.name, stage.start, end - stage.start, peak)
+
+    def _record(self, name, start, duration, peak):
+        capture = getattr(self._local, 'capture', None)
+        record = (name, start, duration, peak, os.getpid(), threading.get_ident())
+        if capture is not None:
+            capture.append(record)
+        else:
+            self._add(*record)
+
+    def _add(self, name, start, duration, peak, pid, tid):
+        self.durations[name].append(duration)
+        self.peaks[name] = max(self.peaks[name], peak)
+        if len(self.events) < self.max_trace_events:
+            self.events.append((name, start, duration, pid, tid))
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """Return {stage: {'count', 'total', 'mean', 'p50', ..., 'peak_mem'}} with times in seconds."""
+        out = dict()
+        for name, durations in self.durations.items():
+            d = np.asarray(durations)
+            stats = {'count': len(d), 'total': float(d.sum()), 'mean': float(d.mean())}
+            for p, v in zip(percentiles, np.percentile(d, percentiles)):
+                stats[f'p{p}'] = float(v)
+            stats['peak_mem'] = self.peaks[name]
+            out[name] = stats
+        return out
+
+    def format_summary(self, percentiles=(50, 90, 99)):
+        summary = self.summary(percentiles)
+        header = ['stage', 'count', 'total(s)', 'mean(ms)'] + [f'p{p}(ms)' for p in percentiles] + ['peak(MB)']
+        lines = ['\t'.join(header)]
+        for name in sorted(summary, key=lambda n: -summary[n]['total']):
+            s = summary[name]
+            row = [name, str(s['count']), f"{s['total']:.2f}", f"{s['mean'] * 1e3:.2f}"]
+            row += [f"{s[f'p{p}'] * 1e3:.2f}" for p in percentiles]
+            row.append(f"{s['peak_mem'] / 2 ** 20:.0f}")
+            lines.append('\t'.join(row))
+        return '\n'.join(lines)
+
+    def log_tensorboard(self, logger, step, prefix='Profile'):
+        """Write the stage statistics through Logger.tf_log."""
+        for name, stats in self.summary().items():
+            for key in ('mean', 'p50', 'p90', 'p99'):
+                logger.tf_log(f"{prefix}/{name}/{key}_ms", stats[key] * 1e3, step)
+            logger.tf_log(f"{prefix}/{name}/peak_mem_MB", stats['peak_mem'] / 2 ** 20, step)
+
+    def export_chrome_trace(self, path):
+        """Write the recorded stages as a chrome://tracing / Perfetto JSON file."""
+        events = []
+        for name, start, duration, pid, tid in self.events:
+            events.append({
+                'name': name, 'cat': name.split('/')[0], 'ph': 'X',
+                'ts': start * 1e6, 'dur': duration * 1e6, 'pid': pid, 'tid': tid,
+            })
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class _TimedIterable:
+
+    def __init__(self, profiler, iterable, name):
+        self.profiler = profiler
+        self.iterable = iterable
+        self.name = name
+
+    def __len__(self):
+        return len(self.iterable)
+
+    def __iter__(self):
+        it = iter(self.iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.profiler._record(self.name, start, time.perf_counter() - start, _peak_rss())
+            yield item
+
+
+profiler = Profiler()
@@ -0,0 +1,106 @@
+''' Testing the stage profiler: no-op when off, nested stages, worker records and the reports. '''
+
+import json
+import os
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from utils.profiler import Profiler
+
+
+def test_disabled():
+    profiler = Profiler()
+    data = [1, 2, 3]
+    assert profiler.stage('a') is profiler.stage('b')
+    assert profiler.iterate(data, 'wait') is data
+    with profiler.stage('model/decoder_0'):
+        pass
+    assert not profiler.durations and not profiler.events
+
+
+def test_stages():
+    profiler = Profiler()
+    profiler.enable()
+    for _ in profiler.iterate(range(3), 'data_wait'):
+        with profiler.stage('model'):
+            with profiler.stage('model/backbone'):
+                pass
+            with profiler.stage('model/decoder_0'):
+                pass
+    assert {name: len(d) for name, d in profiler.durations.items()} == \
+        {'data_wait': 3, 'model': 3, 'model/backbone': 3, 'model/decoder_0': 3}
+    # a stage is recorded when it exits, its duration covers the nested ones
+    names = [event[0] for event in profiler.events]
+    assert names[:4] == ['data_wait', 'model/backbone', 'model/decoder_0', 'model']
+    assert all(parent >= child for parent, child in zip(profiler.durations['model'],
+                                                        profiler.durations['model/backbone']))
+    profiler.disable()
+    with profiler.stage('model'):
+        pass
+    assert len(profiler.durations['model']) == 3
+
+
+def test_merge_worker_records():
+    profiler = Profiler()
+    profiler.enable()
+    samples = []
+
+    def worker():
+        # a DataLoader worker: __getitem__ captures its stages and ships them as json in the sample
+        for _ in range(2):
+            with profiler.capture() as records:
+                with profiler.stage('data/decode'):
+                    pass
+            samples.append(json.dumps(records))
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    assert not profiler.durations
+    profiler.merge(samples)  # a collated batch, one json string per sample
+    profiler.merge(samples[0])
+    assert len(profiler.durations['data/decode']) == 3
+    assert profiler.events[0][4] != threading.get_ident()
+
+
+def test_reports():
+    profiler = Profiler(max_trace_events=50)
+    durations = np.arange(1, 101) / 1000
+    profiler.merge([('model/decoder_0', 10. + i, d, 2 ** 20 * i, 1, 2) for i, d in enumerate(durations)])
+    profiler.merge([('data/decode', 5., 0.5, 0, 3, 4)])
+    summary = profiler.summary()
+    stats = summary['model/decoder_0']
+    assert stats['count'] == 100 and np.isclose(stats['total'], durations.sum())
+    for p in (50, 90, 99):
+        assert np.isclose(stats[f'p{p}'], np.percentile(durations, p))
+    assert stats['peak_mem'] == 99 * 2 ** 20
+
+    lines = profiler.format_summary().split('\n')
+    assert lines[0].split('\t') == ['stage', 'count', 'total(s)', 'mean(ms)', 'p50(ms)', 'p90(ms)', 'p99(ms)',
+                                    'peak(MB)']
+    # the longest total first
+    assert lines[1].split('\t') == ['model/decoder_0', '100', '5.05', '50.50', '50.50', '90.10', '99.01', '99']
+    assert lines[2].startswith('data/decode\t1\t')
+
+    with tempfile.TemporaryDirectory() as out:
+        path = os.path.join(out, 'trace.json')
+        profiler.export_chrome_trace(path)
+        with open(path) as f:
+            trace = json.load(f)
+    events = trace['traceEvents']
+    # the trace is capped, the statistics are not
+    assert len(events) == 50 and all(event['name'] == 'model/decoder_0' for event in events)
+    assert events[1] == {'name': 'model/decoder_0', 'cat': 'model', 'ph': 'X', 'ts': 11e6, 'dur': 2e3,
+                         'pid': 1, 'tid': 2}
+
+
+if __name__ == '__main__':
+    test_disabled()
+    test_stages()
+    test_merge_worker_records()
+    test_reports()
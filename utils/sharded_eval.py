@@ -0,0 +1,150 @@
+"""
+Sharded evaluation.
+
+The test split is cut into `num_shards` contiguous index ranges. Each shard
+runs in its own process with its own model replica and DataLoader, and
+appends its prediction rows to `shard_<i>-of-<n>.part` after every batch.
+A finished shard is renamed to `shard_<i>-of-<n>.npy`; the merge reads the
+finished shards back in shard order, which is dataset order.
+
+A shard that crashes keeps its partial file. The next run skips the
+finished shards and resumes the failed ones after their last complete row,
+so a failure never costs more than one batch of any other shard. A
+manifest records what the rows are predictions of, so a directory is never
+resumed for a different checkpoint or split. The checkpoint is identified
+by its path, size and modification time, so one overwritten in place by
+another run does not resume either.
+
+    python test.py --pretrain best.pth --device cpu --num_shards 16 --shard_dir outputs/shards
+"""
+import json
+import multiprocessing
+import os
+import os.path as osp
+import traceback
+from multiprocessing.connection import wait
+
+import numpy as np
+
+ROW_DTYPE = np.float64
+MANIFEST = 'manifest.json'
+
+
+def shard_range(length, num_shards, shard):
+    """The range of dataset indices of `shard`, shard sizes differ by at most one."""
+    return range(length * shard // num_shards, length * (shard + 1) // num_shards)
+
+
+def shard_paths(out_dir, shard, num_shards):
+    """(partial, finished) file of `shard`."""
+    name = osp.join(out_dir, f'shard_{shard:03d}-of-{num_shards:03d}')
+    return name + '.part', name + '.npy'
+
+
+def file_identity(path):
+    """The absolute path, size and modification time of a file, which change when it is rewritten."""
+    stat = os.stat(path)
+    return {'path': osp.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def check_manifest(out_dir, config):
+    """Write `config` (a JSON-able dict) to out_dir, or check it against the one already there."""
+    os.makedirs(out_dir, exist_ok=True)
+    path = osp.join(out_dir, MANIFEST)
+    if osp.exists(path):
+        with open(path) as f:
+            existing = json.load(f)
+        if existing != config:
+            raise ValueError(f'{out_dir} holds shards of another evaluation ({existing}), use a fresh --shard_dir')
+        return
+    with open(path + '.tmp', 'w') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+class ShardWriter:
+    """
+    Streams the prediction rows (`width` values each) of one shard to disk.
+
+    Opening a shard that already has a partial file drops its incomplete
+    last row and continues after the complete ones; `rows` is how many are
+    there, i.e. how many samples of the shard to skip.
+    """
+
+    def __init__(self, out_dir, shard, num_shards, width):
+        self.partial, self.finished = shard_paths(out_dir, shard, num_shards)
+        self.width = width
+        row_bytes = width * np.dtype(ROW_DTYPE).itemsize
+        size = osp.getsize(self.partial) if osp.exists(self.partial) else 0
+        self.rows = size // row_bytes
+        self.file = open(self.partial, 'ab')
+        self.file.truncate(self.rows * row_bytes)
+
+    def write(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=ROW_DTYPE).reshape(-1, self.width)
+        rows.tofile(self.file)
+        self.file.flush()
+        self.rows += len(rows)
+
+    def finish(self, expected_rows):
+        self.file.close()
+        assert self.rows == expected_rows, f'{self.partial} has {self.rows} rows, expected {expected_rows}'
+        rows = np.fromfile(self.partial, dtype=ROW_DTYPE).reshape(-1, self.width)
+        with open(self.finished + '.tmp', 'wb') as f:
+            np.save(f, rows)
+        os.replace(self.finished + '.tmp', self.finished)
+        os.remove(self.partial)
+
+
+def pending_shards(out_dir, num_shards):
+    return [shard for shard in range(num_shards) if not osp.exists(shard_paths(out_dir, shard, num_shards)[1])]
+
+
+def _run_shard(fn, shard, device):
+    try:
+        fn(shard, device)
+    except BaseException:
+        traceback.print_exc()
+        raise SystemExit(1)
+
+
+def run_shards(fn, out_dir, num_shards, devices, retries=1):
+    """
+    Run fn(shard, device) in a fresh process for every unfinished shard, at
+    most one process per entry of `devices` at a time (repeat an entry to
+    run several shards on one device). A shard whose process fails is
+    started again up to `retries` times. Returns the shards that still
+    failed.
+    """
+    context = multiprocessing.get_context('spawn')
+    queue = [(shard, 0) for shard in pending_shards(out_dir, num_shards)]
+    free = list(range(len(devices)))
+    running = {}
+    failed = []
+    while queue or running:
+        while queue and free:
+            shard, attempt = queue.pop(0)
+            slot = free.pop(0)
+            process = context.Process(target=_run_shard, args=(fn, shard, devices[slot]))
+            process.start()
+            running[process.sentinel] = (process, shard, attempt, slot)
+        for sentinel in wait(list(running)):
+            process, shard, attempt, slot = running.pop(sentinel)
+            process.join()
+            free.append(slot)
+            if process.exitcode == 0:
+                continue
+            if attempt < retries:
+                print(f'shard {shard} failed (exit code {process.exitcode}), retrying')
+                queue.append((shard, attempt + 1))
+            else:
+                failed.append(shard)
+    return sorted(failed)
+
+
+def merge_shards(out_dir, num_shards):
+    """The rows of all shards in dataset order; raises if a shard is unfinished."""
+    missing = pending_shards(out_dir, num_shards)
+    if missing:
+        raise RuntimeError(f'shards {missing} of {out_dir} are unfinished, rerun to complete them')
+    return np.concatenate([np.load(shard_paths(out_dir, shard, num_shards)[1]) for shard in range(num_shards)])
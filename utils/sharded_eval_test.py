@@ -0,0 +1,112 @@
+''' Testing the sharded evaluation: streaming, resuming a failed shard and the ordered merge. '''
+
+import functools
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from utils.sharded_eval import (ShardWriter, check_manifest, file_identity, merge_shards, pending_shards, run_shards,
+                                shard_paths, shard_range)
+
+LENGTH = 23
+NUM_SHARDS = 4
+WIDTH = 7
+
+
+def prediction(index):
+    return np.full(WIDTH, index, dtype=np.float64)
+
+
+def predict(out_dir, fail_once, shard, device):
+    """Predicts shard `shard` in batches of 2; shard `fail_once` dies after one batch on its first attempt."""
+    indices = shard_range(LENGTH, NUM_SHARDS, shard)
+    writer = ShardWriter(out_dir, shard, NUM_SHARDS, WIDTH)
+    marker = os.path.join(out_dir, 'failed')
+    for start in range(writer.rows, len(indices), 2):
+        writer.write(np.stack([prediction(i) for i in indices[start:start + 2]]))
+        if shard == fail_once and not os.path.exists(marker):
+            open(marker, 'w').close()
+            raise RuntimeError('simulated failure')
+    writer.finish(len(indices))
+
+
+def test_shard_ranges():
+    ranges = [shard_range(LENGTH, NUM_SHARDS, shard) for shard in range(NUM_SHARDS)]
+    assert [i for r in ranges for i in r] == list(range(LENGTH))
+    assert max(map(len, ranges)) - min(map(len, ranges)) <= 1
+
+
+def test_writer_resumes_after_last_complete_row():
+    with tempfile.TemporaryDirectory() as out_dir:
+        writer = ShardWriter(out_dir, 0, 1, WIDTH)
+        writer.write(np.stack([prediction(0), prediction(1)]))
+        writer.file.write(b'\0' * 10)  # a row cut off by a crash
+        writer.file.close()
+        writer = ShardWriter(out_dir, 0, 1, WIDTH)
+        assert writer.rows == 2
+        writer.write(prediction(2))
+        writer.finish(3)
+        assert np.array_equal(merge_shards(out_dir, 1), np.stack([prediction(i) for i in range(3)]))
+
+
+def test_failed_shard_is_retried():
+    with tempfile.TemporaryDirectory() as out_dir:
+        fn = functools.partial(predict, out_dir, 2)
+        # without retries the shard stays unfinished, the others are done
+        assert run_shards(fn, out_dir, NUM_SHARDS, ['cpu', 'cpu'], retries=0) == [2]
+        assert pending_shards(out_dir, NUM_SHARDS) == [2]
+        assert os.path.getsize(shard_paths(out_dir, 2, NUM_SHARDS)[0]) == 2 * WIDTH * 8
+        try:
+            merge_shards(out_dir, NUM_SHARDS)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('merged an unfinished shard')
+        # the rerun only runs the failed shard, which continues after its first batch
+        finished = os.path.getmtime(shard_paths(out_dir, 0, NUM_SHARDS)[1])
+        assert run_shards(fn, out_dir, NUM_SHARDS, ['cpu', 'cpu']) == []
+        assert os.path.getmtime(shard_paths(out_dir, 0, NUM_SHARDS)[1]) == finished
+        assert np.array_equal(merge_shards(out_dir, NUM_SHARDS), np.stack([prediction(i) for i in range(LENGTH)]))
+
+
+def test_manifest_mismatch():
+    with tempfile.TemporaryDirectory() as out_dir:
+        check_manifest(out_dir, {'checkpoint': 'a.pth', 'num_shards': 4})
+        check_manifest(out_dir, {'checkpoint': 'a.pth', 'num_shards': 4})
+        try:
+            check_manifest(out_dir, {'checkpoint': 'b.pth', 'num_shards': 4})
+        except ValueError:
+            return
+        raise AssertionError('resumed the shards of another checkpoint')
+
+
+def test_manifest_overwritten_checkpoint():
+    """A checkpoint rewritten at the same path, e.g. best.pth of a retrained run, is another checkpoint."""
+    with tempfile.TemporaryDirectory() as out_dir:
+        path = os.path.join(out_dir, 'best.pth')
+        with open(path, 'wb') as f:
+            f.write(b'model A')
+        check_manifest(out_dir, {'checkpoint': file_identity(path), 'num_shards': 4})
+        check_manifest(out_dir, {'checkpoint': file_identity(path), 'num_shards': 4})
+        # the same size, written a second later
+        stat = os.stat(path)
+        with open(path, 'wb') as f:
+            f.write(b'model B')
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        try:
+            check_manifest(out_dir, {'checkpoint': file_identity(path), 'num_shards': 4})
+        except ValueError:
+            return
+        raise AssertionError('resumed the shards of an overwritten checkpoint')
+
+
+if __name__ == '__main__':
+    test_shard_ranges()
+    test_writer_resumes_after_last_complete_row()
+    test_failed_shard_is_retried()
+    test_manifest_mismatch()
+    test_manifest_overwritten_checkpoint()
@@ -1,7 +1,7 @@
 import numpy as np
 import cv2
-import math
-from scipy.spatial import Delaunay
+import functools
+import torch
 
 cv2.ocl.setUseOpenCL(False)   
 cv2.setNumThreads(0)
@@ -11,6 +11,129 @@ def load_image(img_filename):
     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB) / 255.
     return img
 
+REDUCED_DECODE = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def jpeg_size(buf):
+    """ (height, width) from the SOF header of the JPEG bytes buf, None if it is not a JPEG """
+    if len(buf) < 4 or buf[0] != 0xFF or buf[1] != 0xD8:
+        return None
+    i = 2
+    while i + 9 < len(buf):
+        if buf[i] != 0xFF:
+            return None
+        marker = buf[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker in JPEG_SOF:
+            return (int(buf[i + 5]) << 8 | int(buf[i + 6]), int(buf[i + 7]) << 8 | int(buf[i + 8]))
+        i += 2 + (int(buf[i + 2]) << 8 | int(buf[i + 3]))
+    return None
+
+BACKBONE_STRIDE = 32  # pixels per image token of the ResNet feature map
+
+def img_shape(img_size):
+    """ (H, W) of the letterbox canvas for --img_size: an int or [S] for a square, or [H, W] """
+    if isinstance(img_size, int):
+        return img_size, img_size
+    if len(img_size) == 1:
+        return img_size[0], img_size[0]
+    height, width = img_size
+    return height, width
+
+def fit_img_shape(long_side, camera_size, stride=BACKBONE_STRIDE):
+    """ (H, W) canvas of long_side with the aspect ratio of a (height, width) camera, the short side rounded up to stride """
+    height, width = camera_size
+    short_side = -(-long_side * min(height, width) // (max(height, width) * stride)) * stride
+    return (short_side, long_side) if width >= height else (long_side, short_side)
+
+def letterbox_size(img_size, camera_size=None):
+    """
+    The canvas for --img_size, an int for a square (S or [S]) or (H, W) for [H, W].
+    Given the (height, width) of the camera, S is the long side of a canvas fitted to its aspect ratio.
+    """
+    if not isinstance(img_size, int):
+        img_size = img_size[0] if len(img_size) == 1 else tuple(img_size)
+    if camera_size is not None:
+        img_size = fit_img_shape(max(img_shape(img_size)), camera_size)
+    return img_size
+
+def image_size(img_filename):
+    """ (height, width) of an image, from the JPEG header when it has one """
+    buf = np.fromfile(img_filename, dtype=np.uint8)
+    size = jpeg_size(buf)
+    return size if size is not None else cv2.imdecode(buf, cv2.IMREAD_COLOR).shape[:2]
+
+@functools.lru_cache(maxsize=64)
+def letterbox_mask(img_size, pad_w, pad_h):
+    """
+    The image mask the datasets build for a letterbox, shared (read-only) between frames of a size.
+    img_size: int for the centered square canvas trained checkpoints use, or an (H, W) tuple
+        for a canvas with the image at the top left, see load_image_letterbox
+    """
+    if isinstance(img_size, int):
+        mask = np.zeros((img_size, img_size), dtype=bool)
+        # the datasets always indexed the rows with the (3, H, W) shape of the transposed image;
+        # 3 - pad_h//2 wraps around to the bottom edge (3 rows off), kept for trained checkpoints
+        mask[0+pad_h//2:3-pad_h//2, 0+pad_w//2:img_size-pad_w//2] = 1
+    else:
+        height, width = img_size
+        mask = np.zeros((height, width), dtype=bool)
+        mask[:height - pad_h, :width - pad_w] = 1
+    mask.flags.writeable = False
+    return mask
+
+NO_IMAGE = 'none'  # layout of a missing previous frame, its mask is the [0, 0] pixel
+
+def letterbox_key(img_size, pad_w, pad_h):
+    """ Name of letterbox_mask(img_size, pad_w, pad_h), the host-side layout the image backbone caches by """
+    return f'{img_size}/{pad_w}/{pad_h}'
+
+def load_image_letterbox(img_filename, img_size, out=None):
+    """
+    Decode an image straight into a (3, H, W) float32 RGB letterbox in [0, 1]:
+    load_image + resize_img_keep_ratio + transpose in one pass over a small image.
+    JPEGs much larger than the canvas are decoded at 1/2, 1/4 or 1/8 scale by libjpeg.
+    img_size: int for a centered square canvas, or an (H, W) tuple for a canvas with the
+        image at the top left: the few rows a canvas fitted to the camera pads then fall in
+        the last row of image tokens, where centering would mask the whole first row
+    out: optional preallocated (3, H, W) float32 buffer
+    Returns out, ratio, pad_w, pad_h, with ratio and padding computed on the full size as before.
+    """
+    height, width = img_shape(img_size)
+    buf = np.fromfile(img_filename, dtype=np.uint8)
+    size = jpeg_size(buf)
+    flag = cv2.IMREAD_COLOR
+    if size is not None:
+        ratio = min(height / size[0], width / size[1])
+        for factor, reduced_flag in REDUCED_DECODE:
+            if ratio * factor <= 1:
+                flag = reduced_flag
+                break
+    img = cv2.imdecode(buf, flag)
+    if flag == cv2.IMREAD_COLOR or size is None:
+        size = img.shape[:2]
+    elif (img.shape[0] > img.shape[1]) != (size[0] > size[1]):
+        # rotated by the EXIF orientation
+        size = size[::-1]
+    ratio = min(height / size[0], width / size[1])
+    new_h, new_w = int(size[0] * ratio), int(size[1] * ratio)
+    pad_w, pad_h = width - new_w, height - new_h
+    top, left = (pad_h // 2, pad_w // 2) if isinstance(img_size, int) else (0, 0)
+    img = cv2.resize(img, (new_w, new_h))
+
+    if out is None:
+        out = np.empty((3, height, width), dtype=np.float32)
+    out[:, :top] = 0
+    out[:, top + new_h:] = 0
+    out[:, :, :left] = 0
+    out[:, :, left + new_w:] = 0
+    for c in range(3):
+        # BGR -> RGB and / 255 while writing the plane
+        np.multiply(img[:, :, 2 - c], np.float32(1 / 255.), out=out[c, top:top + new_h, left:left + new_w])
+    return out, ratio, pad_w, pad_h
+
 def norm(value, vmin, vmax):
     return (value - vmin) / (vmax - vmin)
 
@@ -23,6 +146,7 @@ def rotz(t):
                      [0,  0,  1]])
 
 def in_hull(p, hull):
+    from scipy.spatial import Delaunay
     if not isinstance(hull, Delaunay):
         hull = Delaunay(hull)
     return hull.find_simplex(p)>=0
@@ -33,34 +157,77 @@ def extract_pc_in_box3d(pc, box3d):
     return pc[box3d_roi_inds,:], box3d_roi_inds
 
 def my_compute_box_3d(center, size, heading_angle):
-    R = rotz(-1*heading_angle)
-    l,w,h = size
-    l /= 2
-    w /= 2
-    h /= 2
-    x_corners = [-l,l,l,-l,-l,l,l,-l]
-    y_corners = [w,w,-w,-w,w,w,-w,-w]
-    z_corners = [h,h,h,h,-h,-h,-h,-h]
-    corners_3d = np.dot(R, np.vstack([x_corners, y_corners, z_corners]))
-    corners_3d[0,:] += center[0]
-    corners_3d[1,:] += center[1]
-    corners_3d[2,:] += center[2]
-    return np.transpose(corners_3d)
-
-def random_sampling(pc, num_sample, replace=None, return_choices=False):
+    return batch_my_compute_box_3d(np.concatenate([center, size, [heading_angle]])[None])[0]
+
+def batch_my_compute_box_3d(boxes3d):
+    """ Corners (N, 8, 3) of boxes3d (N, 7+), heading clockwise, in the order of my_compute_box_3d """
+    boxes3d = np.array(boxes3d, dtype=np.float64)[:, :7]
+    boxes3d[:, 6] *= -1
+    return box_corners(boxes3d)[:, MY_BOX_ORDER]
+
+def random_sampling(pc, num_sample, replace=None, return_choices=False, rng=None):
     """ Input is NxC, output is num_samplexC
+        rng: optional np.random.Generator, the global numpy state is used otherwise
     """
     if replace is None: replace = (pc.shape[0]<num_sample)
-    choices = np.random.choice(pc.shape[0], num_sample, replace=replace)
+    if rng is None: rng = np.random
+    choices = rng.choice(pc.shape[0], num_sample, replace=replace)
     if return_choices:
         return pc[choices], choices
     else:
         return pc[choices]
 
+def crop_to_range(pc, pc_range):
+    """ Keep the points of pc (N,C) inside pc_range [cx, cy, cz, sx, sy, sz, r], r is ignored (axis-aligned) """
+    center = np.asarray(pc_range[0:3], dtype=pc.dtype)
+    half = np.asarray(pc_range[3:6], dtype=pc.dtype) / 2
+    mask = np.ones(len(pc), dtype=bool)
+    for i in range(3):
+        mask &= (pc[:, i] >= center[i] - half[i]) & (pc[:, i] <= center[i] + half[i])
+    return pc[mask]
+
+def remove_ground(pc, height, bin_size=0.1):
+    """ Drop the points less than `height` above the ground, taken as the most populated z bin """
+    if len(pc) == 0:
+        return pc
+    z = pc[:, 2]
+    bins = np.floor((z - z.min()) / bin_size).astype(np.int64)
+    ground = z.min() + (np.bincount(bins).argmax() + 1) * bin_size
+    return pc[z > ground + height]
+
+def voxel_downsample(pc, voxel_size, rng=None):
+    """ Keep one random point per occupied voxel of a hashed grid, pc (N,C) """
+    if len(pc) == 0:
+        return pc
+    if rng is None: rng = np.random
+    coords = np.floor(pc[:, 0:3] / np.asarray(voxel_size, dtype=pc.dtype)).astype(np.int64)
+    coords -= coords.min(axis=0)
+    dims = coords.max(axis=0) + 1
+    keys = (coords[:, 0] * dims[1] + coords[:, 1]) * dims[2] + coords[:, 2]
+    # the first occurrence in a random order is a random point of the voxel
+    order = rng.permutation(len(pc))
+    _, first = np.unique(keys[order], return_index=True)
+    return pc[np.sort(order[first])]
+
+def preprocess_points(pc, num_sample, pc_range=None, ground_height=0, voxel_size=0, rng=None):
+    """
+    Crop to pc_range, remove the ground, voxel-downsample, then sample num_sample points.
+    Each step is skipped when its argument is None / 0; with all of them off this is random_sampling.
+    """
+    if pc_range is not None:
+        pc = crop_to_range(pc, pc_range)
+    if ground_height > 0:
+        pc = remove_ground(pc, ground_height)
+    if voxel_size > 0:
+        pc = voxel_downsample(pc, voxel_size, rng=rng)
+    if len(pc) == 0:
+        return np.zeros((num_sample, pc.shape[1]), dtype=pc.dtype)
+    return random_sampling(pc, num_sample, rng=rng)
+
 def batch_extract_pc_in_box3d(pc, boxes3d, sample_points_num, dim=4):
     objects_pc = []
-    for i in range(len(boxes3d)):
-        box3d = my_compute_box_3d(boxes3d[i][0:3], boxes3d[i][3:6], boxes3d[i][6])
+    corners = batch_my_compute_box_3d(boxes3d) if len(boxes3d) > 0 else []
+    for box3d in corners:
         obj_pc, pc_ind = extract_pc_in_box3d(pc.copy(), box3d)
         if obj_pc.shape[0] == 0:
             obj_pc = np.zeros((sample_points_num, dim))
@@ -75,77 +242,73 @@ def batch_extract_pc_in_box3d(pc, boxes3d, sample_points_num, dim=4):
 
 
 
-def cal_corner_after_rotation(corner, center, r):
-    x1, y1 = corner
-    x0, y0 = center
-    x2 = math.cos(r) * (x1 - x0) - math.sin(r) * (y1 - y0) + x0
-    y2 = math.sin(r) * (x1 - x0) + math.cos(r) * (y1 - y0) + y0
-    return x2, y2
+# corner signs of a box (x, y, z, w, l, h, r) in the order of eight_points:
+# the y - l face (top, then bottom), then the y + l face
+BOX_CORNERS = np.array([[-1, -1, 1], [1, -1, 1], [1, -1, -1], [-1, -1, -1],
+                        [-1, 1, 1], [1, 1, 1], [1, 1, -1], [-1, 1, -1]], dtype=np.float64) / 2
+# the 12 edges of a box whose corners 0-3 and 4-7 are two faces, corner k + 4 opposite k,
+# as in both box_corners and my_compute_box_3d
+BOX_EDGES = np.array([(k, (k + 1) % 4) for k in range(4)] + [(k + 4, (k + 1) % 4 + 4) for k in range(4)]
+                     + [(k, k + 4) for k in range(4)])
+# my_compute_box_3d corners, as indices into box_corners of the box with the opposite heading
+MY_BOX_ORDER = [4, 5, 1, 0, 7, 6, 2, 3]
+
+def box_corners(boxes):
+    """ Corners (..., 8, 3) of boxes (..., 7+) [x, y, z, w, l, h, r], r rotating counterclockwise about z """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    offsets = BOX_CORNERS * boxes[..., None, 3:6]
+    c, s = np.cos(boxes[..., 6:7]), np.sin(boxes[..., 6:7])
+    x = c * offsets[..., 0] - s * offsets[..., 1]
+    y = s * offsets[..., 0] + c * offsets[..., 1]
+    return np.stack([x, y, offsets[..., 2]], axis=-1) + boxes[..., None, 0:3]
+
+def box_corners_tensor(boxes):
+    """ box_corners for a PyTorch tensor (..., 7+), on its device and in its dtype """
+    offsets = boxes.new_tensor(BOX_CORNERS) * boxes[..., None, 3:6]
+    c, s = torch.cos(boxes[..., 6:7]), torch.sin(boxes[..., 6:7])
+    x = c * offsets[..., 0] - s * offsets[..., 1]
+    y = s * offsets[..., 0] + c * offsets[..., 1]
+    return torch.stack([x, y, offsets[..., 2]], dim=-1) + boxes[..., None, 0:3]
+
+def project_corners(corners, ex_matrix, in_matrix, min_depth=1e-3):
+    """
+    Pixels (N, 8, 2) and in-front mask (N, 8) of lidar points corners (N, 8, 3)
+    with the calibration ex_matrix (3, 4) and in_matrix (3, 3), or one of them
+    per box: (N, 3, 4) and (N, 3, 3).
+    Points less than min_depth in front of the camera are divided by min_depth
+    instead of their depth, so they land far off the image rather than mirrored
+    onto it; the mask tells them apart.
+    """
+    projection = np.matmul(in_matrix, ex_matrix)
+    pixel = np.matmul(corners, np.swapaxes(projection[..., :3], -1, -2)) + projection[..., None, :, 3]
+    in_front = pixel[..., 2] > min_depth
+    return pixel[..., :2] / np.maximum(pixel[..., 2:], min_depth), in_front
+
+def project_corners_tensor(corners, ex_matrix, in_matrix, min_depth=1e-3):
+    """ project_corners for PyTorch tensors """
+    projection = torch.matmul(in_matrix, ex_matrix)
+    pixel = torch.matmul(corners, projection[..., :3].transpose(-1, -2)) + projection[..., None, :, 3]
+    in_front = pixel[..., 2] > min_depth
+    return pixel[..., :2] / pixel[..., 2:].clamp(min=min_depth), in_front
 
 def eight_points(center, size, rotation=0):
-    x, y, z = center
-    w, l, h = size
-    w = w/2
-    l = l/2
-    h = h/2
-
-    x1, y1, z1 = x-w, y-l, z+h
-    x2, y2, z2 = x+w, y-l, z+h
-    x3, y3, z3 = x+w, y-l, z-h
-    x4, y4, z4 = x-w, y-l, z-h
-    x5, y5, z5 = x-w, y+l, z+h
-    x6, y6, z6 = x+w, y+l, z+h
-    x7, y7, z7 = x+w, y+l, z-h
-    x8, y8, z8 = x-w, y+l, z-h
-
-    if rotation != 0:
-        x1, y1 = cal_corner_after_rotation(corner=(x1, y1), center=(x, y), r=rotation)
-        x2, y2 = cal_corner_after_rotation(corner=(x2, y2), center=(x, y), r=rotation)
-        x3, y3 = cal_corner_after_rotation(corner=(x3, y3), center=(x, y), r=rotation)
-        x4, y4 = cal_corner_after_rotation(corner=(x4, y4), center=(x, y), r=rotation)
-        x5, y5 = cal_corner_after_rotation(corner=(x5, y5), center=(x, y), r=rotation)
-        x6, y6 = cal_corner_after_rotation(corner=(x6, y6), center=(x, y), r=rotation)
-        x7, y7 = cal_corner_after_rotation(corner=(x7, y7), center=(x, y), r=rotation)
-        x8, y8 = cal_corner_after_rotation(corner=(x8, y8), center=(x, y), r=rotation)
-
-    conern1 = np.array([x1, y1, z1])
-    conern2 = np.array([x2, y2, z2])
-    conern3 = np.array([x3, y3, z3])
-    conern4 = np.array([x4, y4, z4])
-    conern5 = np.array([x5, y5, z5])
-    conern6 = np.array([x6, y6, z6])
-    conern7 = np.array([x7, y7, z7])
-    conern8 = np.array([x8, y8, z8])
-    
-    eight_corners = np.stack([conern1, conern2, conern3, conern4, conern5, conern6, conern7, conern8], axis=0)
-    return eight_corners
+    return box_corners(np.concatenate([center, size, [rotation]]))
 
 def loc_pc2img(points, ex_matrix, in_matrix):
     assert len(points.shape) == 1 and len(points) > 6 
-    x, y, z, w, l, h, r = points[:7]
-    center = [x, y, z]
-    size = [w, l, h]
-    points = eight_points(center, size, r)
-    points = np.insert(points, 3, values=1, axis=1)
-    points_T = np.transpose(points)
-    points_T[3, :] = 1.0
-
-    # lidar2camera
-    points_T_camera = np.dot(ex_matrix, points_T)
-    # camera2pixel
-    pixel = np.dot(in_matrix, points_T_camera).T
-    pixel_xy = np.array([x / x[2] for x in pixel])[:, 0:2]
-    pixel_xy = np.around(pixel_xy).astype(int)
-    
-    return pixel_xy
+    return batch_compute_box_3d(points[None], ex_matrix, in_matrix)[0]
+
+def batch_loc_pc2img(boxes, ex_matrices, in_matrices):
+    """
+    Pixel corners (N, 8, 2) of boxes (N, 7+), each projected with its own
+    calibration: ex_matrices (N, 3, 4), in_matrices (N, 3, 3).
+    """
+    pixel, _ = project_corners(box_corners(np.asarray(boxes)[:, :7]), ex_matrices, in_matrices)
+    return np.around(pixel).astype(int)
 
 def batch_compute_box_3d(objects, ex_matrix, in_matrix):
-    corners2d = []
-    for obj in objects:
-        corner_2d = loc_pc2img(obj, ex_matrix, in_matrix)
-        corners2d.append(corner_2d)
-    corners2d = np.stack(corners2d, axis=0)
-    return corners2d
+    pixel, _ = project_corners(box_corners(np.asarray(objects)[:, :7]), ex_matrix, in_matrix)
+    return np.around(pixel).astype(int)
 
 def draw_projected_box3d(image, qs, color=(255,255,255), thickness=2):
     ''' Draw 3d bounding box in image
@@ -157,16 +320,22 @@ def draw_projected_box3d(image, qs, color=(255,255,255), thickness=2):
           . 5 -------- 4
           |/         |/
           6 -------- 7
+        Float vertices are truncated to pixels, as this function always did.
+    '''
+    qs = np.asarray(qs).astype(np.int32)
+    return draw_projected_boxes3d(image, qs[None], color=color, thickness=thickness)
+
+def draw_projected_boxes3d(image, corners2d, in_front=None, color=(255,255,255), thickness=2):
+    ''' Draw the 3d boxes corners2d (N,8,2), ordered as for draw_projected_box3d, in one polylines call.
+        in_front: (N,8) mask of project_corners, the edges with a corner behind the camera are left out
     '''
-    qs = qs.astype(np.int32)
-    for k in range(0,4):
-       #http://docs.enthought.com/mayavi/mayavi/auto/mlab_helper_functions.html
-       i,j=k,(k+1)%4
-       cv2.line(image, (qs[i,0],qs[i,1]), (qs[j,0],qs[j,1]), color, thickness, cv2.LINE_AA) # use LINE_AA for opencv3
-
-       i,j=k+4,(k+1)%4 + 4
-       cv2.line(image, (qs[i,0],qs[i,1]), (qs[j,0],qs[j,1]), color, thickness, cv2.LINE_AA)
-
-       i,j=k,k+4
-       cv2.line(image, (qs[i,0],qs[i,1]), (qs[j,0],qs[j,1]), color, thickness, cv2.LINE_AA)
-    return image
\ No newline at end of file
+    corners2d = np.asarray(corners2d)
+    if len(corners2d) == 0:
+        return image
+    edges = np.around(corners2d[:, BOX_EDGES]).reshape(-1, 2, 2)
+    if in_front is not None:
+        edges = edges[np.asarray(in_front)[:, BOX_EDGES].all(axis=-1).reshape(-1)]
+    # keep the coordinates in the range of the drawing code, cv2 clips the lines to the image
+    edges = np.clip(edges, -2 ** 20, 2 ** 20).astype(np.int32)
+    cv2.polylines(image, list(edges), False, color, thickness, cv2.LINE_AA)
+    return image
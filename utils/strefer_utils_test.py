@@ -0,0 +1,190 @@
+''' Testing the point cloud preprocessing before sampling. '''
+
+import os
+import sys
+
+import tempfile
+
+import cv2
+import numpy as np
+import torch
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from datasets.synthetic import calibration, random_boxes, random_image, random_points
+from utils.box_util import resize_img_keep_ratio
+from utils.strefer_utils import (BOX_EDGES, batch_compute_box_3d, box_corners, box_corners_tensor, crop_to_range,
+                                 draw_projected_box3d, draw_projected_boxes3d, extract_pc_in_box3d, fit_img_shape,
+                                 image_size, letterbox_mask, letterbox_size, load_image, load_image_letterbox,
+                                 my_compute_box_3d, preprocess_points, project_corners, project_corners_tensor,
+                                 remove_ground, rotz, voxel_downsample)
+
+PC_RANGE = [16.36, 0, -1.5, 30.72, 40.96, 5, 0]
+
+
+def test_crop_to_range():
+    pc = np.array([[1.5, 0, 0, 0, 0, 0], [0.5, 0, 0, 0, 0, 0], [20, 20, 0, 0, 0, 0], [20, 21, 0, 0, 0, 0]])
+    assert (crop_to_range(pc, PC_RANGE) == pc[[0, 2]]).all()
+
+
+def test_remove_ground():
+    rng = np.random.default_rng(0)
+    ground = np.concatenate([rng.random((900, 2)), rng.normal(-3.5, 0.02, (900, 1))], axis=1)
+    below = np.concatenate([rng.random((20, 2)), rng.uniform(-4, -3.6, (20, 1))], axis=1)
+    objects = np.concatenate([rng.random((100, 2)), rng.uniform(-3, -1, (100, 1))], axis=1)
+    kept = remove_ground(np.concatenate([ground, below, objects]), 0.2)
+    assert len(kept) == 100 and (kept[:, 2] >= -3).all()
+
+
+def test_voxel_downsample():
+    rng = np.random.default_rng(0)
+    pc = rng.random((5000, 6)) * [2, 2, 2, 1, 1, 1]
+    down = voxel_downsample(pc, 0.5, rng=rng)
+    voxels = np.unique(np.floor(down[:, :3] / 0.5), axis=0)
+    assert len(down) == len(voxels) == 64
+    assert all((pc == p).all(axis=1).any() for p in down)
+
+
+def test_preprocess_keeps_target_points():
+    """A smaller budget after cropping and ground removal keeps as many points on the objects."""
+    rng = np.random.default_rng(0)
+    boxes = random_boxes(rng, 12)
+    pc = random_points(rng, boxes, 60000)
+    corners = [my_compute_box_3d(b[0:3], b[3:6], b[6]) for b in boxes]
+    counts = lambda points: np.array([extract_pc_in_box3d(points, c)[1].sum() for c in corners])
+
+    uniform = counts(preprocess_points(pc, 30000, rng=rng))
+    roi = counts(preprocess_points(pc, 16384, PC_RANGE, ground_height=0.2, rng=rng))
+    assert (roi > 0).all()
+    assert roi.sum() >= uniform.sum()
+    assert preprocess_points(pc, 16384, PC_RANGE, 0.2, 0.05, rng=rng).shape == (16384, 6)
+    assert (preprocess_points(pc[:0], 100, PC_RANGE) == 0).all()
+
+
+def test_load_image_letterbox():
+    """Same geometry and mask as load_image + resize_img_keep_ratio, close pixels."""
+    rng = np.random.default_rng(0)
+    out = np.empty((3, 384, 384), dtype=np.float32)
+    with tempfile.TemporaryDirectory() as tmp:
+        for size, ext in [((1920, 1200), 'jpg'), ((1920, 1080), 'jpg'), ((640, 360), 'jpg'), ((400, 600), 'png')]:
+            path = os.path.join(tmp, f'{size[0]}x{size[1]}.{ext}')
+            cv2.imwrite(path, random_image(rng, size))
+            image, ratio, pad_w, pad_h = resize_img_keep_ratio(load_image(path), 384)
+            image = np.transpose(image, (2, 0, 1))
+            img_mask = np.zeros(image.shape[1:3], dtype=bool)
+            img_mask[0+pad_h//2:image.shape[0]-pad_h//2, 0+pad_w//2:image.shape[1]-pad_w//2] = 1
+
+            letterbox, ratio2, pad_w2, pad_h2 = load_image_letterbox(path, 384, out=out)
+            assert letterbox is out and (ratio2, pad_w2, pad_h2) == (ratio, pad_w, pad_h)
+            assert (letterbox_mask(384, pad_w2, pad_h2) == img_mask).all()
+            assert np.abs(letterbox - image).mean() < 0.02
+
+
+def test_letterbox_canvas():
+    """Non-square canvases fitted to the camera, with the valid region of the image as their mask."""
+    assert letterbox_size(384) == letterbox_size([384]) == 384
+    assert letterbox_size([224, 384]) == (224, 384)
+    assert fit_img_shape(384, (1080, 1920)) == (224, 384) and fit_img_shape(512, (1080, 1920)) == (288, 512)
+    assert letterbox_size([384], (1200, 1920)) == (256, 384) and fit_img_shape(384, (600, 400)) == (384, 256)
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        for size, canvas in [((1920, 1080), (224, 384)), ((1920, 1080), (288, 512)), ((400, 600), (384, 256))]:
+            path = os.path.join(tmp, f'{size[0]}x{size[1]}.jpg')
+            cv2.imwrite(path, random_image(rng, size))
+            assert image_size(path) == size[::-1]
+            letterbox, ratio, pad_w, pad_h = load_image_letterbox(path, canvas)
+            assert letterbox.shape == (3,) + canvas
+            mask = letterbox_mask(canvas, pad_w, pad_h)
+            assert mask.sum() == round(size[0] * ratio) * round(size[1] * ratio)
+            # the padding is black, the image is not
+            assert (letterbox[:, ~mask] == 0).all() and letterbox[:, mask].mean() > 0.1
+
+
+def reference_corners(box):
+    """The corners as eight_points built them, one rotated corner at a time."""
+    x, y, z, w, l, h, r = box
+    corners = []
+    for dx, dy, dz in [(-1, -1, 1), (1, -1, 1), (1, -1, -1), (-1, -1, -1),
+                       (-1, 1, 1), (1, 1, 1), (1, 1, -1), (-1, 1, -1)]:
+        cx, cy = x + dx * w / 2, y + dy * l / 2
+        corners.append([np.cos(r) * (cx - x) - np.sin(r) * (cy - y) + x,
+                        np.sin(r) * (cx - x) + np.cos(r) * (cy - y) + y, z + dz * h / 2])
+    return np.array(corners)
+
+
+def test_box_corners():
+    boxes = random_boxes(np.random.default_rng(0), 50)
+    corners = box_corners(boxes)
+    assert corners.shape == (50, 8, 3)
+    assert np.allclose(corners, [reference_corners(b) for b in boxes])
+    assert np.allclose(box_corners_tensor(torch.from_numpy(boxes)).numpy(), corners)
+    for b in boxes[:5]:
+        l, w, h = b[3:6] / 2
+        expected = rotz(-b[6]) @ np.array([[-l, l, l, -l, -l, l, l, -l], [w, w, -w, -w, w, w, -w, -w],
+                                           [h, h, h, h, -h, -h, -h, -h]])
+        assert np.allclose(my_compute_box_3d(b[0:3], b[3:6], b[6]), expected.T + b[0:3])
+
+
+def test_project_corners():
+    ex_matrix, in_matrix = (np.array(m, dtype=np.float64) for m in calibration((1920, 1080)))
+    boxes = random_boxes(np.random.default_rng(1), 40)
+    boxes[:, 0] = np.linspace(-5, 30, 40)  # some of them behind the camera
+    corners = box_corners(boxes)
+    pixel, in_front = project_corners(corners, ex_matrix, in_matrix)
+    camera = corners @ ex_matrix[:, :3].T + ex_matrix[:, 3]
+    assert (in_front == (camera[..., 2] > 1e-3)).all() and not in_front.all() and in_front.any()
+    image = camera @ in_matrix.T
+    assert np.allclose(pixel[in_front], (image[..., :2] / image[..., 2:])[in_front])
+    assert np.isfinite(pixel).all()
+    # one calibration per box, and the tensor version
+    per_box, _ = project_corners(corners, np.stack([ex_matrix] * 40), np.stack([in_matrix] * 40))
+    assert np.allclose(per_box, pixel)
+    tensor, tensor_in_front = project_corners_tensor(torch.from_numpy(corners), torch.from_numpy(ex_matrix),
+                                                     torch.from_numpy(in_matrix))
+    assert np.allclose(tensor.numpy(), pixel) and (tensor_in_front.numpy() == in_front).all()
+    assert (batch_compute_box_3d(boxes, ex_matrix, in_matrix) == np.around(pixel).astype(int)).all()
+
+
+def draw_box_lines(image, qs):
+    """draw_projected_box3d as it drew the box, one cv2.line per edge."""
+    for i, j in BOX_EDGES:
+        cv2.line(image, (int(qs[i, 0]), int(qs[i, 1])), (int(qs[j, 0]), int(qs[j, 1])), (255, 255, 255), 2,
+                 cv2.LINE_AA)
+    return image
+
+
+def test_draw_projected_boxes3d():
+    ex_matrix, in_matrix = (np.array(m, dtype=np.float64) for m in calibration((640, 360)))
+    boxes = random_boxes(np.random.default_rng(2), 30)
+    pixel, in_front = project_corners(box_corners(boxes), ex_matrix, in_matrix)
+    assert in_front.all()
+    one_by_one = np.zeros((360, 640, 3), dtype=np.uint8)
+    for qs in np.around(pixel).astype(int):
+        draw_box_lines(one_by_one, qs)
+    assert (draw_projected_boxes3d(np.zeros_like(one_by_one), pixel) == one_by_one).all()
+    # the single-box wrapper keeps truncating float vertices
+    inside = ((pixel >= 0) & (pixel < [640, 360])).all(axis=(1, 2))
+    qs = pixel[inside][0]
+    assert (np.trunc(qs) != np.around(qs)).any()
+    expected = draw_box_lines(np.zeros_like(one_by_one), qs)
+    assert expected.any() and (draw_projected_box3d(np.zeros_like(one_by_one), qs) == expected).all()
+    # a box around the camera only keeps the edges in front of it
+    pixel, in_front = project_corners(box_corners(np.array([[0.5, 0, 0, 2, 2, 2, 0]])), ex_matrix, in_matrix)
+    assert in_front.any() and not in_front.all()
+    kept = in_front[0, BOX_EDGES].all(axis=1)
+    expected = np.zeros_like(one_by_one)
+    for i, j in BOX_EDGES[kept]:
+        cv2.line(expected, tuple(np.around(pixel[0, i]).astype(int)), tuple(np.around(pixel[0, j]).astype(int)),
+                 (255, 255, 255), 2, cv2.LINE_AA)
+    assert (draw_projected_boxes3d(np.zeros_like(one_by_one), pixel, in_front) == expected).all()
+
+if __name__ == '__main__':
+    test_crop_to_range()
+    test_remove_ground()
+    test_voxel_downsample()
+    test_preprocess_keeps_target_points()
+    test_load_image_letterbox()
+    test_letterbox_canvas()
+    test_box_corners()
+    test_project_corners()
+    test_draw_projected_boxes3d()
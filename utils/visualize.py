@@ -0,0 +1,149 @@
+"""
+Rendering of evaluation results for review.
+
+render.py reads the per-sample records a test run streamed with
+--results_dir (see datasets.results) and renders, in a process pool:
+
+    images/<scene_id>/<index>.jpg           the camera image of every sample with
+                                            its ground-truth (green) and predicted
+                                            (red) box, the IoU and the description
+    ply/<scene_id>/<point_cloud_name>.ply        the colored point cloud of a frame
+    ply/<scene_id>/<point_cloud_name>_boxes.ply  one mesh of all the ground-truth and
+                                                 predicted boxes of the frame
+
+Work is split by frame, so every image and point cloud is decoded once. The
+PLY files are binary, written from vertex arrays in one go, and all boxes of
+a frame are one mesh built from the batched corners of strefer_utils.
+
+    python render.py --results_dir outputs/results --src_path data/STRefer --out_dir outputs/render
+"""
+import functools
+import multiprocessing
+import os
+import os.path as osp
+
+import cv2
+import numpy as np
+
+from utils.strefer_utils import box_corners, draw_projected_boxes3d, random_sampling
+
+# outward triangles of the box_corners corners
+BOX_FACES = np.array([(a, b, c) for q in [(3, 2, 1, 0), (6, 7, 4, 5), (0, 1, 5, 4), (7, 6, 2, 3), (7, 3, 0, 4),
+                                          (2, 6, 5, 1)]
+                      for a, b, c in [(q[0], q[1], q[2]), (q[0], q[2], q[3])]])
+GT_COLOR = (0, 255, 0)    # RGB
+PRED_COLOR = (255, 0, 0)
+
+
+def box_mesh(boxes, colors=None):
+    """ Vertices (8N,3), triangles (12N,3) and vertex colors (8N,3) of boxes (N,7) with colors (N,3), or None """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 7)
+    vertices = box_corners(boxes).reshape(-1, 3)
+    faces = (BOX_FACES + 8 * np.arange(len(boxes))[:, None, None]).reshape(-1, 3)
+    if colors is not None:
+        colors = np.repeat(np.asarray(colors, dtype=np.uint8).reshape(-1, 3), 8, axis=0)
+    return vertices, faces, colors
+
+
+def write_ply_binary(filename, points, colors=None, faces=None):
+    """ Write points (N,3), optional RGB colors (N,3) and triangles (M,3) as a binary little-endian PLY """
+    vertex_dtype = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if colors is not None:
+        vertex_dtype += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    vertex = np.empty(len(points), dtype=vertex_dtype)
+    for i, axis in enumerate('xyz'):
+        vertex[axis] = points[:, i]
+    if colors is not None:
+        for i, channel in enumerate(('red', 'green', 'blue')):
+            vertex[channel] = colors[:, i]
+    header = ['ply', 'format binary_little_endian 1.0', f'element vertex {len(vertex)}']
+    header += [f'property {"float" if t == "<f4" else "uchar"} {name}' for name, t in vertex_dtype]
+    if faces is not None:
+        face = np.empty(len(faces), dtype=[('count', 'u1'), ('vertex_indices', '<i4', (3,))])
+        face['count'] = 3
+        face['vertex_indices'] = faces
+        header += [f'element face {len(face)}', 'property list uchar int vertex_indices']
+    header.append('end_header')
+    with open(filename, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        vertex.tofile(f)
+        if faces is not None:
+            face.tofile(f)
+
+
+def draw_sample(image, record):
+    """ Draw the ground-truth and predicted box of one result record on the BGR image, caption on top """
+    draw_projected_boxes3d(image, record['gt_corner2d'][None], record['gt_in_front'][None], color=GT_COLOR[::-1])
+    draw_projected_boxes3d(image, record['pred_corner2d'][None], record['pred_in_front'][None],
+                           color=PRED_COLOR[::-1])
+    caption = f"IoU {record['iou']:.2f}  {record['language']}"
+    scale = image.shape[1] / 1920
+    cv2.rectangle(image, (0, 0), (image.shape[1], int(40 * scale)), (0, 0, 0), -1)
+    cv2.putText(image, caption[:150], (int(10 * scale), int(28 * scale)), cv2.FONT_HERSHEY_SIMPLEX, 0.8 * scale,
+                (255, 255, 255), max(int(2 * scale), 1), cv2.LINE_AA)
+    return image
+
+
+def frame_groups(results):
+    """ Split result columns by frame: a list of column dicts, one per (scene_id, point_cloud_name) """
+    if len(results['index']) == 0:
+        return []
+    keys = np.char.add(np.char.add(results['scene_id'].astype(str), '/'), results['point_cloud_name'].astype(str))
+    _, inverse = np.unique(keys, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.flatnonzero(np.diff(inverse[order])) + 1
+    return [{key: values[rows] for key, values in results.items()} for rows in np.split(order, bounds)]
+
+
+def render_frame(frame, src_path, out_dir, images=True, points=True, boxes=True, max_points=0):
+    """ Render the samples of one frame (a frame_groups entry); returns the number of files written """
+    scene_id, point_cloud_name = str(frame['scene_id'][0]), str(frame['point_cloud_name'][0])
+    written = 0
+    if images:
+        os.makedirs(osp.join(out_dir, 'images', scene_id), exist_ok=True)
+        decoded = {}
+        for i in range(len(frame['index'])):
+            record = {key: values[i] for key, values in frame.items()}
+            image_name = str(record['image_name'])
+            if image_name not in decoded:
+                decoded[image_name] = cv2.imread(osp.join(src_path, 'image', scene_id, f'{image_name}.jpg'))
+            if decoded[image_name] is None:
+                continue
+            image = draw_sample(decoded[image_name].copy(), record)
+            cv2.imwrite(osp.join(out_dir, 'images', scene_id, f"{record['index']:06d}.jpg"), image)
+            written += 1
+    if points or boxes:
+        os.makedirs(osp.join(out_dir, 'ply', scene_id), exist_ok=True)
+        prefix = osp.join(out_dir, 'ply', scene_id, point_cloud_name)
+    if points:
+        scene_file = osp.join(src_path, 'points_rgbd', scene_id, f'{point_cloud_name}.npy')
+        if osp.exists(scene_file):
+            pc = np.load(scene_file)
+            if max_points and len(pc) > max_points:
+                pc = random_sampling(pc, max_points, rng=np.random.default_rng(0))
+            write_ply_binary(prefix + '.ply', pc[:, 0:3], np.clip(pc[:, 3:6], 0, 255).astype(np.uint8))
+            written += 1
+    if boxes:
+        # several descriptions of a frame often refer to the same object
+        gt_boxes = np.unique(frame['gt_box'][:, :7], axis=0)
+        pred_boxes = frame['pred_box'][:, :7]
+        colors = [GT_COLOR] * len(gt_boxes) + [PRED_COLOR] * len(pred_boxes)
+        vertices, faces, vertex_colors = box_mesh(np.concatenate([gt_boxes, pred_boxes]), colors)
+        write_ply_binary(prefix + '_boxes.ply', vertices, vertex_colors, faces)
+        written += 1
+    return written
+
+
+def render_results(results, src_path, out_dir, workers=8, **options):
+    """
+    Render the columns returned by datasets.results.read_results frame by
+    frame in a pool of `workers` processes, in this process with 0.
+    `options` go to render_frame. Yields the files written per frame.
+    """
+    fn = functools.partial(render_frame, src_path=src_path, out_dir=out_dir, **options)
+    frames = frame_groups(results)
+    if workers == 0:
+        yield from map(fn, frames)
+        return
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        yield from pool.imap_unordered(fn, frames, chunksize=max(1, min(16, len(frames) // (4 * workers))))
@@ -0,0 +1,77 @@
+''' Testing the box meshes, the binary PLY export and rendering evaluation results in a pool. '''
+
+import json
+import os
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE_DIR))
+from datasets.results import evaluate_boxes, read_results
+from datasets.synthetic import ANNOTATION_FILES, generate, random_boxes
+from utils.pc_utils import write_oriented_bbox
+from utils.visualize import box_mesh, frame_groups, render_results, write_ply_binary
+
+
+def test_box_mesh():
+    boxes = random_boxes(np.random.default_rng(0), 5)
+    vertices, faces, colors = box_mesh(boxes, [(255, 0, 0)] * 5)
+    assert vertices.shape == (40, 3) and faces.shape == (60, 3) and (colors == [255, 0, 0]).all()
+    triangles = vertices[faces]
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    outward = triangles.mean(axis=1) - np.repeat(boxes[:, :3], 12, axis=0)
+    assert ((normals * outward).sum(axis=1) > 0).all()
+
+
+def test_write_ply_binary():
+    from plyfile import PlyData
+    import trimesh
+    rng = np.random.default_rng(0)
+    points, colors = rng.random((100, 3)), rng.integers(0, 256, (100, 3))
+    boxes = random_boxes(rng, 4)
+    with tempfile.TemporaryDirectory() as tmp:
+        write_ply_binary(os.path.join(tmp, 'points.ply'), points, colors)
+        vertex = PlyData.read(os.path.join(tmp, 'points.ply'))['vertex']
+        assert np.allclose(np.stack([vertex['x'], vertex['y'], vertex['z']], 1), points, atol=1e-6)
+        assert (np.stack([vertex['red'], vertex['green'], vertex['blue']], 1) == colors).all()
+
+        write_oriented_bbox(boxes, os.path.join(tmp, 'boxes.ply'))
+        mesh = trimesh.load(os.path.join(tmp, 'boxes.ply'), process=False)
+        assert len(mesh.vertices) == 32 and len(mesh.faces) == 48
+        assert np.isclose(mesh.volume, boxes[:, 3:6].prod(axis=1).sum(), rtol=1e-4)
+
+
+def test_render_results():
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        src_path, data_root = generate(tmp, num_scenes=2, frames_per_scene=3, points_per_frame=2000,
+                                       image_size=(320, 180), test_ratio=0.5)
+        entries = json.load(open(os.path.join(data_root, ANNOTATION_FILES['strefer']['test'])))
+        gt = np.array([e['point_cloud']['bbox'] for e in entries])
+        pred = gt + np.concatenate([rng.normal(0, 0.2, (len(gt), 3)), np.zeros((len(gt), 4))], axis=1)
+        evaluate_boxes(entries, pred, os.path.join(tmp, 'results'))
+        results = read_results(os.path.join(tmp, 'results'))
+        frames = frame_groups(results)
+        assert sorted(i for f in frames for i in f['index']) == list(range(len(entries)))
+        assert all(len(set(f['point_cloud_name'])) == len(set(f['scene_id'])) == 1 for f in frames)
+
+        outputs = {}
+        for workers in (0, 2):
+            out_dir = os.path.join(tmp, f'render_{workers}')
+            assert sum(render_results(results, src_path, out_dir, workers=workers)) == len(entries) + 2 * len(frames)
+            outputs[workers] = {os.path.relpath(os.path.join(root, f), out_dir): open(os.path.join(root, f), 'rb').read()
+                                for root, _, files in os.walk(out_dir) for f in files}
+        assert outputs[0] == outputs[2]
+        entry = entries[0]
+        image = cv2.imread(os.path.join(src_path, 'image', entry['scene_id'], entry['image']['image_name'] + '.jpg'))
+        overlay = cv2.imread(os.path.join(tmp, 'render_0', 'images', entry['scene_id'], '000000.jpg'))
+        assert overlay.shape == image.shape and np.abs(overlay.astype(int) - image).max() > 100
+
+
+if __name__ == '__main__':
+    test_box_mesh()
+    test_write_ply_binary()
+    test_render_results()